@@ -0,0 +1,102 @@
+"""
+Стоимость разбора одного callback: прежняя цепочка re.match + elif/startswith
+против таблицы маршрутов CallbackRouter.
+
+  python -m benchmarks.bench_router --n 200000
+"""
+import argparse
+import re
+import time
+
+from router import CallbackRouter
+
+SAMPLE = [
+    "cart", "pay_rub", "enter_promo", "back_categories", "ttt_vs_bot",
+    "cat_clothing", "back_cat_shoes", "view_17", "add_17", "inc_3", "dec_3", "del_3", "move_4",
+]
+
+
+def _noop(*args):
+    return args
+
+
+def legacy_dispatch(data):
+    """Прежняя логика button_handler без обращений к Telegram"""
+    if len(data) > 50 or not re.match(r"^[a-zA-Z0-9_\-]+$", data):
+        return None
+    elif data.startswith("inc_"):
+        return _noop(int(data.split("_")[1]))
+    elif data.startswith("dec_"):
+        return _noop(int(data.split("_")[1]))
+    elif data.startswith("del_"):
+        return _noop(int(data.split("_")[1]))
+    elif data == "cat_clothing":
+        return _noop("clothing")
+    elif data == "cat_shoes":
+        return _noop("shoes")
+    elif data == "cat_accessories":
+        return _noop("accessories")
+    elif data == "back_categories":
+        return _noop()
+    elif data.startswith("view_"):
+        return _noop(int(data.split("_")[1]))
+    elif data.startswith("add_"):
+        return _noop(int(data.split("_")[1]))
+    elif data == "cart":
+        return _noop()
+    elif data == "pay_rub":
+        return _noop()
+    elif data.startswith("back_cat_"):
+        return _noop(data.split("_")[2])
+    elif data in ("ttt_game", "ttt_menu", "ttt_vs_bot", "ttt_vs_friend", "enter_promo"):
+        return _noop()
+    elif data.startswith("move_"):
+        return _noop(int(data.split("_")[1]))
+    return None
+
+
+def build_router() -> CallbackRouter:
+    router = CallbackRouter()
+    for data in ("cart", "pay_rub", "enter_promo", "back_categories", "ignore",
+                 "ttt_game", "ttt_menu", "ttt_vs_bot", "ttt_vs_friend"):
+        router.exact(data, _noop)
+    router.prefix("cat_", _noop)
+    router.prefix("back_cat_", _noop)
+    for prefix in ("view_", "add_", "inc_", "dec_", "del_", "move_"):
+        router.prefix(prefix, _noop, int)
+    return router
+
+
+def router_dispatch(router, data):
+    route = router.route(data)
+    if route is None:
+        return None
+    handler, args, _ = route
+    return handler(*args)
+
+
+def _measure(fn, n: int) -> float:
+    """нс на один callback"""
+    samples = SAMPLE * (n // len(SAMPLE) + 1)
+    samples = samples[:n]
+    started = time.perf_counter()
+    for data in samples:
+        fn(data)
+    return (time.perf_counter() - started) / n * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации callback")
+    parser.add_argument("--n", type=int, default=200000)
+    args = parser.parse_args()
+
+    router = build_router()
+    legacy = _measure(legacy_dispatch, args.n)
+    routed = _measure(lambda data: router_dispatch(router, data), args.n)
+    print(f"elif + re.match : {legacy:8.1f} нс/callback")
+    print(f"CallbackRouter  : {routed:8.1f} нс/callback")
+    print(f"ускорение       : {legacy / routed:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
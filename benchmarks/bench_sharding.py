@@ -0,0 +1,135 @@
+"""
+Пропускная способность шардированного бота в зависимости от числа процессов.
+
+Поднимает заглушку Bot API (devtools.fake_telegram), запускает
+python -m sharding с --workers N и отправляет на вебхук фронта пачку
+команд /start от разных пользователей. Каждая команда — ровно один
+sendMessage, поэтому обработка считается законченной, когда заглушка
+насчитает столько же вызовов. 0 процессов — обычный python bot.py
+с вебхуком, для сравнения без фронта.
+
+  python -m benchmarks.bench_sharding --workers 0 1 2 4 --updates 5000 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from devtools.fake_telegram import FakeTelegram
+from server import SECRET_HEADER, webhook_secret
+
+BOT_TOKEN = "123456:bench"
+URL_PATH = "telegram"
+
+
+def make_update(update_id: int, user_id: int) -> bytes:
+    user = {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }).encode()
+
+
+def launch(workers: int, port: int, api_url: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_API_BASE_URL": f"{api_url}/bot",
+        "WEBHOOK_URL": "http://bench.invalid",
+        "PORT": str(port),
+        "STATE_BACKEND": "memory",
+        "CATALOG_RELOAD_INTERVAL": "0",
+        # Измеряем сам бот, а не лимиты Telegram и антиспам
+        "BOT_API_RATE": "1000000",
+        "BOT_API_CHAT_RATE": "1000000",
+        "BOT_API_CHAT_BURST": "1000000",
+        "RATE_LIMIT_PER_SEC": "1000000",
+        "RATE_LIMIT_BURST": "1000000",
+        "INGEST_QUEUE_SIZE": "100000",
+    })
+    for name in ("SUPABASE_URL", "SUPABASE_KEY", "WEBHOOK_SECRET"):
+        env.pop(name, None)
+    if workers:
+        command = [sys.executable, "-m", "sharding", "--workers", str(workers),
+                   "--host", "127.0.0.1", "--port", str(port), "--worker-port", str(port + 1)]
+    else:
+        command = [sys.executable, "bot.py"]
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout} с")
+
+
+async def measure(port: int, fake: FakeTelegram, updates: int, users: int, concurrency: int) -> float:
+    base = f"http://127.0.0.1:{port}"
+    headers = {"Content-Type": "application/json", SECRET_HEADER: webhook_secret(BOT_TOKEN)}
+    bodies = [make_update(i + 1, 1000 + i % users) for i in range(updates)]
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await wait_ready(client, f"{base}/readyz")
+        fake.reset()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def post(body):
+            async with semaphore:
+                while (await client.post(f"{base}/{URL_PATH}", content=body, headers=headers)).status_code == 503:
+                    await asyncio.sleep(0.01)  # Как Telegram: повтор при перегрузке
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(body) for body in bodies))
+        while fake.stats()["calls"].get("sendMessage", 0) < updates:
+            await asyncio.sleep(0.01)
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка заглушки Bot API, с")
+    parser.add_argument("--port", type=int, default=18000)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency)
+    server, api_url = fake.serve()
+    baseline = None
+    try:
+        for workers in args.workers:
+            process = launch(workers, args.port, api_url)
+            try:
+                elapsed = asyncio.run(measure(args.port, fake, args.updates, args.users, args.concurrency))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+            rate = args.updates / elapsed
+            baseline = baseline or rate
+            label = f"{workers} процессов" if workers else "без фронта"
+            print(f"{label:>14}: {rate:8.0f} обновлений/с  ({elapsed:.2f} с, x{rate / baseline:.2f})")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
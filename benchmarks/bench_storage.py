@@ -0,0 +1,70 @@
+"""
+Сравнение задержки операций хранилищ состояния.
+
+  python -m benchmarks.bench_storage --ops 20000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from storage import MemoryBackend, SQLiteBackend
+
+
+def _time_op(fn, n: int) -> float:
+    """Среднее время одной операции, мкс"""
+    started = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    return (time.perf_counter() - started) / n * 1e6
+
+
+def bench_backend(backend, ops: int, users: int) -> dict:
+    carts = backend.namespace("carts")
+    rng = random.Random(42)
+    user_ids = [rng.randrange(users) for _ in range(ops)]
+    cart = {str(pid): rng.randint(1, 3) for pid in range(5)}
+
+    results = {
+        "put_us": _time_op(lambda i: carts.put(user_ids[i], cart), ops),
+        "get_us": _time_op(lambda i: carts.get(user_ids[i]), ops),
+        "get_missing_us": _time_op(lambda i: carts.get(users + i), ops),
+    }
+
+    def read_modify_write(i):
+        value = carts.get(user_ids[i]) or {}
+        value["1"] = value.get("1", 0) + 1
+        carts.put(user_ids[i], value)
+
+    results["read_modify_write_us"] = _time_op(read_modify_write, ops)
+    started = time.perf_counter()
+    backend.flush()
+    results["final_flush_ms"] = (time.perf_counter() - started) * 1000
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилищ состояния")
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "memory": MemoryBackend(),
+            "sqlite": SQLiteBackend(os.path.join(tmp, "state.db")),
+            "sqlite_no_coalescing": SQLiteBackend(os.path.join(tmp, "state_nc.db"), flush_threshold=1),
+        }
+        rows = {name: bench_backend(backend, args.ops, args.users) for name, backend in backends.items()}
+        for backend in backends.values():
+            backend.close()
+
+    columns = list(next(iter(rows.values())))
+    print(f"{'backend':<22}" + "".join(f"{c:>22}" for c in columns))
+    for name, row in rows.items():
+        print(f"{name:<22}" + "".join(f"{row[c]:>22.2f}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Ходов бота в секунду: прежние функции на списках строк
+(check_win + find_winning_move) против ttt_engine на битовых масках.
+
+  python -m benchmarks.bench_ttt --games 20000
+"""
+import argparse
+import random
+import time
+
+import ttt_engine
+
+
+# --- Прежняя реализация из bot.py (для сравнения) ---
+def legacy_check_win(board, player):
+    win_conditions = [
+        (0, 1, 2), (3, 4, 5), (6, 7, 8),
+        (0, 3, 6), (1, 4, 7), (2, 5, 8),
+        (0, 4, 8), (2, 4, 6)
+    ]
+    return any(all(board[i] == player for i in cond) for cond in win_conditions)
+
+
+def legacy_check_draw(board):
+    return " " not in board
+
+
+def legacy_find_winning_move(board, player):
+    for i in range(9):
+        if board[i] == " ":
+            board[i] = player
+            if legacy_check_win(board, player):
+                board[i] = " "
+                return i
+            board[i] = " "
+    return None
+
+
+def legacy_bot_move(board, rng):
+    move = legacy_find_winning_move(board, "O")
+    if move is None:
+        move = legacy_find_winning_move(board, "X")
+    if move is None:
+        move = rng.choice([i for i, cell in enumerate(board) if cell == " "])
+    return move
+
+
+# --- Прогоны ---
+def play_legacy(games: int, seed: int = 1) -> int:
+    rng = random.Random(seed)
+    moves = 0
+    for _ in range(games):
+        board = [" "] * 9
+        while True:
+            board[rng.choice([i for i, c in enumerate(board) if c == " "])] = "X"
+            if legacy_check_win(board, "X") or legacy_check_draw(board):
+                break
+            board[legacy_bot_move(board, rng)] = "O"
+            moves += 1
+            if legacy_check_win(board, "O") or legacy_check_draw(board):
+                break
+    return moves
+
+
+def play_engine(games: int, seed: int = 1) -> int:
+    rng = random.Random(seed)
+    wins = ttt_engine.WINS
+    moves = 0
+    for _ in range(games):
+        x = o = 0
+        while True:
+            x |= 1 << rng.choice(ttt_engine.free_cells(x, o))
+            if wins[x] or ttt_engine.is_full(x, o):
+                break
+            o |= 1 << ttt_engine.bot_move(x, o, rng=rng)
+            moves += 1
+            if wins[o] or ttt_engine.is_full(x, o):
+                break
+    return moves
+
+
+def _rate(fn, games: int) -> float:
+    started = time.perf_counter()
+    moves = fn(games)
+    return moves / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк ходов бота в крестиках-ноликах")
+    parser.add_argument("--games", type=int, default=20000)
+    args = parser.parse_args()
+
+    legacy = _rate(play_legacy, args.games)
+    engine = _rate(play_engine, args.games)
+    print(f"списки + check_win : {legacy:12,.0f} ходов/с")
+    print(f"ttt_engine         : {engine:12,.0f} ходов/с")
+    print(f"ускорение          : {engine / legacy:12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+Нагрузочный тест: синтетические покупатели и игроки против настоящих обработчиков.
+
+Бот импортируется в этот же процесс и работает через Application
+(дедупликация, антиспам, порядок по пользователям, все обработчики),
+но Bot API и Supabase — локальные заглушки devtools.fake_telegram и
+devtools.fake_supabase с заданной задержкой. Каждый пользователь
+проигрывает сценарии:
+
+  shop   — /start, категория, товар, add/inc/dec, корзина, промокод,
+           счёт, pre_checkout_query, successful_payment
+  browse — /start, категории и карточки товаров туда-обратно
+  game   — /tictactoe и ходы до конца партии с ботом
+  pvp    — партия вдвоём: приглашение, вход по ссылке, ходы по очереди
+
+Задержка обновления — от передачи в Application до завершения всех его
+обработчиков, включая ожидание ответов заглушек.
+
+  python -m benchmarks.loadtest --users 200 --sessions 3 --api-latency 0.05 --db-latency 0.02
+
+Лимиты антиспама и Bot API по умолчанию сняты, чтобы мерить сам бот;
+чтобы оставить боевые, задайте RATE_LIMIT_PER_SEC, BOT_API_RATE и т.п. в окружении.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import re
+import time
+
+from devtools.fake_supabase import FakeSupabase
+from devtools.fake_telegram import BOT_USER, FakeTelegram
+
+SCENARIOS = ("shop", "browse", "game", "pvp")
+PVP_OPPONENT_OFFSET = 10 ** 9  # соперник в партии вдвоём — отдельный синтетический пользователь
+INVITE_RE = re.compile(r"start=ttt_([0-9a-f]{8})")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+
+def invoice_amount(invoice: dict) -> int:
+    return sum(price["amount"] for price in invoice["prices"])
+
+
+def configure_env(api_url: str, db_url: str):
+    """Окружение бота — до его импорта: bot.py читает настройки при загрузке модуля"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:loadtest",
+        "BOT_API_BASE_URL": f"{api_url}/bot",
+        "SUPABASE_URL": db_url,
+        "SUPABASE_KEY": "fake.fake.fake",
+        "PROVIDER_TOKEN": "fake",
+        "STATE_BACKEND": "memory",
+        "CATALOG_RELOAD_INTERVAL": "0",
+        "PROMO_SYNC_INTERVAL": "0",
+    })
+    for name in ("RATE_LIMIT_PER_SEC", "RATE_LIMIT_BURST", "BOT_API_RATE", "BOT_API_CHAT_RATE", "BOT_API_CHAT_BURST"):
+        os.environ.setdefault(name, "1000000")
+    os.environ.pop("WEBHOOK_URL", None)
+    os.environ.pop("SHARD_INDEX", None)
+
+
+class LoadTest:
+    def __init__(self, bot, app, fake: FakeTelegram, rng: random.Random, think: float):
+        from telegram import Update
+        self._update_cls = Update
+        self.bot = bot
+        self.app = app
+        self.fake = fake
+        self.rng = rng
+        self.think = think
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.latencies = {}  # вид обновления -> [секунды]
+        self.errors = 0
+        app.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+        logging.getLogger(__name__).warning(f"Исключение в обработчике: {context.error!r}")
+
+    # --- сборка обновлений ---
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, **fields) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }
+
+    def text(self, user_id: int, text: str) -> dict:
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": self._message(user_id, **fields)}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        bot_message = {
+            "message_id": user_id % 100000 + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": BOT_USER,
+            "text": "…",
+        }
+        return {"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": bot_message,
+        }}
+
+    def pre_checkout(self, user_id: int, invoice: dict) -> dict:
+        """invoice — параметры sendInvoice, запомненные заглушкой Bot API"""
+        return {"pre_checkout_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "currency": invoice["currency"],
+            "total_amount": invoice_amount(invoice),
+            "invoice_payload": invoice["payload"],
+        }}
+
+    def payment(self, user_id: int, invoice: dict, charge_id: str) -> dict:
+        return {"message": self._message(user_id, successful_payment={
+            "currency": invoice["currency"],
+            "total_amount": invoice_amount(invoice),
+            "invoice_payload": invoice["payload"],
+            "telegram_payment_charge_id": charge_id,
+            "provider_payment_charge_id": f"pr-{user_id}",
+        })}
+
+    async def send(self, kind: str, payload: dict):
+        update = self._update_cls.de_json({"update_id": next(self._update_ids), **payload}, self.app.bot)
+        started = time.perf_counter()
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        if self.think:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think))
+
+    # --- сценарии ---
+    def _product(self, category: str = None):
+        catalog = self.bot.CATALOG.current
+        if category is None:
+            category = self.rng.choice(catalog.categories)
+        products = catalog.in_category(category)
+        return category, self.rng.choice(products) if products else None
+
+    async def browse(self, user_id: int):
+        await self.send("start", self.text(user_id, "/start"))
+        for _ in range(self.rng.randint(1, 4)):
+            category, product = self._product()
+            await self.send("category", self.callback(user_id, f"cat_{category}"))
+            if product is not None:
+                await self.send("view", self.callback(user_id, f"view_{product.id}"))
+                await self.send("back", self.callback(user_id, f"back_cat_{category}"))
+        await self.send("back", self.callback(user_id, "back_categories"))
+
+    async def shop(self, user_id: int):
+        await self.send("start", self.text(user_id, "/start"))
+        for _ in range(self.rng.randint(1, 3)):
+            category, product = self._product()
+            await self.send("category", self.callback(user_id, f"cat_{category}"))
+            if product is None:
+                continue
+            await self.send("view", self.callback(user_id, f"view_{product.id}"))
+            await self.send("add", self.callback(user_id, f"add_{product.id}"))
+            # Быстрые нажатия «+» подряд
+            for _ in range(self.rng.randint(0, 4)):
+                await self.send("inc", self.callback(user_id, f"inc_{product.id}"))
+            if self.rng.random() < 0.3:
+                await self.send("dec", self.callback(user_id, f"dec_{product.id}"))
+        await self.send("cart", self.callback(user_id, "cart"))
+        if self.rng.random() < 0.3:
+            await self.send("promo", self.callback(user_id, "enter_promo"))
+            code = self.bot.PROMOS.issue() if self.rng.random() < 0.7 else "WRONG123"
+            await self.send("promo", self.text(user_id, code))
+        if self.rng.random() < 0.7:
+            await self.pay(user_id)
+
+    async def pay(self, user_id: int):
+        self.fake.invoices.pop(user_id, None)
+        await self.send("invoice", self.callback(user_id, "pay_rub"))
+        invoice = self.fake.invoices.pop(user_id, None)
+        if invoice is None:  # корзина пуста или изменилась — счёт не выставлен
+            return
+        await self.send("pre_checkout", self.pre_checkout(user_id, invoice))
+        await self.send("payment", self.payment(user_id, invoice, f"tg-{user_id}-{next(self._update_ids)}"))
+
+    def _free_cell(self, x: int, o: int):
+        free = [i for i in range(9) if not (x | o) & (1 << i)]
+        return self.rng.choice(free) if free else None
+
+    async def game(self, user_id: int):
+        await self.send("ttt_start", self.text(user_id, "/tictactoe"))
+        while True:
+            game = self.bot.games.get(user_id)
+            cell = self._free_cell(game["x"], game["o"]) if game else None
+            if cell is None:
+                return
+            await self.send("ttt_move", self.callback(user_id, f"move_{cell}"))
+
+    async def pvp(self, user_id: int):
+        opponent_id = user_id + PVP_OPPONENT_OFFSET
+        self.fake.texts.pop(user_id, None)
+        await self.send("pvp_create", self.callback(user_id, "ttt_vs_friend"))
+        match = INVITE_RE.search(self.fake.texts.get(user_id, ""))
+        if match is None:
+            return
+        game_id = match.group(1)
+        await self.send("pvp_join", self.text(opponent_id, f"/start ttt_{game_id}"))
+        while True:
+            game = self.bot.active_games.get(game_id)
+            cell = self._free_cell(game["x"], game["o"]) if game else None
+            if cell is None:
+                return
+            await self.send("pvp_move", self.callback(game["current_turn"], f"pmove_{game_id}{cell}"))
+
+    async def user(self, user_id: int, sessions: int, weights: list):
+        for _ in range(sessions):
+            scenario = self.rng.choices(SCENARIOS, weights)[0]
+            await getattr(self, scenario)(user_id)
+
+
+async def run(args) -> dict:
+    import bot
+    from server import running
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    app = bot.build_application()
+    fake = args.fake_telegram
+    test = LoadTest(bot, app, fake, random.Random(args.seed), args.think)
+    async with running(app):
+        fake.reset()
+        weights = [args.shop, args.browse, args.game, args.pvp]
+        started = time.perf_counter()
+        await asyncio.gather(*(test.user(100000 + i, args.sessions, weights) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    return {"test": test, "elapsed": elapsed, "api_calls": fake.stats()["total"]}
+
+
+def report(result: dict, db: FakeSupabase):
+    test, elapsed = result["test"], result["elapsed"]
+    everything = [value for values in test.latencies.values() for value in values]
+    print(f"{'вид':>14} {'число':>8} {'p50, мс':>9} {'p99, мс':>9}")
+    for kind in sorted(test.latencies):
+        values = test.latencies[kind]
+        print(f"{kind:>14} {len(values):8} {percentile(values, 0.5) * 1000:9.1f} {percentile(values, 0.99) * 1000:9.1f}")
+    print(f"{'всего':>14} {len(everything):8} {percentile(everything, 0.5) * 1000:9.1f} "
+          f"{percentile(everything, 0.99) * 1000:9.1f}")
+    print(f"\n{len(everything) / elapsed:.0f} обновлений/с за {elapsed:.2f} с; "
+          f"вызовов Bot API {result['api_calls']}, запросов к Supabase {db.requests}, исключений {test.errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sessions", type=int, default=3, help="сценариев на пользователя")
+    parser.add_argument("--shop", type=float, default=0.5, help="доля сценария shop")
+    parser.add_argument("--browse", type=float, default=0.3)
+    parser.add_argument("--game", type=float, default=0.15)
+    parser.add_argument("--pvp", type=float, default=0.05)
+    parser.add_argument("--think", type=float, default=0.0, help="средняя пауза между действиями, с")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка заглушки Bot API, с")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="задержка заглушки Supabase, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    args.fake_telegram = FakeTelegram(latency=args.api_latency)
+    api_server, api_url = args.fake_telegram.serve()
+    db = FakeSupabase(latency=args.db_latency)
+    db_server, db_url = db.serve()
+    configure_env(api_url, db_url)
+    try:
+        report(asyncio.run(run(args)), db)
+    finally:
+        api_server.shutdown()
+        db_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
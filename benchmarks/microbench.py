@@ -0,0 +1,246 @@
+"""
+Микробенчмарки чистых функций горячего пути — без сети и токенов.
+
+Каталог синтетический, от 3 до 50 000 товаров, корзины — от 1 до 50
+позиций. Каждый случай прогоняется через timeit (число повторов
+подбирается само), в результат идёт лучшее из --repeat время одного
+вызова в наносекундах.
+
+  python -m benchmarks.microbench run --output benchmarks/baseline.json
+  python -m benchmarks.microbench run --filter cart --catalog-sizes 3 50000
+  python -m benchmarks.microbench compare benchmarks/baseline.json new.json --threshold 0.15
+
+compare завершается с кодом 1, если хоть один случай стал медленнее больше чем на threshold.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+import timeit
+
+# bot.py читает настройки при импорте: состояние — в памяти, без файлов и сети
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("QUOTA_PERSIST", "0")
+os.environ.pop("SUPABASE_URL", None)
+
+import bot  # noqa: E402
+import ttt_engine  # noqa: E402
+from catalog import Catalog, Product  # noqa: E402
+from promos import PromoStore  # noqa: E402
+from quotas import SlidingWindowQuota  # noqa: E402
+
+CATEGORIES = ("clothing", "shoes", "accessories")
+CALLBACKS = (
+    "cart", "pay_rub", "enter_promo", "back_categories", "ttt_vs_bot", "cat_clothing", "back_cat_shoes",
+    "view_17", "add_17", "inc_3", "dec_3", "del_3", "move_4", "pmove_abcd12343", "view_17x", "bogus",
+)
+
+
+def make_catalog(size: int) -> Catalog:
+    return Catalog(
+        Product(id=i, name=f"Товар {i}", category=CATEGORIES[i % len(CATEGORIES)], price_rub=100 + i % 9000,
+                description="Описание товара", photo_url=f"https://example.com/{i}.jpg")
+        for i in range(1, size + 1)
+    )
+
+
+def make_cart(catalog: Catalog, size: int, rng: random.Random) -> dict:
+    ids = rng.sample(range(1, len(catalog) + 1), min(size, len(catalog)))
+    return {pid: rng.randint(1, 5) for pid in ids}
+
+
+class FakeUsedPromos:
+    """Ответы supabase.table("used_promos").select(...).gt(...).order(...).limit(...).execute() из памяти"""
+
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def table(self, name):
+        return _Query(self.rows)
+
+
+class _Query:
+    def __init__(self, rows):
+        self._rows = rows
+        self._after = 0
+        self._limit = len(rows)
+
+    def select(self, *args):
+        return self
+
+    def order(self, *args):
+        return self
+
+    def gt(self, column, value):
+        self._after = value
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def execute(self):
+        # id строк — 1..N подряд, поэтому «id > after» — это срез
+        return type("Response", (), {"data": self._rows[self._after:self._after + self._limit]})()
+
+
+def cases(catalog_sizes: list, cart_sizes: list, seed: int):
+    """(имя, функция без аргументов) — по одному вызову на замер"""
+    rng = random.Random(seed)
+
+    for size in catalog_sizes:
+        catalog = make_catalog(size)
+        ids = [rng.randint(1, size) for _ in range(1024)]
+        lookup_ids = itertools.cycle(ids)
+        yield f"catalog_lookup[catalog={size}]", lambda catalog=catalog, it=lookup_ids: catalog.get(next(it))
+        yield f"catalog_in_category[catalog={size}]", lambda catalog=catalog: catalog.in_category("shoes")
+        if size <= 10000:  # 50k пересобирается сотни миллисекунд — хватит и меньших размеров для тренда
+            raw = list(catalog.products)
+            yield f"catalog_build[catalog={size}]", lambda raw=raw: Catalog(raw)
+        yield f"build_categories[catalog={size}]", lambda catalog=catalog: bot.KEYBOARDS.build_categories(catalog)
+
+        for cart_size in cart_sizes:
+            if cart_size > size:
+                continue
+            cart = make_cart(catalog, cart_size, rng)
+            user_id = size * 1000 + cart_size
+            bot.user_carts.put(user_id, cart)
+            params = f"catalog={size},cart={cart_size}"
+
+            def total(catalog=catalog, user_id=user_id):
+                bot.CATALOG.current = catalog
+                return bot.calculate_cart_total(user_id)
+            yield f"calculate_cart_total[{params}]", total
+            yield f"render_cart[{params}]", lambda cart=cart, catalog=catalog: bot.render_cart(cart, catalog, None, 0)
+            yield (f"render_cart_summary[{params}]",
+                   lambda cart=cart, catalog=catalog: bot.render_cart_summary(cart, catalog, None, 0))
+            yield f"prune_cart[{params}]", lambda catalog=catalog, user_id=user_id: bot.prune_cart(user_id, catalog)
+
+    yield "category_menu", bot.category_menu
+    boards = [(rng.getrandbits(9) & 0b101010101, rng.getrandbits(9) & 0b010101010) for _ in range(64)]
+    board_iter = itertools.cycle(boards)
+    yield "get_game_keyboard", lambda it=board_iter: bot.get_game_keyboard(*next(it))
+    pvp_iter = itertools.cycle(boards)
+    yield "get_game_keyboard[pvp]", lambda it=pvp_iter: bot.get_game_keyboard(*next(it), "abcd1234")
+
+    positions = []
+    for _ in range(256):
+        x = o = 0
+        for turn in range(rng.randint(1, 7)):
+            cell = rng.choice(ttt_engine.free_cells(x, o))
+            if turn % 2:
+                o |= 1 << cell
+            else:
+                x |= 1 << cell
+        if ttt_engine.winner(x, o) is None and not ttt_engine.is_full(x, o):
+            positions.append((x, o))
+    position_iter = itertools.cycle(positions)
+    yield "ttt_winner", lambda it=position_iter: ttt_engine.winner(*next(it))
+    yield "ttt_is_full", lambda it=position_iter: ttt_engine.is_full(*next(it))
+    yield "ttt_bot_move", lambda it=position_iter: ttt_engine.bot_move(*next(it), play_to_win=True)
+
+    # Длинная история: событий записано много больше лимита, пользователей — до 100 000
+    for users in (10, 100000):
+        clock = itertools.count().__next__
+        quota = SlidingWindowQuota(limit=bot.MAX_GAMES_PER_DAY, window=10 ** 6, max_users=users, clock=clock)
+        for user in range(users):
+            for _ in range(3 if users > 10 else 1000):
+                quota.record(user)
+        user_iter = itertools.cycle(range(users))
+        yield f"check_game_limits[users={users}]", lambda quota=quota, it=user_iter: quota.allowed(next(it))
+
+    issuer = PromoStore(b"microbench")
+    issuer.rng = rng
+    codes = [issuer.issue() for _ in range(10000)]
+    code_iter = itertools.cycle(codes)
+    yield "promo_is_valid", lambda it=code_iter: issuer.is_valid(next(it))
+    for rows_count in (100, 10000):
+        rows = [{"id": i + 1, "code": codes[i % len(codes)]} for i in range(rows_count)]
+
+        def sync(rows=rows):
+            store = PromoStore(b"microbench", FakeUsedPromos(rows))
+            return store.sync()
+        yield f"promo_sync[rows={rows_count}]", sync
+
+    route_iter = itertools.cycle(CALLBACKS)
+    yield "callback_route", lambda it=route_iter: bot.ROUTER.route(next(it))
+
+
+def measure(func, repeat: int) -> float:
+    """Лучшее время одного вызова, нс"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def command_run(args):
+    results = {}
+    for name, func in cases(args.catalog_sizes, args.cart_sizes, args.seed):
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func, args.repeat)
+        print(f"{name:<56} {results[name]:>14,.0f} нс")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                },
+                "results_ns": results,
+            }, f, ensure_ascii=False, indent=2)
+
+
+def command_compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)["results_ns"]
+    with open(args.head, encoding="utf-8") as f:
+        head = json.load(f)["results_ns"]
+
+    slower = 0
+    for name in sorted(set(base) & set(head)):
+        change = head[name] / base[name] - 1
+        mark = ""
+        if change > args.threshold:
+            mark = "  МЕДЛЕННЕЕ"
+            slower += 1
+        elif change < -args.threshold:
+            mark = "  быстрее"
+        print(f"{name:<56} {base[name]:>12,.0f} {head[name]:>12,.0f} {change:+8.1%}{mark}")
+    for name in sorted(set(base) ^ set(head)):
+        print(f"{name:<56} есть только в {'base' if name in base else 'head'}")
+    if slower:
+        print(f"\nМедленнее больше чем на {args.threshold:.0%}: {slower}")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="замерить и (по желанию) сохранить результаты")
+    run_parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[3, 100, 1000, 10000, 50000])
+    run_parser.add_argument("--cart-sizes", type=int, nargs="+", default=[1, 10, 50])
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--filter", help="только случаи, в имени которых есть подстрока")
+    run_parser.add_argument("--output", help="JSON с результатами — базовая линия для compare")
+    run_parser.set_defaults(handler=command_run)
+
+    compare_parser = commands.add_parser("compare", help="сравнить результаты с базовой линией")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="допустимое замедление, доля")
+    compare_parser.set_defaults(handler=command_compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Повторный прогон записанного трафика (UPDATE_JOURNAL_PATH) и сравнение двух сборок.
+
+run — проигрывает журнал через настоящие обработчики бота в этом же
+процессе против заглушек Bot API и Supabase (как benchmarks.loadtest)
+в реальном темпе (--speed 1), ускоренно (--speed 10) или без пауз
+(--speed 0). Обновления одного пользователя идут строго друг за другом,
+разных — параллельно. random засевается --seed, так что промокоды
+и ходы бота повторяются от прогона к прогону.
+
+Счета и партии вдвоём в новом прогоне получают новые id; payload
+счёта заменяется на выставленный в этом прогоне тому же пользователю,
+id партии — на созданные по порядку. При --speed 0 вход в партию может
+обогнать её создание — такие входы получат «Игра не найдена».
+
+compare — задержки по видам обновлений и число вызовов Bot API двух прогонов рядом.
+
+  git worktree add ../shop-base main
+  (cd ../shop-base && python -m benchmarks.replay run updates.jsonl.gz --output base.json)
+  python -m benchmarks.replay run updates.jsonl.gz --output head.json
+  python -m benchmarks.replay compare ../shop-base/base.json head.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+
+from benchmarks.loadtest import INVITE_RE, configure_env, invoice_amount, percentile
+from devtools.fake_supabase import FakeSupabase
+from devtools.fake_telegram import FakeTelegram
+from recorder import read_journal
+
+
+def update_kind(data: dict) -> str:
+    query = data.get("callback_query")
+    if query:
+        value = query.get("data", "")
+        return value.split("_", 1)[0] + "_" if "_" in value and value[-1].isdigit() else value
+    if "pre_checkout_query" in data:
+        return "pre_checkout"
+    message = data.get("message") or {}
+    if "successful_payment" in message:
+        return "payment"
+    text = message.get("text", "")
+    if text.startswith("/"):
+        return text.split()[0]
+    return "text" if text else next((key for key in data if key != "update_id"), "other")
+
+
+def user_of(data: dict):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return None
+
+
+class Replay:
+    def __init__(self, bot, app, fake: FakeTelegram):
+        from telegram import Update
+        self._update_cls = Update
+        self.bot = bot
+        self.app = app
+        self.fake = fake
+        self.latencies = {}
+        self.errors = 0
+        self._invoices = {}    # user_id -> (payload, total_amount) последнего счёта этого прогона
+        self._payloads = {}    # payload из журнала -> (payload, total_amount) этого прогона
+        self._new_games = deque()
+        self._games = {}       # id партии из журнала -> id партии этого прогона
+        app.add_error_handler(self.on_error)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+
+    def _game(self, recorded: str) -> str:
+        if recorded not in self._games and self._new_games:
+            self._games[recorded] = self._new_games.popleft()
+        return self._games.get(recorded, recorded)
+
+    def _rewrite(self, data: dict, user_id) -> dict:
+        """Подставляет id счетов и партий этого прогона вместо записанных"""
+        data = json.loads(json.dumps(data))
+        payment = data.get("pre_checkout_query") or (data.get("message") or {}).get("successful_payment")
+        if payment and "invoice_payload" in payment:
+            recorded = payment["invoice_payload"]
+            if recorded not in self._payloads and user_id in self._invoices:
+                self._payloads[recorded] = self._invoices.pop(user_id)
+            if recorded in self._payloads:
+                payment["invoice_payload"], payment["total_amount"] = self._payloads[recorded]
+        query = data.get("callback_query")
+        if query and query.get("data", "").startswith("pmove_"):
+            query["data"] = f"pmove_{self._game(query['data'][6:14])}{query['data'][14:]}"
+        message = data.get("message")
+        if message and message.get("text", "").startswith("/start ttt_"):
+            message["text"] = f"/start ttt_{self._game(message['text'][11:19])}"
+        return data
+
+    def _observe_outgoing(self, kind: str, user_id):
+        """Запоминает счета и приглашения, которые бот только что отправил этому пользователю"""
+        if kind == "pay_rub":
+            invoice = self.fake.invoices.pop(user_id, None)
+            if invoice is not None:
+                amount = invoice_amount(invoice)
+                self._invoices[user_id] = (invoice["payload"], amount)
+        elif kind == "ttt_vs_friend":
+            match = INVITE_RE.search(self.fake.texts.get(user_id, ""))
+            if match:
+                self._new_games.append(match.group(1))
+
+    async def user(self, entries: list, started: float, t0: float, speed: float):
+        for entry in entries:
+            if speed:
+                delay = started + (entry["t"] - t0) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            data = entry["update"]
+            user_id = user_of(data)
+            kind = update_kind(data)
+            update = self._update_cls.de_json(self._rewrite(data, user_id), self.app.bot)
+            sent = time.perf_counter()
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+            self.latencies.setdefault(kind, []).append(time.perf_counter() - sent)
+            self._observe_outgoing(kind, user_id)
+
+
+async def run(args, fake: FakeTelegram, entries: list) -> dict:
+    import bot
+    from server import running
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    random.seed(args.seed)  # Ходы бота в крестики-нолики
+    bot.PROMOS.rng = random.Random(args.seed)  # generate_promo
+    app = bot.build_application()
+    replay = Replay(bot, app, fake)
+
+    users = {}
+    for entry in entries:
+        users.setdefault(user_of(entry["update"]), []).append(entry)
+    async with running(app):
+        fake.reset()
+        started = time.perf_counter()
+        t0 = entries[0]["t"]
+        await asyncio.gather(*(replay.user(items, started, t0, args.speed) for items in users.values()))
+        elapsed = time.perf_counter() - started
+    return {"replay": replay, "elapsed": elapsed}
+
+
+def summarize(values: list) -> dict:
+    return {"count": len(values), "p50_ms": percentile(values, 0.5) * 1000, "p99_ms": percentile(values, 0.99) * 1000}
+
+
+def command_run(args):
+    entries = read_journal(*args.journal)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit("Журнал пуст")
+
+    fake = FakeTelegram(latency=args.api_latency)
+    api_server, api_url = fake.serve()
+    db = FakeSupabase(latency=args.db_latency)
+    db_server, db_url = db.serve()
+    configure_env(api_url, db_url)
+    try:
+        result = asyncio.run(run(args, fake, entries))
+    finally:
+        api_server.shutdown()
+        db_server.shutdown()
+
+    replay = result["replay"]
+    everything = [value for values in replay.latencies.values() for value in values]
+    calls = fake.stats()["calls"]
+    summary = {
+        "updates": len(everything),
+        "elapsed_s": result["elapsed"],
+        "updates_per_sec": len(everything) / result["elapsed"],
+        "speed": args.speed,
+        "latency": {kind: summarize(values) for kind, values in sorted(replay.latencies.items())},
+        "latency_all": summarize(everything),
+        "api_calls": dict(sorted(calls.items())),
+        "api_calls_total": sum(calls.values()),
+        "supabase_requests": db.requests,
+        "errors": replay.errors,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"{summary['updates']} обновлений за {summary['elapsed_s']:.2f} с ({summary['updates_per_sec']:.0f}/с), "
+          f"p50 {summary['latency_all']['p50_ms']:.1f} мс, p99 {summary['latency_all']['p99_ms']:.1f} мс, "
+          f"вызовов Bot API {summary['api_calls_total']}, исключений {summary['errors']}")
+
+
+def _delta(old: float, new: float) -> str:
+    if not old:
+        return "—"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def command_compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.head, encoding="utf-8") as f:
+        head = json.load(f)
+
+    print(f"{'вид':>16} {'число':>7} {'p50 A':>8} {'p50 B':>8} {'Δ':>6} {'p99 A':>8} {'p99 B':>8} {'Δ':>6}")
+    rows = [(kind, base["latency"].get(kind), head["latency"].get(kind))
+            for kind in sorted(set(base["latency"]) | set(head["latency"]))]
+    rows.append(("всего", base["latency_all"], head["latency_all"]))
+    empty = {"count": 0, "p50_ms": 0.0, "p99_ms": 0.0}
+    for kind, a, b in rows:
+        a, b = a or empty, b or empty
+        print(f"{kind[:16]:>16} {b['count']:7} {a['p50_ms']:8.1f} {b['p50_ms']:8.1f} {_delta(a['p50_ms'], b['p50_ms']):>6} "
+              f"{a['p99_ms']:8.1f} {b['p99_ms']:8.1f} {_delta(a['p99_ms'], b['p99_ms']):>6}")
+
+    print(f"\n{'метод Bot API':>24} {'A':>8} {'B':>8} {'Δ':>6}")
+    for method in sorted(set(base["api_calls"]) | set(head["api_calls"])):
+        a, b = base["api_calls"].get(method, 0), head["api_calls"].get(method, 0)
+        print(f"{method:>24} {a:8} {b:8} {_delta(a, b):>6}")
+    print(f"{'всего':>24} {base['api_calls_total']:8} {head['api_calls_total']:8} "
+          f"{_delta(base['api_calls_total'], head['api_calls_total']):>6}")
+    print(f"\nобновлений/с: {base['updates_per_sec']:.0f} → {head['updates_per_sec']:.0f}; "
+          f"запросов к Supabase: {base['supabase_requests']} → {head['supabase_requests']}; "
+          f"исключений: {base['errors']} → {head['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="проиграть журнал")
+    run_parser.add_argument("journal", nargs="+", help="один или несколько журналов (по процессам)")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="1 — реальный темп, N — в N раз быстрее, 0 — без пауз")
+    run_parser.add_argument("--limit", type=int, default=0, help="только первые N обновлений")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--api-latency", type=float, default=0.05, help="задержка заглушки Bot API, с")
+    run_parser.add_argument("--db-latency", type=float, default=0.02, help="задержка заглушки Supabase, с")
+    run_parser.add_argument("--output", help="сохранить сводку в JSON для compare")
+    run_parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    run_parser.set_defaults(handler=command_run)
+
+    compare_parser = commands.add_parser("compare", help="сравнить два прогона")
+    compare_parser.add_argument("base", help="JSON прогона A (прежняя сборка)")
+    compare_parser.add_argument("head", help="JSON прогона B (новая сборка)")
+    compare_parser.set_defaults(handler=command_compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
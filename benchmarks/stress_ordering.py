@@ -0,0 +1,146 @@
+"""
+Стресс-проверка порядка обработки: настоящие обработчики бота под конкурентной нагрузкой.
+
+Бот работает через Application против заглушек devtools.fake_telegram и
+devtools.fake_supabase (как benchmarks.loadtest). Каждый пользователь
+присылает пачку обновлений одновременно, не дожидаясь ответов:
+
+  1. enter_promo, промокод текстом, add_ и inc_ товара, pay_rub
+  2. pre_checkout_query, successful_payment и его повтор, add_ после оплаты
+
+Пачки прогоняются дважды: через обычный параллельный обработчик
+(SimpleUpdateProcessor) и через bot.UPDATES (KeyedUpdateProcessor).
+Проверяется, что счёт включает все товары и скидку по промокоду,
+заказ записан в Supabase ровно один раз, промокод погашен один раз,
+а в корзине остался только товар, добавленный после оплаты.
+Без замков по пользователю промокод и часть нажатий обгоняют друг друга,
+с замками всё должно сойтись точно. Код завершения 1 — расхождение при замках.
+
+  python -m benchmarks.stress_ordering --users 200 --adds 5 --incs 5
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import random
+import sys
+
+from benchmarks.loadtest import LoadTest, configure_env, invoice_amount
+from devtools.fake_supabase import FakeSupabase
+from devtools.fake_telegram import FakeTelegram
+
+
+class Stress(LoadTest):
+    def __init__(self, bot, app, fake: FakeTelegram, db: FakeSupabase, rng: random.Random):
+        super().__init__(bot, app, fake, rng, think=0.0)
+        self.db = db
+        self._charge_ids = itertools.count(1)
+
+    async def burst(self, processor, payloads: list):
+        """Все обновления пачки передаются обработчику сразу, как при быстрых нажатиях"""
+        updates = [self._update_cls.de_json({"update_id": next(self._update_ids), **payload}, self.app.bot)
+                   for payload in payloads]
+        await asyncio.gather(*(processor.process_update(update, self.app.process_update(update)) for update in updates))
+
+    async def scenario(self, processor, user_id: int, product, adds: int, incs: int) -> list:
+        """Сценарий одного пользователя; возвращает список найденных расхождений"""
+        problems = []
+        code = self.bot.PROMOS.issue()
+        self.fake.invoices.pop(user_id, None)
+        await self.burst(processor, [
+            self.callback(user_id, "enter_promo"),
+            self.text(user_id, code),
+            *(self.callback(user_id, f"add_{product.id}") for _ in range(adds)),
+            *(self.callback(user_id, f"inc_{product.id}") for _ in range(incs)),
+            self.callback(user_id, "pay_rub"),
+        ])
+        invoice = self.fake.invoices.pop(user_id, None)
+        expected = max(product.price_rub * (adds + incs) - 200, 0) * 100
+        if invoice is None:
+            return ["счёт не выставлен"]
+        if invoice_amount(invoice) != expected:
+            problems.append(f"сумма счёта {invoice_amount(invoice)}, ожидалось {expected}")
+
+        charge_id = f"tg-stress-{next(self._charge_ids)}"
+        await self.burst(processor, [
+            self.pre_checkout(user_id, invoice),
+            self.payment(user_id, invoice, charge_id),
+            self.payment(user_id, invoice, charge_id),  # Повтор платежа, например после таймаута вебхука
+            self.callback(user_id, f"add_{product.id}"),
+        ])
+        cart = self.bot.get_cart(user_id)
+        if cart != {product.id: 1}:
+            problems.append(f"корзина после оплаты {cart}, ожидалось {{{product.id}: 1}}")
+        return problems
+
+    def stored(self, table: str, column: str, value) -> int:
+        return sum(1 for row in self.db.tables.get(table, []) if row.get(column) == value)
+
+
+async def run(args, fake: FakeTelegram, db: FakeSupabase) -> int:
+    import bot
+    from server import running
+    from telegram.ext import SimpleUpdateProcessor
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.CRITICAL)
+    app = bot.build_application()
+    stress = Stress(bot, app, fake, db, random.Random(args.seed))
+    adds, incs = args.adds, args.incs
+    if adds + incs > bot.MAX_TOTAL_ITEMS:
+        raise SystemExit(f"--adds + --incs не больше {bot.MAX_TOTAL_ITEMS}: больше корзина не вмещает")
+
+    failed = 0
+    async with running(app):
+        # Дороже скидки по промокоду, иначе сумма счёта не зависит от числа товаров
+        products = [p for p in bot.CATALOG.current.products if p.price_rub > 200]
+        modes = (("без замков", SimpleUpdateProcessor(args.concurrency)), ("по ключам", bot.UPDATES))
+        for offset, (mode, processor) in enumerate(modes):
+            # Свои пользователи в каждом прогоне: состояние бота общее
+            users = [(offset + 1) * 10 ** 6 + i for i in range(args.users)]
+            orders_before = len(db.tables.get("orders", []))
+            results = await asyncio.gather(*(
+                stress.scenario(processor, user_id, stress.rng.choice(products), adds, incs) for user_id in users
+            ))
+            bad = [(user_id, problems) for user_id, problems in zip(users, results) if problems]
+            await bot.SUPABASE_WRITES.close()  # Заказы пишутся в фоне — дожидаемся записи
+            orders = len(db.tables.get("orders", [])) - orders_before
+            promos = sum(stress.stored("used_promos", "used_by", user_id) for user_id in users)
+            print(f"{mode:>10}: пользователей с расхождениями {len(bad)}/{args.users}, "
+                  f"заказов {orders}, погашено промокодов {promos}, исключений {stress.errors}")
+            for user_id, problems in bad[:args.show]:
+                print(f"{'':>12}{user_id}: {'; '.join(problems)}")
+            if processor is bot.UPDATES:
+                failed += len(bad) + (orders != args.users) + (promos != args.users) + stress.errors
+            stress.errors = 0
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--adds", type=int, default=5, help="нажатий «В корзину» в пачке")
+    parser.add_argument("--incs", type=int, default=5, help="нажатий «+» в пачке")
+    parser.add_argument("--concurrency", type=int, default=256, help="параллельность прогона без замков")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="задержка заглушки Bot API, с")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="задержка заглушки Supabase, с")
+    parser.add_argument("--show", type=int, default=5, help="сколько расхождений показать")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.api_latency)
+    api_server, api_url = fake.serve()
+    db = FakeSupabase(latency=args.db_latency)
+    db_server, db_url = db.serve()
+    configure_env(api_url, db_url)
+    try:
+        failed = asyncio.run(run(args, fake, db))
+    finally:
+        api_server.shutdown()
+        db_server.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
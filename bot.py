@@ -1,155 +1,287 @@
-import json
+import asyncio
+import itertools
 import os
 import logging
-import random
 import re
 import uuid
+import httpx
+import ttt_engine
+from catalog import CatalogStore
+from keyboards import KeyboardCache, parse_category_page
+from metrics import MetricsRegistry
+from photos import PhotoCache
+from promos import PromoStore
+from quotas import SlidingWindowQuota
+from persistence import WriteBehindQueue
+from ratelimit import TokenBucketLimiter
+from recorder import UpdateRecorder
+from router import CallbackRouter
+from dedup import UpdateDeduplicator
+from invoices import InvoiceStore
+from ttl import TTLCache
+from views import MessageTracker, RenderMemo
+from ordering import KeyedUpdateProcessor
+from ingest import IngestQueue, LANE_DEFAULT, LANE_GAME, LANE_PAYMENT
+from server import QUOTA_PATH, SECRET_HEADER, ReadinessChecks, serve, serve_worker, webhook_secret
+from sharding import HashRing, game_key, user_key
+from storage import create_backend, flush_periodically, sweep_periodically
+from throttle import PriorityRateLimiter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, InputMediaPhoto
 from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     MessageHandler,
     PreCheckoutQueryHandler,
+    TypeHandler,
     filters
 )
 
+# === Метрики ===
+# Задержки обработчиков, Bot API и Supabase; отдаются в /metrics вместе с collect_stats
+METRICS = MetricsRegistry()
+
 # === Supabase ===
 from supabase import create_client
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY) if SUPABASE_URL else None
+# Запись в Supabase идёт в фоне, чтобы не блокировать цикл событий
+SUPABASE_WRITES = WriteBehindQueue(
+    supabase,
+    journal_path=os.getenv("SUPABASE_JOURNAL_PATH", "supabase_journal.jsonl"),
+    max_size=int(os.getenv("SUPABASE_QUEUE_SIZE", "10000")),
+    # Уникальные колонки: по ним повтор записи не задваивает строку
+    keys={"customers": "id", "orders": "telegram_payment_charge_id", "used_promos": "code"},
+    metrics=METRICS,
+)
 
 # === Настройки ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 PROVIDER_TOKEN = os.getenv("PROVIDER_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()  # Убираем пробелы
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Telegram присылает секрет в заголовке каждого запроса; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or webhook_secret(BOT_TOKEN)
 MAX_GAMES_PER_DAY = 10
 MAX_PROMOS_PER_DAY = 2
 MIN_GAMES_TO_LOSE = 5  # Бот проигрывает после 5 игр
+# Адрес Bot API (для локальной заглушки devtools.fake_telegram)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").strip()
+# Шардирование: процесс SHARD_INDEX из SHARD_COUNT, задаются фронтом (python -m sharding)
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_PORT = int(os.getenv("SHARD_PORT", "0"))
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", "0"))  # процесс i слушает 127.0.0.1:SHARD_BASE_PORT+i
+SHARD_RING = HashRing(SHARD_COUNT) if SHARD_COUNT > 1 else None
+# Исходящие запросы к Bot API: общий лимит бота и лимит на один чат
+BOT_API_RATE = float(os.getenv("BOT_API_RATE", "30"))
+BOT_API_CHAT_RATE = float(os.getenv("BOT_API_CHAT_RATE", "1"))
+BOT_API_CHAT_BURST = int(os.getenv("BOT_API_CHAT_BURST", "5"))
+# Ключ подписи промокодов. Без PROMO_SECRET подписывается токеном бота —
+# смена BOT_TOKEN сделает недействительными все выданные коды
+PROMO_SECRET = os.getenv("PROMO_SECRET") or BOT_TOKEN or ""
+PROMO_SYNC_INTERVAL = float(os.getenv("PROMO_SYNC_INTERVAL", "60"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+if not os.getenv("PROMO_SECRET"):
+    logger.warning("PROMO_SECRET не задан: промокоды подписаны токеном бота и перестанут действовать при его смене")
 
 # === Хранение данных ===
-from collections import defaultdict
-import time
-# ... существующие переменные ...
-user_carts = {}
-active_promocodes = set()  # Множество активных промокодов
-user_game_stats = defaultdict(lambda: {"games": [], "promos": 0})
-games = {}  # Для крестиков-ноликов
-active_games = {}      # Игры между двумя игроками
-pending_invites = {}   # Ожидающие приглашения
+# STATE_BACKEND: sqlite (переживает перезапуск) или memory
+STATE = create_backend(os.getenv("STATE_BACKEND", "sqlite"), os.getenv("STATE_DB_PATH", "state.db"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "0.5"))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "60"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))  # На каждое пространство имён
+CART_TTL = float(os.getenv("CART_TTL", str(7 * 86400)))  # Брошенные корзины живут неделю
+GAME_TTL = float(os.getenv("GAME_TTL", "3600"))          # Брошенные партии — час
+INVITE_TTL = float(os.getenv("INVITE_TTL", "86400"))     # Неиспользованные приглашения — сутки
+PAYMENT_TTL = float(os.getenv("PAYMENT_TTL", str(90 * 86400)))  # Ключи идемпотентности платежей — 90 дней
+INVOICE_TTL = float(os.getenv("INVOICE_TTL", "86400"))   # Неоплаченные счета — сутки
+
+user_carts = STATE.namespace("carts", ttl=CART_TTL, max_entries=STATE_MAX_ENTRIES)
+# Версии корзин и готовые тексты корзин — только в памяти
+CART_VERSIONS = TTLCache(ttl=CART_TTL, max_entries=STATE_MAX_ENTRIES)
+_cart_version_seq = itertools.count(1)
+CART_VIEWS = RenderMemo()
+# Что последним показано в каждом сообщении — чтобы не отправлять правки без изменений
+MESSAGES = MessageTracker()
+# Выданные и погашенные промокоды; погашенные переживают перезапуск и без Supabase
+PROMOS = PromoStore(
+    PROMO_SECRET.encode(),
+    supabase,
+    metrics=METRICS,
+    writes=SUPABASE_WRITES,
+    store=STATE.namespace("redeemed_promos"),
+)
+# Лимиты игр и промокодов — скользящее окно в сутки; QUOTA_PERSIST=0 — только в памяти
+QUOTA_PERSIST = os.getenv("QUOTA_PERSIST", "1") == "1"
+GAME_QUOTA = SlidingWindowQuota(
+    MAX_GAMES_PER_DAY,
+    max_users=STATE_MAX_ENTRIES,
+    store=STATE.namespace("game_quota", ttl=86400, max_entries=STATE_MAX_ENTRIES) if QUOTA_PERSIST else None,
+)
+PROMO_QUOTA = SlidingWindowQuota(
+    MAX_PROMOS_PER_DAY,
+    max_users=STATE_MAX_ENTRIES,
+    store=STATE.namespace("promo_quota", ttl=86400, max_entries=STATE_MAX_ENTRIES) if QUOTA_PERSIST else None,
+)
+games = STATE.namespace("games", ttl=GAME_TTL, max_entries=STATE_MAX_ENTRIES)                  # Для крестиков-ноликов
+active_games = STATE.namespace("active_games", ttl=GAME_TTL, max_entries=STATE_MAX_ENTRIES)    # Игры между двумя игроками
+pending_invites = STATE.namespace("pending_invites", ttl=INVITE_TTL, max_entries=STATE_MAX_ENTRIES)  # Ожидающие приглашения
+player_games = STATE.namespace("player_games", ttl=GAME_TTL, max_entries=STATE_MAX_ENTRIES)    # user_id -> id партии вдвоём
+INVOICES = InvoiceStore(STATE.namespace("invoices", ttl=INVOICE_TTL, max_entries=STATE_MAX_ENTRIES))  # Снимки выставленных счетов
+processed_payments = STATE.namespace("processed_payments", ttl=PAYMENT_TTL)  # telegram_payment_charge_id -> user_id
+# === Повторные доставки ===
+# Telegram повторяет обновление, если не дождался ответа на вебхук
+DEDUP = UpdateDeduplicator(int(os.getenv("DEDUP_WINDOW", "4096")))
 # === Защита от спама ===
-user_last_action = defaultdict(float)
+# В среднем RATE_LIMIT_PER_SEC действий в секунду, серией — до RATE_LIMIT_BURST.
+# Не выше BOT_API_CHAT_RATE: почти каждое действие — правка сообщения в чате пользователя,
+# и более быстрый вход копил бы очередь исходящих запросов этого чата
+RATE_LIMITER = TokenBucketLimiter(
+    rate=float(os.getenv("RATE_LIMIT_PER_SEC", "1")),
+    burst=int(os.getenv("RATE_LIMIT_BURST", "5")),
+    max_keys=STATE_MAX_ENTRIES,
+)
+
+def get_cart(user_id: int) -> dict:
+    """Корзина {id товара: количество}. Это копия — после изменения вызовите save_cart"""
+    # В SQLite ключи словаря хранятся строками, приводим обратно к int
+    return {int(pid): qty for pid, qty in (user_carts.get(user_id) or {}).items()}
+
+def save_cart(user_id: int, cart: dict):
+    if cart:
+        user_carts.put(user_id, cart)
+    else:
+        user_carts.delete(user_id)
+    CART_VERSIONS[user_id] = next(_cart_version_seq)
+
+def cart_version(user_id: int) -> int:
+    """Меняется при каждом save_cart; номера не повторяются, поэтому годятся как ключ кэша"""
+    version = CART_VERSIONS.get(user_id)
+    if version is None:
+        version = CART_VERSIONS[user_id] = next(_cart_version_seq)
+    return version
+
+def cart_view(user_id: int, cart: dict, catalog, promo, removed: int, summary: bool = False):
+    """(text, markup) корзины из кэша: пересчёт только при изменении корзины, промокода или каталога"""
+    key = (summary, cart_version(user_id), promo, PROMOS.is_valid(promo), CATALOG.version, bool(removed))
+    render = render_cart_summary if summary else render_cart
+    return CART_VIEWS.get_or_build(key, lambda: render(cart, catalog, promo, removed))
+
+def record_game(user_id: int, promo_issued: bool = False):
+    """Записывает сыгранную игру (и выданный промокод) в лимиты пользователя"""
+    GAME_QUOTA.record(user_id)
+    if promo_issued:
+        PROMO_QUOTA.record(user_id)
 
 # === Загрузка товаров ===
-try:
-    with open("products.json", "r", encoding="utf-8") as f:
-        PRODUCTS = json.load(f)
-except Exception as e:
-    logger.error(f"Ошибка загрузки products.json: {e}")
-    PRODUCTS = []
+CATALOG = CatalogStore("products.json")
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CATALOG_RELOAD_INTERVAL", "30"))  # 0 — не следить за файлом
+
+# === Кэш клавиатур ===
+KEYBOARDS = KeyboardCache()
+CATALOG.on_reload(KEYBOARDS.set_categories, build=KEYBOARDS.build_categories)
+
+# === Кэш file_id фото товаров ===
+PHOTOS = PhotoCache(os.getenv("PHOTO_CACHE_PATH", "photo_cache.json"))
+PHOTO_WARMUP_CHAT_ID = int(os.getenv("PHOTO_WARMUP_CHAT_ID", "0"))  # 0 — без предзагрузки
+
+# Журнал входящих обновлений для benchmarks.replay; пусто — не пишется
+UPDATE_JOURNAL_PATH = os.getenv("UPDATE_JOURNAL_PATH", "").strip()
+UPDATE_JOURNAL_SALT = os.getenv("UPDATE_JOURNAL_SALT") or f"journal:{BOT_TOKEN}"  # Ключ псевдонимов id
+RECORDER = UpdateRecorder(UPDATE_JOURNAL_PATH, UPDATE_JOURNAL_SALT.encode()) if UPDATE_JOURNAL_PATH else None
+CATALOG.on_reload(PHOTOS.prune)
 
 # === Вспомогательные функции для игры ===
-def create_game_board():
-    return [" " for _ in range(9)]
-
-def check_win(board, player):
-    win_conditions = [
-        (0, 1, 2), (3, 4, 5), (6, 7, 8),
-        (0, 3, 6), (1, 4, 7), (2, 5, 8),
-        (0, 4, 8), (2, 4, 6)
-    ]
-    return any(all(board[i] == player for i in cond) for cond in win_conditions)
-
-def check_draw(board):
-    return " " not in board
-
-def get_game_keyboard(board):
-    keyboard = []
-    for row in range(3):
-        buttons = []
-        for col in range(3):
-            idx = row * 3 + col
-            text = board[idx] if board[idx] != " " else " "
-            callback = f"move_{idx}" if board[idx] == " " else "ignore"
-            buttons.append(InlineKeyboardButton(text, callback_data=callback))
-        keyboard.append(buttons)
-    return InlineKeyboardMarkup(keyboard)
+def get_game_keyboard(x: int, o: int, game_id: str = None):
+    """Без game_id — доска игры с ботом, с game_id — партии вдвоём (id попадает в callback_data)"""
+    if game_id is None:
+        return KEYBOARDS.board(ttt_engine.render(x, o))
+    return KEYBOARDS.pvp_board(ttt_engine.render(x, o), game_id)
 
 def generate_promo():
-    code = "WIN" + str(random.randint(1000, 9999))
-    active_promocodes.add(code)  # Сохраняем как активный
-    return code
-
-def load_active_promos():
-    if not supabase:
-        return set()
-    response = supabase.table("used_promos").select("code").execute()
-    used = {row["code"] for row in response.data}
-    
-    # Генерируем ВСЕ возможные промокоды (например, WIN1000-WIN9999)
-    all_promos = {f"WIN{i}" for i in range(1000, 10000)}
-    return all_promos - used
+    return PROMOS.issue()
 
 # === Защита от спама ===
-async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    now = time.time()
-    
-    if now - user_last_action[user_id] < 1.0:  # 1 сек между действиями
-        await update.callback_query.answer("⏳ Подождите немного!")
+async def drop_duplicates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -2: повторно доставленное обновление не доходит ни до лимитов, ни до обработчиков"""
+    if DEDUP.is_duplicate(update.update_id):
+        logger.info(f"Повторная доставка обновления {update.update_id}, пропускаем")
+        raise ApplicationHandlerStop
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Группа -3, только при polling: с вебхуком обновление пишет в журнал сам HTTP-сервер"""
+    RECORDER.record(update.to_dict())
+
+def within_rate_limit(update: Update) -> bool:
+    user = update.effective_user
+    if user is None:
         return True
-        
-    user_last_action[user_id] = now
-    return False
+    # Платежи не ограничиваем и не тратим на них маркеры: деньги уже списаны или списываются
+    if update.pre_checkout_query or (update.message and update.message.successful_payment):
+        return True
+    return RATE_LIMITER.allow(user.id)
 
-def find_losing_move(board, player):
-    """Находит ход, который приведёт к победе игрока (бот проигрывает)"""
-    for i in range(9):
-        if board[i] == " ":
-            board[i] = player
-            if check_win(board, player):
-                board[i] = " "  # Отменяем изменение
-                return i
-            board[i] = " "
-    return None
-
-def find_winning_move(board, player):
-    """Находит ход, который приведёт к победе указанного игрока"""
-    for i in range(9):
-        if board[i] == " ":
-            board[i] = player
-            if check_win(board, player):
-                board[i] = " "  # Отменяем изменение
-                return i
-            board[i] = " "
-    return None
+async def rate_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Выполняется в группе -1 раньше всех обработчиков и для любых типов апдейтов, только при polling:
+    с вебхуком та же проверка отсекает лишнее ещё до очереди (IngestQueue admit).
+    Отклонённый апдейт дальше не идёт: ни логирования, ни разбора callback_data
+    """
+    if within_rate_limit(update):
+        return
+    if update.callback_query:
+        await update.callback_query.answer("⏳ Подождите немного!")
+    raise ApplicationHandlerStop
 
 def check_game_limits(user_id: int):
     """Возвращает (can_play: bool, can_win: bool)"""
-    now = time.time()
-    
-    # Очистка старых игр (>24ч)
-    stats = user_game_stats[user_id]
-    stats["games"] = [ts for ts in stats["games"] if now - ts < 86400]
-    
-    total_games = len(stats["games"])
-    promo_count = stats["promos"]
-    
-    can_play = total_games < MAX_GAMES_PER_DAY  # 10 игр/день
-    can_win = promo_count < MAX_PROMOS_PER_DAY  # 2 промокода/день
-    
+    can_play = GAME_QUOTA.allowed(user_id)  # 10 игр за сутки
+    can_win = PROMO_QUOTA.allowed(user_id)  # 2 промокода за сутки
     return can_play, can_win
 
+QUOTAS = {"game": GAME_QUOTA, "promo": PROMO_QUOTA}
+
+def charge_quota(name: str, user_id: int) -> bool:
+    """Засчитывает событие в лимит пользователя, если лимит не исчерпан"""
+    quota = QUOTAS[name]
+    if not quota.allowed(user_id):
+        return False
+    quota.record(user_id)
+    return True
+
+async def charge_user_quota(name: str, user_id: int) -> bool:
+    """
+    Как charge_quota, но в процессе, который ведёт лимиты пользователя.
+    Партия вдвоём живёт в процессе создателя, и лимит соперника
+    списывается запросом к его процессу; нет ответа — лимит не выдан
+    """
+    owner = SHARD_RING.shard_for(user_key(user_id)) if SHARD_RING and SHARD_INDEX is not None else None
+    if owner is None or owner == int(SHARD_INDEX):
+        return charge_quota(name, user_id)
+    try:
+        async with httpx.AsyncClient(timeout=2) as client:
+            response = await client.post(
+                f"http://127.0.0.1:{SHARD_BASE_PORT + owner}{QUOTA_PATH}",
+                json={"quota": name, "user_id": user_id},
+                headers={SECRET_HEADER: WEBHOOK_SECRET},
+            )
+        response.raise_for_status()
+        return bool(response.json()["granted"])
+    except Exception as e:
+        logger.warning(f"Не удалось списать лимит {name} пользователя {user_id} в процессе {owner}: {e}")
+        return False
+
 # === Обработчики магазина ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем user_id при первом контакте
@@ -166,198 +298,155 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 def category_menu():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("👕 Одежда", callback_data="cat_clothing")],
-        [InlineKeyboardButton("👟 Обувь", callback_data="cat_shoes")],
-        [InlineKeyboardButton("👜 Аксессуары", callback_data="cat_accessories")],
-        [InlineKeyboardButton("🛒 Корзина", callback_data="cart")],
-        [InlineKeyboardButton("↓↓ Игры ↓↓", callback_data="ignore")],
-        [InlineKeyboardButton("🎮 Крестики-нолики", callback_data="ttt_menu")]
-    ])
+    return KEYBOARDS.category_menu
+
+MAX_TOTAL_ITEMS = 20
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):    
+# === Обработчики кнопок ===
+async def cart_inc(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = context.user_data.get('session_user_id', update.effective_user.id)
+    user_id = update.effective_user.id
 
-    # ЛОГИРОВАНИЕ
-    logger.info(f"Получен callback: {data} от пользователя {user_id}")
+    current_cart = get_cart(user_id)
+    total_items = sum(current_cart.values())
 
-    # Защита от спама
-    if await rate_limit(update, context):
+    if total_items >= MAX_TOTAL_ITEMS:
+        # Показываем ошибку прямо в корзине
+        await MESSAGES.edit_text(
+            query,
+            "🛒 Корзина переполнена!\nМаксимум 20 товаров. Удалите что-нибудь или уменьшите количество.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("⬅️ Вернуться в корзину", callback_data="cart")]
+            ])
+        )
         return
 
-    # Валидация данных
-    if len(data) > 50 or not re.match(r"^[a-zA-Z0-9_\-]+$", data):
-        await query.answer("Недопустимый запрос")
-        logger.warning(f"Подозрительный callback_data: {data} от пользователя {user_id}")
-        return
-    
-        # Управление количеством
-    elif data.startswith("inc_"):
-        prod_id = int(data.split("_")[1])
-        user_id = update.effective_user.id
-    
-        MAX_TOTAL_ITEMS = 20
-        current_cart = user_carts.get(user_id, {})
-        total_items = sum(current_cart.values())
-    
-        if total_items >= MAX_TOTAL_ITEMS:
-            # Показываем ошибку прямо в корзине
-            await query.edit_message_text(
-                "🛒 Корзина переполнена!\nМаксимум 20 товаров. Удалите что-нибудь или уменьшите количество.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("⬅️ Вернуться в корзину", callback_data="cart")]
-                ])
-            )
-            return
-    
-        if user_id not in user_carts:
-            user_carts[user_id] = {}
-        user_carts[user_id][prod_id] = user_carts[user_id].get(prod_id, 0) + 1
-        await show_cart(update, context)
-        return
+    current_cart[prod_id] = current_cart.get(prod_id, 0) + 1
+    save_cart(user_id, current_cart)
+    await show_cart(update, context)
 
-    elif data.startswith("dec_"):
-        prod_id = int(data.split("_")[1])
-        if user_id in user_carts and prod_id in user_carts[user_id]:
-            user_carts[user_id][prod_id] -= 1
-            if user_carts[user_id][prod_id] <= 0:
-                del user_carts[user_id][prod_id]
-        await show_cart(update, context)
-        return
+async def cart_dec(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
+    user_id = context.user_data.get('session_user_id', update.effective_user.id)
+    cart = get_cart(user_id)
+    if prod_id in cart:
+        cart[prod_id] -= 1
+        if cart[prod_id] <= 0:
+            del cart[prod_id]
+        save_cart(user_id, cart)
+    await show_cart(update, context)
+
+async def cart_del(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
+    user_id = context.user_data.get('session_user_id', update.effective_user.id)
+    cart = get_cart(user_id)
+    if prod_id in cart:
+        del cart[prod_id]
+        save_cart(user_id, cart)
+    await show_cart(update, context)
 
-    elif data.startswith("del_"):
-        prod_id = int(data.split("_")[1])
-        if user_id in user_carts and prod_id in user_carts[user_id]:
-            del user_carts[user_id][prod_id]
-        await show_cart(update, context)
-        return
-        
-    elif data == "cat_clothing":
-        logger.info("Загружаем категорию clothing")
-        await show_category(update, context, "clothing")
-    elif data == "cat_shoes":
-        await show_category(update, context, "shoes")
-    elif data == "cat_accessories":
-        await show_category(update, context, "accessories")
-    elif data == "back_categories":
-        if query.message.photo:
-            await query.edit_message_caption(
-                caption="Выберите категорию:",
-                reply_markup=category_menu()
-            )
-        else:
-            await query.edit_message_text(
-                "Выберите категорию:",
-                reply_markup=category_menu()
-            )
-    elif data.startswith("view_"):
-        prod_id = int(data.split("_")[1])
-        await view_product(update, context, prod_id)
-    elif data.startswith("add_"):
-        prod_id = int(data.split("_")[1])
-        user_id = update.effective_user.id
-    
-        MAX_TOTAL_ITEMS = 20
-        current_cart = user_carts.get(user_id, {})
-        total_items = sum(current_cart.values())
-    
-        if total_items >= MAX_TOTAL_ITEMS:
-            # Показываем ошибку в карточке товара
-            product = next((p for p in PRODUCTS if p["id"] == prod_id), None)
-            if product:
-                caption = f"*{product['name']}*\n\n{product['description']}\n\n⚠️ Нельзя добавить: корзина заполнена (макс. 20)."
-                keyboard = [
-                    [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_cat_{product['category']}")]
-                ]
-                if product.get("photo_url", "").strip():
-                    try:
-                        await query.edit_message_media(
-                            media=InputMediaPhoto(
-                                media=product["photo_url"].strip(),
-                                caption=caption,
-                                parse_mode="Markdown"
-                            ),
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                    except Exception:
-                        await query.edit_message_text(caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
-                else:
-                    await query.edit_message_text(caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+async def cart_add(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
+    query = update.callback_query
+    user_id = update.effective_user.id
+
+    current_cart = get_cart(user_id)
+    total_items = sum(current_cart.values())
+
+    if total_items >= MAX_TOTAL_ITEMS:
+        await query.answer()
+        # Показываем ошибку в карточке товара
+        product = CATALOG.current.get(prod_id)
+        if product:
+            caption = f"*{product.name}*\n\n{product.description}\n\n⚠️ Нельзя добавить: корзина заполнена (макс. 20)."
+            keyboard = [
+                [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_cat_{product.category}")]
+            ]
+            if product.photo_url:
+                try:
+                    message = await MESSAGES.edit_media(
+                        query,
+                        media=InputMediaPhoto(
+                            media=PHOTOS.media_for(product),
+                            caption=caption,
+                            parse_mode="Markdown"
+                        ),
+                        reply_markup=InlineKeyboardMarkup(keyboard),
+                        content=(product.id, product.photo_url, caption),
+                        skippable=True,
+                    )
+                    PHOTOS.remember(product, message)
+                except Exception:
+                    await MESSAGES.edit_text(query, caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard), skippable=True)
             else:
-                await query.edit_message_text("❌ Товар не найден.")
-            return
-    
-        if user_id not in user_carts:
-            user_carts[user_id] = {}
-        user_carts[user_id][prod_id] = user_carts[user_id].get(prod_id, 0) + 1
-        await query.answer("✅ Товар добавлен!")
-        await view_product(update, context, prod_id)
-        return
-    
-    elif data == "cart":
-        await show_cart(update, context)
-    elif data == "pay_rub":
-        await send_rub_invoice(update, context)
-    elif data.startswith("back_cat_"):
-        category = data.split("_")[2]
-        # Удаляем текущее сообщение (фото или текст)
-        await query.delete_message()
-        # Отправляем новое текстовое меню категории
-        items = [p for p in PRODUCTS if p["category"] == category]
-        if not items:
-            await update.effective_chat.send_message(
-                "В этой категории нет товаров.",
-                reply_markup=back_kb()
-            )
+                await MESSAGES.edit_text(query, caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard), skippable=True)
         else:
-            buttons = [[InlineKeyboardButton(p["name"], callback_data=f"view_{p['id']}")] for p in items]
-            buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")])
-            await update.effective_chat.send_message(
-                "Выберите товар:",
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-    elif data == "back_categories":
-        await query.delete_message()
-        await update.effective_chat.send_message(
+            await MESSAGES.edit_text(query, "❌ Товар не найден.")
+        return
+
+    current_cart[prod_id] = current_cart.get(prod_id, 0) + 1
+    save_cart(user_id, current_cart)
+    await query.answer("✅ Товар добавлен!")
+    await view_product(update, context, prod_id)
+
+async def back_to_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.message.photo:
+        await MESSAGES.edit_caption(
+            query,
+            caption="Выберите категорию:",
+            reply_markup=category_menu(),
+            skippable=True,
+        )
+    else:
+        await MESSAGES.edit_text(
+            query,
             "Выберите категорию:",
-            reply_markup=category_menu()
+            reply_markup=category_menu(),
+            skippable=True,
         )
-        await show_category(update, context, category)
-    elif data == "ttt_game":
-        await query.answer()
-        await start_ttt(update, context)
-    elif data == "ttt_menu":
-        await ttt_menu(update, context)
-    elif data == "ttt_vs_bot":
-        await start_ttt(update, context)
-    elif data == "ttt_vs_friend":
-        await create_ttt_game(update, context)
-    elif data == "enter_promo":
-        await query.edit_message_text(
-            "Введите промокод:",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("⬅️ Отмена", callback_data="cart")]
-            ])
+
+async def back_to_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
+    query = update.callback_query
+    # Удаляем текущее сообщение (фото или текст)
+    await query.delete_message()
+    # Отправляем новое текстовое меню категории
+    markup = KEYBOARDS.category(category)
+    if markup is None:
+        await update.effective_chat.send_message(
+            "В этой категории нет товаров.",
+            reply_markup=back_kb()
+        )
+    else:
+        await update.effective_chat.send_message(
+            "Выберите товар:",
+            reply_markup=markup
         )
-        # Ожидаем текстовый ввод
-        context.user_data['awaiting_promo'] = True
+
+async def enter_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await MESSAGES.edit_text(
+        update.callback_query,
+        "Введите промокод:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("⬅️ Отмена", callback_data="cart")]
+        ])
+    )
+    # Ожидаем текстовый ввод
+    context.user_data['awaiting_promo'] = True
+
+async def ignore_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    pass
 
 async def view_product(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
     query = update.callback_query
     try:
-        product = next((p for p in PRODUCTS if p["id"] == prod_id), None)
+        product = CATALOG.current.get(prod_id)
         if not product:
-            await query.edit_message_text("❌ Товар не найден. Возможно, он удалён.")
+            await MESSAGES.edit_text(query, "❌ Товар не найден. Возможно, он удалён.")
             return
 
-        photo_url = product.get("photo_url", "").strip()
-        caption = f"*{product['name']}*\n\n{product['description']}\n\nЦена: {product['price_rub']} ₽"
+        photo_url = product.photo_url
+        caption = f"*{product.name}*\n\n{product.description}\n\nЦена: {product.price_rub} ₽"
         keyboard = [
             [InlineKeyboardButton("➕ В корзину", callback_data=f"add_{prod_id}")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_cat_{product['category']}")]
+            [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_cat_{product.category}")]
         ]
 
         if photo_url:
@@ -365,23 +454,30 @@ async def view_product(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_
                 if not photo_url.startswith(("http://", "https://")):
                     raise ValueError("Неверный URL фото")
                     
-                await query.edit_message_media(
-                    media=InputMediaPhoto(media=photo_url, caption=caption, parse_mode="Markdown"),
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                message = await MESSAGES.edit_media(
+                    query,
+                    media=InputMediaPhoto(media=PHOTOS.media_for(product), caption=caption, parse_mode="Markdown"),
+                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    content=(product.id, product.photo_url, caption),
+                    skippable=True,
                 )
+                PHOTOS.remember(product, message)
             except BadRequest as e:
                 if "Message is not modified" in str(e):
                     # Игнорируем ошибку — пользователь уже видит это сообщение
                     pass
                 else:
                     logger.error(f"Ошибка фото: {e}")
-                    await query.edit_message_text(caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+                    # file_id мог устареть — в следующий раз отправим по URL
+                    PHOTOS.forget(product)
+                    await MESSAGES.edit_text(query, caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard), skippable=True)
             except Exception as e:
                 logger.error(f"Ошибка загрузки фото: {e}")
-                await query.edit_message_text(caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard))
+                await MESSAGES.edit_text(query, caption, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(keyboard), skippable=True)
         else:
             try:
-                await query.edit_message_text(
+                await MESSAGES.edit_text(
+                    query,
                     caption, 
                     parse_mode="Markdown", 
                     reply_markup=InlineKeyboardMarkup(keyboard)
@@ -393,24 +489,26 @@ async def view_product(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_
                     raise
     except Exception as e:
         logger.error(f"Критическая ошибка в view_product: {e}")
-        await query.edit_message_text("Произошла ошибка. Попробуйте позже.")
+        await MESSAGES.edit_text(query, "Произошла ошибка. Попробуйте позже.")
 
-async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):    
+async def show_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category: str, page: int = 0):
     query = update.callback_query
-    items = [p for p in PRODUCTS if p["category"] == category]
-    if not items:
-        await query.edit_message_text("В этой категории нет товаров.", reply_markup=back_kb())
+    markup = KEYBOARDS.category(category, page)
+    if markup is None:
+        await MESSAGES.edit_text(query, "В этой категории нет товаров.", reply_markup=back_kb())
         return
 
-    buttons = [[InlineKeyboardButton(p["name"], callback_data=f"view_{p['id']}")] for p in items]
-    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")])
-
     # ВСЕГДА используем edit_message_text для категорий
-    await query.edit_message_text(
+    await MESSAGES.edit_text(
+        query,
         "Выберите товар:",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=markup,
+        skippable=True,
     )
 
+async def show_category_page(update: Update, context: ContextTypes.DEFAULT_TYPE, target: tuple):
+    await show_category(update, context, *target)
+
 async def handle_promo_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get('awaiting_promo'):
         promo = update.message.text.strip().upper()
@@ -422,7 +520,7 @@ async def handle_promo_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if not re.match(r"^[A-Z0-9]+$", promo):
             await update.message.reply_text("❌ Промокод может содержать только буквы и цифры")
             return   
-        if promo in active_promocodes:
+        if PROMOS.is_valid(promo):
             context.user_data['promo'] = promo
             await update.message.reply_text("✅ Промокод применён! Скидка 200 ₽ активна.")
         else:
@@ -436,26 +534,35 @@ async def handle_promo_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def show_cart_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = context.user_data.get('session_user_id', update.effective_user.id)
-    cart = user_carts.get(user_id, {})
+    catalog = CATALOG.current
+    removed = prune_cart(user_id, catalog)
+    cart = get_cart(user_id)
     if not cart:
         await update.message.reply_text("Корзина пуста.", reply_markup=back_kb())
         return
 
+    promo = context.user_data.get('promo', None)
+    text, markup = cart_view(user_id, cart, catalog, promo, removed, summary=True)
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=markup)
+
+def render_cart_summary(cart: dict, catalog, promo, removed: int):
+    """Текст и клавиатура корзины списком (для нового сообщения)"""
     total = 0
     for pid, qty in cart.items():
-        product = next((p for p in PRODUCTS if p["id"] == pid), None)
+        product = catalog.get(pid)
         if product:
-            total += product["price_rub"] * qty
+            total += product.price_rub * qty
 
-    promo = context.user_data.get('promo', None)
-    discount = 200 if promo in active_promocodes else 0
+    discount = 200 if PROMOS.is_valid(promo) else 0
     final_total = max(total - discount, 0)
 
     text = "🛒 *Ваша корзина:*\n\n"
+    if removed:
+        text += REMOVED_ITEMS_NOTICE
     for pid, qty in cart.items():
-        product = next((p for p in PRODUCTS if p["id"] == pid), None)
+        product = catalog.get(pid)
         if product:
-            text += f"- {product['name']} × {qty}\n"
+            text += f"- {product.name} × {qty}\n"
     
     if discount > 0:
         text += f"\nСкидка по промокоду: -{discount} ₽"
@@ -469,59 +576,60 @@ async def show_cart_from_message(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton("💳 Оплатить", callback_data="pay_rub")],
         [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
     ])
+    return text, InlineKeyboardMarkup(kb)
 
-    await update.message.reply_text(
-        text, 
-        parse_mode="Markdown", 
-        reply_markup=InlineKeyboardMarkup(kb)
-    )
-        
 def back_kb():
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
-    ])
+    return KEYBOARDS.back_kb
+
+def prune_cart(user_id: int, catalog) -> int:
+    """
+    Удаляет из корзины товары, которых больше нет в каталоге
+    (после перезагрузки products.json). Возвращает число удалённых позиций
+    """
+    cart = get_cart(user_id)
+    missing = [pid for pid in cart if pid not in catalog]
+    if missing:
+        for pid in missing:
+            del cart[pid]
+        save_cart(user_id, cart)
+    return len(missing)
+
+REMOVED_ITEMS_NOTICE = "⚠️ Некоторые товары больше не продаются и удалены из корзины.\n"
 
 def calculate_cart_total(user_id: int, context: ContextTypes.DEFAULT_TYPE = None) -> int:
     """
     Возвращает общую сумму корзины в рублях (без копеек)
     Учитывает промокод, если context передан
     """
-    cart = user_carts.get(user_id, {})
+    cart = get_cart(user_id)
+    catalog = CATALOG.current
     total = 0
     
     # Считаем базовую сумму
     for pid, qty in cart.items():
-        product = next((p for p in PRODUCTS if p["id"] == pid), None)
+        product = catalog.get(pid)
         if product:
-            total += product["price_rub"] * qty
+            total += product.price_rub * qty
 
     # Применяем скидку по промокоду
     if context and hasattr(context, 'user_data'):
         promo = context.user_data.get('promo')
-        if promo in active_promocodes:
+        if PROMOS.is_valid(promo):
             total = max(total - 200, 0)  # Минимальная сумма — 0
     
     return total
 
-async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = context.user_data.get('session_user_id', update.effective_user.id)
-    cart = user_carts.get(user_id, {})
-    promo = context.user_data.get('promo', None)
-    
-    if not cart:
-        await query.edit_message_text("Корзина пуста.", reply_markup=back_kb())
-        return
-
+def render_cart(cart: dict, catalog, promo, removed: int):
+    """Текст и клавиатура корзины с кнопками управления (для правки сообщения)"""
     total = 0
     buttons = []
     
     for pid, qty in cart.items():
-        product = next((p for p in PRODUCTS if p["id"] == pid), None)
+        product = catalog.get(pid)
         if not product:
             continue
             
-        total += product["price_rub"] * qty
+        total += product.price_rub * qty
         
         # Кнопки управления
         control_buttons = [
@@ -529,16 +637,18 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton(str(qty), callback_data="ignore"),
             InlineKeyboardButton("+", callback_data=f"inc_{pid}")
         ]
-        buttons.append([InlineKeyboardButton(f"{product['name']} × {qty}", callback_data=f"view_{pid}")])
+        buttons.append([InlineKeyboardButton(f"{product.name} × {qty}", callback_data=f"view_{pid}")])
         buttons.append(control_buttons)
         buttons.append([InlineKeyboardButton("🗑️ Удалить", callback_data=f"del_{pid}")])
         buttons.append([])  # Пустая строка для разделения
 
     # Применяем скидку
-    discount = 200 if promo in active_promocodes else 0
+    discount = 200 if PROMOS.is_valid(promo) else 0
     final_total = max(total - discount, 0)
 
     text = "🛒 *Ваша корзина:*\n\n"
+    if removed:
+        text += REMOVED_ITEMS_NOTICE
     if discount > 0:
         text += f"\nСкидка по промокоду: -{discount} ₽"
     
@@ -552,41 +662,50 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
     ])
     buttons.extend(kb)
+    return text, InlineKeyboardMarkup(buttons)
 
-    await query.edit_message_text(
-        text, 
-        parse_mode="Markdown", 
-        reply_markup=InlineKeyboardMarkup(buttons)
-    )
+async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = context.user_data.get('session_user_id', update.effective_user.id)
+    catalog = CATALOG.current
+    removed = prune_cart(user_id, catalog)
+    cart = get_cart(user_id)
+    promo = context.user_data.get('promo', None)
+    
+    if not cart:
+        await MESSAGES.edit_text(query, "Корзина пуста.", reply_markup=back_kb())
+        return
+
+    text, markup = cart_view(user_id, cart, catalog, promo, removed)
+    await MESSAGES.edit_text(query, text, parse_mode="Markdown", reply_markup=markup, skippable=True)
 
 async def send_rub_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = context.user_data.get('session_user_id', update.effective_user.id)
-    cart = user_carts.get(user_id, {})
+    catalog = CATALOG.current
+    if prune_cart(user_id, catalog):
+        # Состав корзины изменился — сначала показываем новую сумму
+        await show_cart(update, context)
+        return
+    cart = get_cart(user_id)
     
     if not cart:
-        await query.edit_message_text("Корзина пуста.")
+        await MESSAGES.edit_text(query, "Корзина пуста.")
         return
 
-    total_rub = 0
-    for pid, qty in cart.items():
-        product = next((p for p in PRODUCTS if p["id"] == pid), None)
-        if product:
-            total_rub += product["price_rub"] * qty
-
-    # Применяем скидку
+    # Фиксируем состав, цены и скидку: дальнейшие изменения корзины счёт не затрагивают
     promo = context.user_data.get('promo')
-    if promo in active_promocodes:
-        total_rub = max(total_rub - 200, 0)
+    discount = 200 if PROMOS.is_valid(promo) else 0
+    invoice = INVOICES.create(user_id, cart, catalog, promo=promo, discount_rub=discount)
 
     await context.bot.send_invoice(
         chat_id=update.effective_chat.id,
         title="Заказ в Urban Style",
         description="Оплата за выбранные товары",
-        payload=f"order_{user_id}",
+        payload=invoice.payload,
         provider_token=PROVIDER_TOKEN,
         currency="RUB",
-        prices=[LabeledPrice("Общая сумма", total_rub * 100)],
+        prices=[LabeledPrice("Общая сумма", invoice.total_kopecks)],
         need_name=False,
         need_email=False,
         need_phone_number=False,
@@ -594,7 +713,16 @@ async def send_rub_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.pre_checkout_query.answer(ok=True)
+    # Telegram ждёт ответа 10 секунд — проверяем только по снимку счёта, без сети
+    query = update.pre_checkout_query
+    invoice, error = INVOICES.check(query.invoice_payload, query.from_user.id, query.currency, query.total_amount)
+    if invoice is not None and invoice.promo and not PROMOS.is_valid(invoice.promo):
+        error = "Промокод уже использован. Оформите заказ заново."
+    if error:
+        logger.warning(f"Pre-checkout отклонён для {query.from_user.id}: {error}")
+        await query.answer(ok=False, error_message=error)
+        return
+    await query.answer(ok=True)
 
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     payment = update.message.successful_payment
@@ -602,62 +730,65 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     user = update.effective_user
     username = user.username or f"id{user.id}"
 
-       # === Проверка валюты ===
-    if payment.currency != "RUB":
-        logger.warning(f"Неверная валюта: {payment.currency} от пользователя {user_id}")
-        await update.message.reply_text("❌ Ошибка оплаты: неверная валюта.")
+    charge_id = payment.telegram_payment_charge_id
+    if charge_id in processed_payments:
+        # Повтор уже сохранённого платежа: корзина очищена, сумму проверять не с чем
+        logger.warning(f"Платёж {charge_id} уже обработан, повтор от {user_id} пропущен")
         return
 
-        # === Проверка суммы с учётом промокода ===
-    expected_amount = calculate_cart_total(user_id, context) * 100  # в копейках
-    if payment.total_amount != expected_amount:
-        logger.warning(f"Несоответствие суммы: ожидаемо {expected_amount}, получено {payment.total_amount} от {user_id}")
-        await update.message.reply_text("❌ Ошибка оплаты: сумма не совпадает. Свяжитесь с поддержкой.")
+    # === Проверка по снимку счёта ===
+    invoice, error = INVOICES.check(payment.invoice_payload, user.id, payment.currency, payment.total_amount)
+    if invoice is None:
+        logger.warning(f"Оплата не совпадает со счётом {payment.invoice_payload} от {user_id}: {error}")
+        await update.message.reply_text("❌ Ошибка оплаты: счёт не найден или сумма не совпадает. Свяжитесь с поддержкой.")
         return
 
-    user = update.effective_user
-    user_id = context.user_data.get('session_user_id', user.id)
-    
-    # === Сохраняем в Supabase ===
+    # === Идемпотентность: один платёж — один заказ ===
+    processed_payments.put(charge_id, user_id)
+    STATE.flush()  # Ключ должен пережить перезапуск раньше, чем уйдут записи о заказе
+
+    promo_redeemed = bool(invoice.promo) and await PROMOS.redeem(invoice.promo, user_id)
+    if invoice.promo and not promo_redeemed:
+        logger.warning(f"Промокод {invoice.promo} погашен раньше, чем оплачен счёт {invoice.payload}")
+
+    # === Сохраняем в Supabase ровно то, что было в счёте ===
     if supabase:
         # 1. Сохраняем пользователя
-        supabase.table("customers").upsert({
+        SUPABASE_WRITES.submit("customers", "upsert", {
             "id": user_id,
             "username": user.username,
             "first_name": user.first_name
-        }).execute()
+        })
 
         # 2. Сохраняем заказ
-        cart_items = []
-        for pid, qty in user_carts.get(user_id, {}).items():
-            product = next((p for p in PRODUCTS if p["id"] == pid), None)
-            if product:
-                cart_items.append({
-                    "id": product["id"],
-                    "name": product["name"],
-                    "qty": qty,
-                    "price": product["price_rub"]
-                })
-
-        promo_used = context.user_data.get('promo')
-        if promo_used in active_promocodes:
-            # Сохраняем промокод как использованный
-            supabase.table("used_promos").insert({
-                "code": promo_used,
-                "used_by": user_id
-            }).execute()
-            active_promocodes.discard(promo_used)
-
-        supabase.table("orders").insert({
+        cart_items = [
+            {"id": line.product_id, "name": line.name, "qty": line.qty, "price": line.price_rub}
+            for line in invoice.lines
+        ]
+
+        # Ключ идемпотентности заказа: orders.telegram_payment_charge_id уникален
+        # (alter table orders add column telegram_payment_charge_id text unique),
+        # поэтому повтор вставки после таймаута, который на деле прошёл, не создаст второй заказ
+        SUPABASE_WRITES.submit("orders", "insert", {
             "customer_id": user_id,
-            "amount_rub": payment.total_amount // 100,
+            "amount_rub": invoice.total_rub,
             "items": cart_items,
-            "promo_used": promo_used
-        }).execute()
-
-    # Удаляем корзину
-    user_carts.pop(user_id, None)
-    context.user_data.pop('promo', None)
+            "promo_used": invoice.promo,
+            "telegram_payment_charge_id": charge_id,
+        })
+    INVOICES.complete(invoice.payload)
+
+    # Убираем из корзины оплаченное; добавленное после выставления счёта остаётся
+    cart = get_cart(user_id)
+    for line in invoice.lines:
+        left = cart.get(line.product_id, 0) - line.qty
+        if left > 0:
+            cart[line.product_id] = left
+        else:
+            cart.pop(line.product_id, None)
+    save_cart(user_id, cart)
+    if context.user_data.get('promo') == invoice.promo:
+        context.user_data.pop('promo', None)
 
     await update.message.reply_text("🎉 Спасибо за заказ!")
 
@@ -684,213 +815,198 @@ async def start_ttt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info("Запуск игры с ботом")
     chat_id = update.effective_chat.id
-    board = create_game_board()
-    games[chat_id] = {'board': board, 'vs_bot': True}
+    games.put(chat_id, {'x': 0, 'o': 0, 'vs_bot': True})
     
     await context.bot.send_message(
         chat_id=chat_id,
         text="🎮 Игра против бота!\nВы — X. Сделайте свой ход:",
-        reply_markup=get_game_keyboard(board)
+        reply_markup=get_game_keyboard(0, 0)
     )
     
 async def ttt_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("ttt_menu вызван")
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text(
+    await MESSAGES.edit_text(
+        query,
         "Выберите режим:",
-        reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("С ботом", callback_data="ttt_vs_bot")],
-            [InlineKeyboardButton("С другом", callback_data="ttt_vs_friend")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
-        ])
+        reply_markup=KEYBOARDS.ttt_menu,
+        skippable=True,
     )
 
-async def ttt_move(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def finish_bot_game(chat_id: int, user_id: int, promo_issued: bool = False):
+    """Единая точка завершения партии с ботом: игра засчитывается ровно один раз"""
+    games.delete(chat_id)
+    record_game(user_id, promo_issued=promo_issued)
+
+async def ttt_move(update: Update, context: ContextTypes.DEFAULT_TYPE, move_index: int):
     query = update.callback_query
     await query.answer()
     chat_id = query.message.chat.id
-    user_id = context.user_data.get('session_user_id', update.effective_user.id)
-    MAX_GAMES_PER_DAY = 10
+    user_id = update.effective_user.id
 
     # Игра с ботом
-    if chat_id in games:
-        game = games[chat_id]
-        board = game['board']
-        move_index = int(query.data.split('_')[1])
+    game = games.get(chat_id)
+    if not game:
+        return
+    x, o = game['x'], game['o']
+    bit = 1 << move_index
 
-        if board[move_index] != " ":
-            await query.answer("Эта ячейка уже занята!")
-            return
+    if (x | o) & bit:
+        await query.answer("Эта ячейка уже занята!")
+        return
 
-        # Ход игрока (X)
-        board[move_index] = 'X'
+    # Ход игрока (X)
+    x |= bit
+    _, can_win = check_game_limits(user_id)
 
-        # Проверка победы игрока
-    if check_win(board, 'X'):
-        _, can_win = check_game_limits(user_id)
-    
+    # Проверка победы игрока
+    if ttt_engine.WINS[x]:
         if can_win:
             # Выдаём промокод
             promo = generate_promo()
             result_text = f"🎉 Вы победили! 🎉\n\nТвой промокод: `{promo}`\n+30 ⭐️ бонусов!"
-            user_game_stats[user_id]["promos"] += 1
         else:
             # Победа без промокода
             result_text = "🎉 Вы победили! Но лимит промокодов на сегодня исчерпан."
     
-        user_game_stats[user_id]["games"].append(time.time())  # Записываем игру
-        del games[chat_id]
-        await query.edit_message_text(text=result_text, parse_mode="Markdown")
+        finish_bot_game(chat_id, user_id, promo_issued=can_win)
+        await MESSAGES.edit_text(query, text=result_text, parse_mode="Markdown")
         return
 
     # Проверка ничьей
-    if check_draw(board):
-        user_game_stats[user_id]["games"].append(time.time())
-        result_text = "🤝 Ничья!"
-        del games[chat_id]
-    
-        # ЗАПИСЫВАЕМ ИГРУ В ИСТОРИЮ
-        user_id = update.effective_user.id
-        user_game_stats[user_id]["games"].append(time.time())
-    
-        await query.edit_message_text(text=result_text, reply_markup=None)
+    if ttt_engine.is_full(x, o):
+        finish_bot_game(chat_id, user_id)
+        await MESSAGES.edit_text(query, text="🤝 Ничья!", reply_markup=None)
         return
 
     # === ХОД БОТА (O) ===
-    empty_cells = [i for i, cell in enumerate(board) if cell == " "]
-    if not empty_cells:
-        return
-
-    user_id = update.effective_user.id
-    _, can_win = check_game_limits(user_id)
+    # Пока можно выиграть промокод, бот играет оптимально, иначе — поддаётся
+    o |= 1 << ttt_engine.bot_move(x, o, play_to_win=can_win)
 
-    bot_move = None
-    if can_win:
-        # Бот играет честно: сначала атакует, потом защищается
-        bot_move = find_winning_move(board, 'O')
-        if bot_move is None:
-            bot_move = find_winning_move(board, 'X')
-    else:
-        # Бот намеренно проигрывает: ищет ход, который даст победу игроку
-        bot_move = find_losing_move(board, 'X')
-    
-    # Если не нашли ход — выбираем случайно
-    if bot_move is None:
-        bot_move = random.choice(empty_cells)
-
-    board[bot_move] = 'O'
-
-    # Проверка победы бота (только если он играет честно)
-    if can_win and check_win(board, 'O'):
-        result_text = "🤖 Бот победил! Попробуй ещё раз!"
-        del games[chat_id]
-        await query.edit_message_text(text=result_text, reply_markup=None)
+    # Проверка победы бота
+    if ttt_engine.WINS[o]:
+        finish_bot_game(chat_id, user_id)
+        await MESSAGES.edit_text(query, text="🤖 Бот победил! Попробуй ещё раз!", reply_markup=None)
         return
 
     # Проверка ничьей после хода бота
-    if check_draw(board):
-        result_text = "🤝 Ничья!"
-        del games[chat_id]
-        user_game_stats[user_id]["games"].append(time.time())
-    
-        await query.edit_message_text(text=result_text, reply_markup=None)
+    if ttt_engine.is_full(x, o):
+        finish_bot_game(chat_id, user_id)
+        await MESSAGES.edit_text(query, text="🤝 Ничья!", reply_markup=None)
         return
 
     # Обновление доски
-    await query.edit_message_text(
+    game['x'], game['o'] = x, o
+    games.put(chat_id, game)
+    await MESSAGES.edit_text(
+        query,
         text="Ваш ход:",
-        reply_markup=get_game_keyboard(board)
+        reply_markup=get_game_keyboard(x, o),
+        skippable=True,
     )
-    return
-        
-    # Мультиплеерная игра (если есть)
-    game_id = None
-    game = None
-    for gid, g in active_games.items():
-        if user_id in (g['player_x_id'], g['player_o_id']):
-            game_id = gid
-            game = g
-            break
-
-    if game:
-        # Мультиплеерная игра
-        if game['current_turn'] != user_id:
-            symbol = "X" if user_id == game['player_x_id'] else "O"
-            await query.answer(f"Сейчас ход противника! Вы — {symbol}.")
-            return
 
-        board = game['board']
-        if board[move_index] != " ":
-            await query.answer("Ячейка занята!")
-            return
+# === Игра вдвоём ===
+def end_pvp_game(game_id: str, game: dict):
+    active_games.delete(game_id)
+    for player_id in (game['player_x_id'], game['player_o_id']):
+        if player_games.get(player_id) == game_id:
+            player_games.delete(player_id)
+
+async def edit_both_boards(context: ContextTypes.DEFAULT_TYPE, game: dict, text_x: str, text_o: str, **kwargs):
+    """Обновляет сообщения обоих игроков параллельно: ответ приходит за один RTT, а не за два"""
+    results = await asyncio.gather(
+        context.bot.edit_message_text(chat_id=game['chat_id_x'], message_id=game['msg_id_x'], text=text_x, **kwargs),
+        context.bot.edit_message_text(chat_id=game['chat_id_o'], message_id=game['msg_id_o'], text=text_o, **kwargs),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Не удалось обновить доску: {result}")
 
-        player_symbol = "X" if user_id == game['player_x_id'] else "O"
-        board[move_index] = player_symbol
+async def ttt_pvp_move(update: Update, context: ContextTypes.DEFAULT_TYPE, move: tuple):
+    query = update.callback_query
+    game_id, move_index = move
+    user_id = update.effective_user.id
 
-        if check_win(board, player_symbol):
-            promo = generate_promo() if player_symbol == "X" else "Попробуй ещё раз!"
-            winner_name = "Вы" if user_id == game['player_x_id'] else "Ваш друг"
-            result_text = f"🎉 {winner_name} победил как {player_symbol}!\n\n"
-            if player_symbol == "X":
-                result_text += f"Твой промокод: `{promo}`\n+30 ⭐️ бонусов!"
-            
-            await context.bot.edit_message_text(
-                chat_id=game['chat_id_x'],
-                message_id=game['msg_id_x'],
-                text=result_text,
-                parse_mode="Markdown" if player_symbol == "X" else None
-            )
-            await context.bot.edit_message_text(
-                chat_id=game['chat_id_o'],
-                message_id=game['msg_id_o'],
-                text=result_text,
-                parse_mode="Markdown" if player_symbol == "X" else None
-            )
-            del active_games[game_id]
-            return
+    # Партия — по id из callback_data, принадлежность игрока — по индексу игрок → партия
+    game = active_games.get(game_id)
+    if game is None or player_games.get(user_id) != game_id:
+        await query.answer("❌ Игра не найдена или уже закончилась.")
+        return
 
-        if check_draw(board):
-            await context.bot.edit_message_text(
-                chat_id=game['chat_id_x'],
-                message_id=game['msg_id_x'],
-                text="🤝 Ничья!"
-            )
-            await context.bot.edit_message_text(
-                chat_id=game['chat_id_o'],
-                message_id=game['msg_id_o'],
-                text="🤝 Ничья!"
-            )
-            del active_games[game_id]
-            return
+    player_symbol = "X" if user_id == game['player_x_id'] else "O"
+    if game['current_turn'] != user_id:
+        await query.answer(f"Сейчас ход противника! Вы — {player_symbol}.")
+        return
 
-        next_player = game['player_o_id'] if user_id == game['player_x_id'] else game['player_x_id']
-        game['current_turn'] = next_player
+    bit = 1 << move_index
+    if (game['x'] | game['o']) & bit:
+        await query.answer("Ячейка занята!")
+        return
+    await query.answer()
 
-        next_symbol = "O" if player_symbol == "X" else "X"
-        await context.bot.edit_message_text(
-            chat_id=game['chat_id_x'],
-            message_id=game['msg_id_x'],
-            text=f"Ходит {'O' if user_id == game['player_x_id'] else 'X'} ({next_symbol}):",
-            reply_markup=get_game_keyboard(board)
-        )
-        await context.bot.edit_message_text(
-            chat_id=game['chat_id_o'],
-            message_id=game['msg_id_o'],
-            text=f"Ходит {'O' if user_id == game['player_x_id'] else 'X'} ({next_symbol}):",
-            reply_markup=get_game_keyboard(board)
-        )
+    game[player_symbol.lower()] |= bit
+    x, o = game['x'], game['o']
+
+    if ttt_engine.winner(x, o) == player_symbol:
+        end_pvp_game(game_id, game)
+        win_text = f"🎉 Вы победили ({player_symbol})!"
+        # Победитель может быть из другого процесса: лимит промокодов — там, где его остальные игры
+        if await charge_user_quota("promo", user_id):
+            win_text += f"\n\nТвой промокод: `{generate_promo()}`\n+30 ⭐️ бонусов!"
+        lose_text = f"😔 Победил соперник ({player_symbol}). Попробуй ещё раз!"
+        if player_symbol == "X":
+            await edit_both_boards(context, game, win_text, lose_text, parse_mode="Markdown")
+        else:
+            await edit_both_boards(context, game, lose_text, win_text, parse_mode="Markdown")
+        return
+
+    if ttt_engine.is_full(x, o):
+        end_pvp_game(game_id, game)
+        await edit_both_boards(context, game, "🤝 Ничья!", "🤝 Ничья!")
         return
-           
+
+    next_symbol = "O" if player_symbol == "X" else "X"
+    game['current_turn'] = game['player_o_id'] if player_symbol == "X" else game['player_x_id']
+    # Запись продлевает GAME_TTL: партия и индекс игроков живут, пока в неё играют
+    active_games.put(game_id, game)
+    player_games.put(game['player_x_id'], game_id)
+    player_games.put(game['player_o_id'], game_id)
+
+    your_turn = f"Ваш ход ({next_symbol}):"
+    their_turn = f"Ходит соперник ({next_symbol})..."
+    await edit_both_boards(
+        context, game,
+        your_turn if next_symbol == "X" else their_turn,
+        your_turn if next_symbol == "O" else their_turn,
+        reply_markup=get_game_keyboard(x, o, game_id),
+    )
+
+def new_game_id(creator_id: int) -> str:
+    """
+    8 hex-символов. При шардировании id подбирается так, чтобы партия попала
+    на тот же процесс, что и её создатель: там лежит приглашение, и туда же
+    фронт направит вход соперника и все ходы (по id партии)
+    """
+    while True:
+        game_id = uuid.uuid4().hex[:8]
+        if SHARD_RING is None or SHARD_RING.shard_for(game_key(game_id)) == SHARD_RING.shard_for(user_key(creator_id)):
+            return game_id
+
 async def create_ttt_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    game_id = str(uuid.uuid4())[:8]
+    can_play, _ = check_game_limits(user.id)
+    if not can_play:
+        await update.effective_message.reply_text(f"🎮 Лимит игр на сегодня исчерпан ({MAX_GAMES_PER_DAY}/день).")
+        return
+    game_id = new_game_id(user.id)
     
-    pending_invites[game_id] = {
+    pending_invites.put(game_id, {
         'creator_id': user.id,
         'creator_name': user.first_name,
         'chat_id': update.effective_chat.id
-    }
+    })
     
     bot_username = context.bot.username
     invite_link = f"https://t.me/{bot_username}?start=ttt_{game_id}"
@@ -904,71 +1020,315 @@ async def join_ttt_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game
     user = update.effective_user
     chat_id = update.effective_chat.id
 
-    if game_id not in pending_invites:
+    invite = pending_invites.get(game_id)
+    if invite is None:
         await update.message.reply_text("❌ Игра не найдена или уже началась.")
         return
 
-    invite = pending_invites[game_id]
     if invite['creator_id'] == user.id:
         await update.message.reply_text("Вы уже создали эту игру!")
         return
 
-    board = create_game_board()
-    active_games[game_id] = {
-        'board': board,
+    # Партия вдвоём засчитывается в лимит игр обоим игрокам, как только начинается
+    if not GAME_QUOTA.allowed(invite['creator_id']):
+        await update.message.reply_text("🎮 У создателя игры исчерпан лимит игр на сегодня.")
+        return
+    if not await charge_user_quota("game", user.id):
+        await update.message.reply_text(f"🎮 Лимит игр на сегодня исчерпан ({MAX_GAMES_PER_DAY}/день).")
+        return
+    charge_quota("game", invite['creator_id'])
+
+    # У игрока одна партия вдвоём: прежняя, если была, завершается
+    for player_id in (invite['creator_id'], user.id):
+        previous_id = player_games.get(player_id)
+        previous = active_games.get(previous_id) if previous_id else None
+        if previous is not None:
+            end_pvp_game(previous_id, previous)
+
+    game = {
+        'x': 0,
+        'o': 0,
         'player_x_id': invite['creator_id'],
         'player_o_id': user.id,
         'current_turn': invite['creator_id'],
         'chat_id_x': invite['chat_id'],
         'chat_id_o': chat_id
     }
+    pending_invites.delete(game_id)
+
+    keyboard = get_game_keyboard(0, 0, game_id)
+    msg_x, msg_o = await asyncio.gather(
+        context.bot.send_message(
+            chat_id=invite['chat_id'],
+            text=f"✅ {user.first_name} присоединился!\n\nВаш ход (X):",
+            reply_markup=keyboard
+        ),
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=f"Вы играете за O.\n\nХодит {invite['creator_name']} (X)...",
+            reply_markup=keyboard
+        ),
+    )
 
-    del pending_invites[game_id]
+    game['msg_id_x'] = msg_x.message_id
+    game['msg_id_o'] = msg_o.message_id
+    active_games.put(game_id, game)
+    player_games.put(game['player_x_id'], game_id)
+    player_games.put(game['player_o_id'], game_id)
 
-    keyboard = get_game_keyboard(board)
-    msg_x = await context.bot.send_message(
-        chat_id=invite['chat_id'],
-        text=f"✅ {user.first_name} присоединился!\n\nВаш ход (X):",
-        reply_markup=keyboard
-    )
-    msg_o = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"Вы играете за O.\n\nХодит {invite['creator_name']} (X)...",
-        reply_markup=keyboard
+# === Администрирование ===
+async def reload_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        return
+    if await CATALOG.reload():
+        await update.message.reply_text(f"🔄 Каталог перезагружен: {len(CATALOG.current)} товаров.")
+    else:
+        await update.message.reply_text("❌ Не удалось перезагрузить каталог, работает прежняя версия.")
+
+def collect_stats() -> dict:
+    """Сводка внутренних счётчиков для /stats"""
+    stats = {"catalog_products": len(CATALOG.current), "catalog_version": CATALOG.version}
+    stats.update(KEYBOARDS.stats())
+    stats.update(PHOTOS.stats())
+    stats.update(PROMOS.stats())
+    stats.update(SUPABASE_WRITES.stats())
+    stats.update(RATE_LIMITER.stats())
+    for name, quota in (("game_quota", GAME_QUOTA), ("promo_quota", PROMO_QUOTA)):
+        for key, value in quota.stats().items():
+            stats[f"{name}_{key}"] = value
+    stats.update(OUTGOING.stats())
+    stats.update(INGEST.stats())
+    stats.update(DEDUP.stats())
+    stats.update(INVOICES.stats())
+    stats.update(CART_VIEWS.stats())
+    stats.update(MESSAGES.stats())
+    stats.update(UPDATES.stats())
+    if RECORDER:
+        stats.update(RECORDER.stats())
+    for ns, counters in STATE.stats().items():
+        for name, value in counters.items():
+            stats[f"state_{ns}_{name}"] = value
+    return stats
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        return
+    lines = [f"{name}: {value}" for name, value in collect_stats().items()]
+    await update.message.reply_text("📊 Статистика\n\n" + "\n".join(lines))
+
+# Фоновые задачи живут всё время работы бота. Application.create_task не подходит:
+# Application.stop() ждёт завершения таких задач, а эти не завершаются сами
+BACKGROUND_TASKS = []
+
+def start_background(coro):
+    BACKGROUND_TASKS.append(asyncio.create_task(coro))
+
+async def post_init(application: Application):
+    if CATALOG_RELOAD_INTERVAL > 0:
+        start_background(CATALOG.watch(CATALOG_RELOAD_INTERVAL))
+    if STATE_FLUSH_INTERVAL > 0:
+        start_background(flush_periodically(STATE, STATE_FLUSH_INTERVAL))
+    if STATE_SWEEP_INTERVAL > 0:
+        start_background(sweep_periodically(STATE, STATE_SWEEP_INTERVAL))
+    if supabase:
+        SUPABASE_WRITES.replay_journal()
+        start_background(SUPABASE_WRITES.run())
+    if supabase and PROMO_SYNC_INTERVAL > 0:
+        start_background(PROMOS.sync_forever(PROMO_SYNC_INTERVAL))
+    if PHOTO_WARMUP_CHAT_ID:
+        start_background(PHOTOS.warm_up(application.bot, CATALOG.current, PHOTO_WARMUP_CHAT_ID))
+    if RECORDER:
+        start_background(RECORDER.flush_periodically())
+
+async def post_stop(application: Application):
+    if supabase:
+        try:
+            await asyncio.wait_for(SUPABASE_WRITES.close(), timeout=10)
+        except asyncio.TimeoutError:
+            logger.warning("Не все записи в Supabase успели сохраниться до остановки")
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    STATE.flush()
+    if RECORDER:
+        RECORDER.flush()
+
+def parse_cell(value: str) -> int:
+    cell = int(value)
+    if not 0 <= cell < 9:
+        raise ValueError(f"Нет такой клетки: {cell}")
+    return cell
+
+def parse_game_move(value: str) -> tuple:
+    """'<id партии из 8 символов><клетка>' -> (id, клетка)"""
+    if len(value) != 9:
+        raise ValueError(f"Неверный ход: {value}")
+    return value[:8], parse_cell(value[8])
+
+# === Маршруты callback-кнопок ===
+# Единственное место, где перечислены все callback_data бота
+ROUTER = CallbackRouter(instrument=METRICS.timed)
+ROUTER.exact("cart", show_cart)
+ROUTER.exact("pay_rub", send_rub_invoice)
+ROUTER.exact("enter_promo", enter_promo)
+ROUTER.exact("back_categories", back_to_categories)
+ROUTER.exact("ignore", ignore_callback)
+ROUTER.exact("ttt_game", start_ttt)
+ROUTER.exact("ttt_menu", ttt_menu, answer=False)
+ROUTER.exact("ttt_vs_bot", start_ttt)
+ROUTER.exact("ttt_vs_friend", create_ttt_game)
+ROUTER.prefix("cat_", show_category)
+ROUTER.prefix("catpage_", show_category_page, parse_category_page)
+ROUTER.prefix("back_cat_", back_to_category)
+ROUTER.prefix("view_", view_product, int)
+ROUTER.prefix("add_", cart_add, int, answer=False)
+ROUTER.prefix("inc_", cart_inc, int)
+ROUTER.prefix("dec_", cart_dec, int)
+ROUTER.prefix("del_", cart_del, int)
+ROUTER.prefix("move_", ttt_move, parse_cell, answer=False)
+ROUTER.prefix("pmove_", ttt_pvp_move, parse_game_move, answer=False)
+
+# === Исходящие запросы ===
+OUTGOING = PriorityRateLimiter(
+    overall_rate=BOT_API_RATE,
+    overall_burst=max(1, int(BOT_API_RATE)),
+    chat_rate=BOT_API_CHAT_RATE,
+    chat_burst=BOT_API_CHAT_BURST,
+    max_chat_wait=float(os.getenv("BOT_API_MAX_CHAT_WAIT", "5")),
+    metrics=METRICS,
+)
+
+# === HTTP: вебхук, здоровье, метрики ===
+async def catalog_ready() -> bool:
+    return len(CATALOG.current) > 0
+
+async def supabase_ready() -> bool:
+    if not supabase:
+        return True
+    await asyncio.to_thread(lambda: supabase.table("used_promos").select("id").limit(1).execute())
+    return True
+
+READINESS = ReadinessChecks({"catalog": catalog_ready, "supabase": supabase_ready})
+
+# Callback-кнопки игры и навигации: при перегрузке их можно потерять без вреда
+GAME_CALLBACK_PREFIXES = ("move_", "pmove_", "ttt_", "cat_", "catpage_", "back_", "view_", "ignore")
+
+def update_lane(update: Update) -> int:
+    if update.pre_checkout_query or (update.message and update.message.successful_payment):
+        return LANE_PAYMENT
+    query = update.callback_query
+    if query and query.data and query.data.startswith(GAME_CALLBACK_PREFIXES):
+        return LANE_GAME
+    return LANE_DEFAULT
+
+def update_user(update: Update):
+    """Ключ порядка в очереди вебхука: обновления одного пользователя не обгоняют друг друга"""
+    return update.effective_user.id if update.effective_user else None
+
+def update_keys(update: Update) -> list:
+    """Ключи порядка: обновления с общим ключом обрабатываются строго по очереди"""
+    keys = []
+    if update.effective_user:
+        keys.append(("user", update.effective_user.id))
+    # Ходы и вход в партию вдвоём затрагивают состояние обоих игроков
+    query = update.callback_query
+    if query and query.data and query.data.startswith("pmove_"):
+        keys.append(("game", query.data[6:14]))
+    message = update.message
+    if message and message.text and message.text.startswith("/start ttt_"):
+        keys.append(("game", message.text[11:19]))
+    return keys
+
+# Разные пользователи обрабатываются параллельно, один пользователь — по порядку
+UPDATES = KeyedUpdateProcessor(update_keys, max_concurrent_updates=int(os.getenv("CONCURRENT_UPDATES", "64")))
+
+# Вебхук только ставит обновление в очередь; из неё одновременно разбирается
+# до INGEST_MAX_IN_FLIGHT обновлений, из них обработчики выполняют не больше CONCURRENT_UPDATES
+INGEST = IngestQueue(
+    update_lane,
+    key=update_user,
+    admit=within_rate_limit,  # Сверх лимита — молча, без ответа на каждое нажатие
+    max_size=int(os.getenv("INGEST_QUEUE_SIZE", "1000")),
+    max_in_flight=int(os.getenv("INGEST_MAX_IN_FLIGHT", "1000")),
+)
+
+def build_application(ingest: IngestQueue = None) -> Application:
+    """ingest — очередь вебхука; с ней антиспам проверяется при постановке в очередь, а не обработчиком"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(OUTGOING)
+        .concurrent_updates(UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
     )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    app = builder.build()
 
-    active_games[game_id]['msg_id_x'] = msg_x.message_id
-    active_games[game_id]['msg_id_o'] = msg_o.message_id
+    # Регистрация обработчиков
+    app.add_handler(TypeHandler(Update, drop_duplicates), group=-2)
+    if ingest is None:
+        app.add_handler(TypeHandler(Update, rate_limit), group=-1)
+    timed = METRICS.timed
+    app.add_handler(CommandHandler("start", timed(start)))
+    app.add_handler(CommandHandler("tictactoe", timed(start_ttt)))
+    app.add_handler(CommandHandler("reload", timed(reload_catalog)))
+    app.add_handler(CommandHandler("stats", timed(admin_stats)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_promo_input)))
+    # Весь путь callback: разбор, ответ на query и сам обработчик маршрута (его время — отдельно)
+    app.add_handler(CallbackQueryHandler(timed(ROUTER.dispatch, "button_handler")))
+    app.add_handler(PreCheckoutQueryHandler(timed(precheckout_handler)))
+    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, timed(successful_payment_handler)))
+    return app
 
 # === Запуск ===
 if __name__ == "__main__":
     # Восстанавливаем активные промокоды из Supabase
     if supabase:
-        active_promocodes = load_active_promos()
-        logger.info(f"Загружено {len(active_promocodes)} активных промокодов")
-        
-    app = Application.builder().token(BOT_TOKEN).build()
+        try:
+            PROMOS.sync()
+            logger.info(f"Загружено {PROMOS.stats()['promos_redeemed']} погашенных промокодов")
+        except Exception as e:
+            # Бот стартует и без истории: повтор погашения всё равно отсечёт Supabase, sync_forever догрузит позже
+            logger.error(f"Не удалось загрузить погашенные промокоды: {e}")
 
-    # Регистрация обработчиков
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("tictactoe", start_ttt))
-    app.add_handler(CallbackQueryHandler(ttt_move, pattern="^move_"))
-    app.add_handler(CallbackQueryHandler(lambda u, c: u.callback_query.answer(), pattern="^ignore$"))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_promo_input))
-    app.add_handler(CallbackQueryHandler(button_handler, pattern=r"^(inc_|dec_|del_|cat_|cart|ttt_game|ttt_menu|ttt_vs_bot|ttt_vs_friend|view_|add_|pay_rub|back_|enter_promo)"))
-    app.add_handler(CallbackQueryHandler(ttt_menu, pattern="^ttt_menu$"))
-    app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
-    app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
-
-    # Запуск с вебхуком
+    app = build_application(INGEST if SHARD_INDEX is not None or WEBHOOK_URL else None)
+
+    # Запуск с вебхуком: один ASGI-сервер на цикле событий бота
     PORT = int(os.environ.get("PORT", 10000))
-    if WEBHOOK_URL:
-        # Устанавливаем вебхук и запускаем сервер
-        app.run_webhook(
-            listen="0.0.0.0",
+    if SHARD_INDEX is not None:
+        # Процесс за фронтом sharding: слушает только локальный порт
+        logger.info(f"Процесс {SHARD_INDEX} из {SHARD_COUNT}, порт {SHARD_PORT}")
+        asyncio.run(serve_worker(
+            app,
+            host="127.0.0.1",
+            port=SHARD_PORT,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            readiness=READINESS,
+            metrics=collect_stats,
+            ingest=INGEST,
+            registry=METRICS,
+            recorder=RECORDER,
+            quota=charge_quota,
+        ))
+    elif WEBHOOK_URL:
+        asyncio.run(serve(
+            app,
+            host="0.0.0.0",
             port=PORT,
-            url_path=BOT_TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}"
-        )
+            webhook_url=WEBHOOK_URL,
+            url_path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            readiness=READINESS,
+            metrics=collect_stats,
+            ingest=INGEST,
+            registry=METRICS,
+            recorder=RECORDER,
+        ))
     else:
+        if RECORDER:
+            app.add_handler(TypeHandler(Update, record_update), group=-3)
         app.run_polling()
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class Product:
+    """Неизменяемая запись о товаре"""
+    id: int
+    name: str
+    category: str
+    price_rub: int
+    description: str = ""
+    photo_url: str = ""
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "Product":
+        return cls(
+            id=int(raw["id"]),
+            name=str(raw["name"]),
+            category=str(raw["category"]),
+            price_rub=int(raw["price_rub"]),
+            description=str(raw.get("description", "")),
+            photo_url=str(raw.get("photo_url") or "").strip(),
+        )
+
+
+class Catalog:
+    """
+    Каталог товаров с индексами, построенными один раз при загрузке:
+    поиск по id и список товаров категории — O(1)
+    """
+
+    __slots__ = ("_by_id", "_by_category", "products")
+
+    def __init__(self, products):
+        by_id = {}
+        by_category = {}
+        for product in products:
+            if product.id in by_id:
+                logger.warning(f"Дубликат товара с id {product.id} — используется первый")
+                continue
+            by_id[product.id] = product
+            by_category.setdefault(product.category, []).append(product)
+
+        self.products = tuple(by_id.values())
+        self._by_id = MappingProxyType(by_id)
+        self._by_category = MappingProxyType({cat: tuple(items) for cat, items in by_category.items()})
+
+    @classmethod
+    def from_file(cls, path: str) -> "Catalog":
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        return cls(Product.from_dict(item) for item in raw)
+
+    def get(self, prod_id: int):
+        return self._by_id.get(prod_id)
+
+    def in_category(self, category: str) -> tuple:
+        return self._by_category.get(category, ())
+
+    @property
+    def categories(self):
+        return tuple(self._by_category)
+
+    def __contains__(self, prod_id) -> bool:
+        return prod_id in self._by_id
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+
+def load_catalog(path: str = "products.json") -> Catalog:
+    try:
+        return Catalog.from_file(path)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки {path}: {e}")
+        return Catalog(())
+
+
+_FAILED = object()
+
+
+class CatalogStore:
+    """
+    Держит текущий снимок каталога и подменяет его целиком при перезагрузке.
+    Индексы строятся в отдельном потоке, обработчики видят либо старый,
+    либо новый снимок — но никогда не наполовину собранный.
+    """
+
+    def __init__(self, path: str = "products.json"):
+        self.path = path
+        self.version = 0
+        self._mtime = self._stat()
+        self._listeners = []
+        self._lock = asyncio.Lock()
+        self.current = load_catalog(path)
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def on_reload(self, callback, build=None):
+        """
+        Регистрирует callback(catalog), вызываемый после каждой подмены снимка.
+        С build вызывается callback(build(catalog)), причём build выполняется в потоке
+        загрузки каталога: тяжёлые производные данные не строятся на цикле событий
+        """
+        self._listeners.append((callback, build))
+        callback(build(self.current) if build else self.current)
+
+    def _load(self, listeners):
+        catalog = Catalog.from_file(self.path)
+        prepared = []
+        for _, build in listeners:
+            if build is None:
+                prepared.append(catalog)
+                continue
+            try:
+                prepared.append(build(catalog))
+            except Exception as e:
+                logger.error(f"Ошибка подготовки данных при перезагрузке каталога: {e}")
+                prepared.append(_FAILED)
+        return catalog, prepared
+
+    async def reload(self) -> bool:
+        async with self._lock:
+            mtime = self._stat()
+            listeners = list(self._listeners)
+            try:
+                catalog, prepared = await asyncio.to_thread(self._load, listeners)
+            except Exception as e:
+                logger.error(f"Каталог не перезагружен, остаётся прежний: {e}")
+                return False
+
+            self._mtime = mtime
+            self.version += 1
+            self.current = catalog
+            for (callback, _), value in zip(listeners, prepared):
+                if value is _FAILED:
+                    continue
+                try:
+                    callback(value)
+                except Exception as e:
+                    logger.error(f"Ошибка обработчика перезагрузки каталога: {e}")
+            logger.info(f"Каталог перезагружен: {len(catalog)} товаров (версия {self.version})")
+            return True
+
+    async def watch(self, interval: float = 30.0):
+        """Фоновая задача: перезагружает каталог при изменении файла"""
+        while True:
+            await asyncio.sleep(interval)
+            if self._stat() != self._mtime:
+                await self.reload()
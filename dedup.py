@@ -0,0 +1,35 @@
+class UpdateDeduplicator:
+    """
+    Окно последних update_id: кольцевой буфер фиксированного размера плюс
+    множество для проверки за O(1). Новый id вытесняет самый старый.
+
+    Повтором считается только id из окна. Сравнивать с вытесненными
+    по величине нельзя: Telegram может начать нумерацию заново (после
+    смены вебхука или долгого простоя), и все новые обновления
+    оказались бы «старыми».
+    """
+
+    __slots__ = ("window", "_ring", "_pos", "_seen", "duplicates")
+
+    def __init__(self, window: int = 4096):
+        self.window = window
+        self._ring = [None] * window
+        self._pos = 0
+        self._seen = set()
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id: int) -> bool:
+        """Отмечает update_id как увиденный; True — он уже встречался"""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        old = self._ring[self._pos]
+        if old is not None:
+            self._seen.discard(old)
+        self._ring[self._pos] = update_id
+        self._pos = (self._pos + 1) % self.window
+        self._seen.add(update_id)
+        return False
+
+    def stats(self) -> dict:
+        return {"dedup_duplicates": self.duplicates, "dedup_tracked": len(self._seen)}
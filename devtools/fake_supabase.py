@@ -0,0 +1,182 @@
+"""
+Локальная заглушка Supabase REST (PostgREST) для отладки и нагрузочных тестов.
+
+Поддерживает ровно то, что использует бот:
+  POST /rest/v1/<table>            — insert/upsert одной строки или списка
+  GET  /rest/v1/<table>?id=gt.N&order=id&limit=N — чтение used_promos
+
+Уникальные колонки (по умолчанию used_promos.code и orders.telegram_payment_charge_id)
+проверяются при вставке:
+повтор — 409 с кодом Postgres 23505, как у настоящего PostgREST.
+
+Запуск:
+  python -m devtools.fake_supabase --port 54321 --latency 0.05 --fail-rate 0.1
+
+Бот подключается через SUPABASE_URL=http://127.0.0.1:54321
+и SUPABASE_KEY=fake.fake.fake (клиент проверяет только формат ключа).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+UNIQUE_COLUMNS = {"used_promos": ("code",), "orders": ("telegram_payment_charge_id",)}
+
+
+class UniqueViolation(Exception):
+    pass
+
+
+class CardinalityViolation(Exception):
+    pass
+
+
+class FakeSupabase:
+    def __init__(self, latency: float = 0.0, fail_rate: float = 0.0, unique: dict = None):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.unique = UNIQUE_COLUMNS if unique is None else unique
+        self.tables = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def insert(self, table: str, rows, upsert: bool = False):
+        if upsert:
+            ids = [row.get("id") for row in rows if "id" in row]
+            if len(ids) != len(set(ids)):
+                # Как Postgres: ON CONFLICT DO UPDATE не может изменить одну строку дважды
+                raise CardinalityViolation("ON CONFLICT DO UPDATE command cannot affect row a second time")
+        with self._lock:
+            stored = self.tables.setdefault(table, [])
+            # Вся пачка отклоняется целиком, как одна транзакция PostgREST
+            for column in self.unique.get(table, ()):
+                taken = {existing.get(column) for existing in stored}
+                for row in rows:
+                    if row.get(column) in taken:
+                        raise UniqueViolation(f"duplicate key value violates unique constraint on {table}.{column}")
+                    taken.add(row.get(column))
+            for row in rows:
+                row = dict(row)
+                if upsert and "id" in row:
+                    for existing in stored:
+                        if existing.get("id") == row["id"]:
+                            existing.update(row)
+                            break
+                    else:
+                        stored.append(row)
+                    continue
+                row.setdefault("id", self._next_id)
+                self._next_id += 1
+                stored.append(row)
+            return rows
+
+    def select(self, table: str, params: dict):
+        with self._lock:
+            rows = list(self.tables.get(table, []))
+        for column, values in params.items():
+            if column in ("select", "order", "limit"):
+                continue
+            op, _, value = values[0].partition(".")
+            if op == "gt":
+                rows = [r for r in rows if r.get(column, 0) > int(value)]
+            elif op == "eq":
+                rows = [r for r in rows if str(r.get(column)) == value]
+        if "order" in params:
+            column = params["order"][0].split(".")[0]
+            rows.sort(key=lambda r: r.get(column, 0))
+        if "limit" in params:
+            rows = rows[:int(params["limit"][0])]
+        return rows
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _table(self):
+                path = urlparse(self.path).path
+                prefix = "/rest/v1/"
+                return path[len(prefix):] if path.startswith(prefix) else None
+
+            def _reply(self, status: int, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _simulate(self) -> bool:
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.fail_rate and random.random() < fake.fail_rate:
+                    self._reply(503, {"message": "injected failure"})
+                    return False
+                return True
+
+            def do_GET(self):
+                table = self._table()
+                if table is None:
+                    self._reply(404, {"message": "not found"})
+                    return
+                if self._simulate():
+                    self._reply(200, fake.select(table, parse_qs(urlparse(self.path).query)))
+
+            def do_POST(self):
+                table = self._table()
+                if table is None:
+                    self._reply(404, {"message": "not found"})
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"[]")
+                rows = payload if isinstance(payload, list) else [payload]
+                upsert = "merge-duplicates" in self.headers.get("Prefer", "")
+                if self._simulate():
+                    try:
+                        self._reply(201, fake.insert(table, rows, upsert=upsert))
+                    except UniqueViolation as e:
+                        self._reply(409, {"code": "23505", "message": str(e), "details": None, "hint": None})
+                    except CardinalityViolation as e:
+                        self._reply(500, {"code": "21000", "message": str(e), "details": None, "hint": None})
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+        return Handler
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0):
+        """Запускает сервер в фоновом потоке, возвращает (server, base_url)"""
+        server = ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Supabase REST")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+
+    fake = FakeSupabase(latency=args.latency, fail_rate=args.fail_rate)
+    server = ThreadingHTTPServer((args.host, args.port), fake.make_handler())
+    print(f"Fake Supabase слушает http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
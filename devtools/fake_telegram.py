@@ -0,0 +1,170 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов и бенчмарков.
+
+Отвечает на любые методы POST /bot<token>/<method> правдоподобным
+результатом: getMe — описание бота, send*/edit* — сообщение,
+остальное — true. Последний счёт и последний текст в каждый чат
+запоминаются (invoices, texts) — по ним нагрузочный тест продолжает
+сценарий: оплачивает счёт, переходит по ссылке-приглашению.
+Считает вызовы по методам:
+  GET  /stats — {"calls": {метод: число}, "total": N}
+  POST /reset — обнулить счётчики
+
+Запуск:
+  python -m devtools.fake_telegram --port 8081 --latency 0.05
+
+Бот подключается через BOT_API_BASE_URL=http://127.0.0.1:8081/bot
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Fake",
+    "username": "fake_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+# Методы, в ответ на которые Telegram присылает сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendInvoice",
+    "editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup",
+}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.invoices = {}  # chat_id -> параметры последнего sendInvoice
+        self.texts = {}     # chat_id -> текст последнего sendMessage
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+
+    def call(self, method: str, params: dict):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method == "sendInvoice":
+                self.invoices[params.get("chat_id")] = params
+            elif method == "sendMessage":
+                self.texts[params.get("chat_id")] = params.get("text", "")
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return []
+        if method in MESSAGE_METHODS:
+            message_id = next(self._message_ids)
+            message = {
+                "message_id": params.get("message_id") or message_id,
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id") or 0, "type": "private"},
+                "from": BOT_USER,
+            }
+            if method in ("sendPhoto", "editMessageMedia"):
+                message["photo"] = [{"file_id": f"fake-photo-{message_id}", "file_unique_id": f"u{message_id}", "width": 1, "height": 1}]
+            elif "text" in params:
+                message["text"] = params["text"]
+            return message
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = dict(self.calls)
+        return {"calls": calls, "total": sum(calls.values())}
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.invoices.clear()
+            self.texts.clear()
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive: клиент бота держит соединения открытыми
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status: int, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _params(self) -> dict:
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length) if length else b""
+                if not raw:
+                    return {}
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    return json.loads(raw)
+                # PTB передаёт параметры формой, сложные значения — строками JSON
+                params = {}
+                for key, values in parse_qs(raw.decode("utf-8")).items():
+                    try:
+                        params[key] = json.loads(values[0])
+                    except ValueError:
+                        params[key] = values[0]
+                return params
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self._reply(200, fake.stats())
+                else:
+                    self._reply(404, {"ok": False, "description": "Not Found"})
+
+            def do_POST(self):
+                if self.path == "/reset":
+                    self._params()
+                    fake.reset()
+                    self._reply(200, {"ok": True})
+                    return
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 2 or not parts[0].startswith("bot"):
+                    self._reply(404, {"ok": False, "description": "Not Found"})
+                    return
+                params = self._params()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                self._reply(200, {"ok": True, "result": fake.call(parts[1], params)})
+
+        return Handler
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0):
+        """Запускает сервер в фоновом потоке, возвращает (server, base_url)"""
+        server = ThreadingHTTPServer((host, port), self.make_handler())
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, с")
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency)
+    server = ThreadingHTTPServer((args.host, args.port), fake.make_handler())
+    server.daemon_threads = True
+    print(f"Fake Bot API слушает http://{args.host}:{args.port}/bot")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Полосы очереди: меньшее число — выше приоритет
+LANE_PAYMENT = 0  # pre_checkout_query, successful_payment — не отбрасываются никогда
+LANE_DEFAULT = 1  # команды, сообщения, корзина
+LANE_GAME = 2     # игра и навигация по меню — отбрасываются первыми
+LANE_NAMES = ("payment", "default", "game")
+
+
+class IngestQueue:
+    """
+    Ограниченная очередь входящих обновлений.
+    Вебхук только кладёт обновление в очередь и сразу отвечает Telegram 200,
+    поэтому медленные обработчики не задерживают ответ и не вызывают повторных доставок.
+    Каждое обновление из очереди обрабатывается своей задачей, одновременно —
+    не больше max_in_flight: обновление, ждущее предыдущее обновление того же
+    пользователя, не держит разбор очереди для остальных.
+
+    При переполнении нагрузка сбрасывается по полосам: новое обновление
+    вытесняет самое свежее из менее важной полосы, а если такого нет —
+    отбрасывается само. Платежи принимаются всегда, даже сверх max_size.
+
+    Обновления одного ключа (key, обычно пользователь) разбираются строго
+    в порядке поступления: пока у ключа есть обновления в очереди, все они
+    лежат в одной полосе. Более важное обновление поднимает уже ждущие
+    обновления своего ключа в свою полосу, менее важное встаёт за ними.
+
+    admit — проверка до постановки в очередь (антиспам): не прошедшее её
+    обновление отбрасывается молча, не занимая ни места в очереди, ни слота обработки.
+    """
+
+    def __init__(self, classify, key=None, admit=None, max_size: int = 1000, max_in_flight: int = 1000):
+        self._classify = classify  # update -> номер полосы
+        self._key = key  # update -> ключ порядка или None
+        self._admit = admit  # update -> bool
+        self.max_size = max_size
+        self.max_in_flight = max_in_flight
+        self._lanes = [deque() for _ in LANE_NAMES]  # (update, enqueued_at, key)
+        self._pending = {}  # ключ -> [полоса, обновлений в очереди]
+        self._size = 0
+        self._ready = asyncio.Event()
+        self._dispatcher = None
+        self._slots = None
+        self._tasks = set()
+        self._process = None
+        self._busy = 0
+        self.accepted = [0] * len(LANE_NAMES)
+        self.shed = [0] * len(LANE_NAMES)
+        self.throttled = 0
+        self.processed = 0
+        self.max_wait = 0.0
+
+    def submit(self, update) -> bool:
+        """Кладёт обновление в очередь; False — обновление отброшено"""
+        if self._admit is not None and not self._admit(update):
+            self.throttled += 1
+            return False
+        lane = self._classify(update)
+        key = self._key(update) if self._key else None
+        pending = self._pending.get(key) if key is not None else None
+        if self._size >= self.max_size and lane != LANE_PAYMENT:
+            # Ждущие обновления ключа тоже в очереди: встаём в их полосу, если она важнее
+            target = min(lane, pending[0]) if pending else lane
+            if not self._evict_below(target):
+                self._shed(lane)
+                return False
+            pending = self._pending.get(key) if key is not None else None  # Вытеснение могло опустошить ключ
+        if pending is None:
+            if key is not None:
+                self._pending[key] = [lane, 1]
+        else:
+            if lane < pending[0]:
+                self._promote(key, pending[0], lane)
+                pending[0] = lane
+            lane = pending[0]
+            pending[1] += 1
+        self._lanes[lane].append((update, time.monotonic(), key))
+        self._size += 1
+        self.accepted[lane] += 1
+        self._ready.set()
+        return True
+
+    def _promote(self, key, source: int, target: int):
+        """Переносит ждущие обновления ключа в более важную полосу, сохраняя их порядок"""
+        moving = [item for item in self._lanes[source] if item[2] == key]
+        self._lanes[source] = deque(item for item in self._lanes[source] if item[2] != key)
+        self._lanes[target].extend(moving)
+
+    def _release(self, key):
+        if key is None:
+            return
+        pending = self._pending[key]
+        pending[1] -= 1
+        if not pending[1]:
+            del self._pending[key]
+
+    def _evict_below(self, lane: int) -> bool:
+        for victim in range(len(self._lanes) - 1, lane, -1):
+            if self._lanes[victim]:
+                # Самое свежее обновление полосы: более ранние обновления его ключа остаются по порядку
+                _, _, key = self._lanes[victim].pop()
+                self._release(key)
+                self._shed(victim)
+                self._size -= 1
+                return True
+        return False
+
+    def _shed(self, lane: int):
+        self.shed[lane] += 1
+        logger.warning(f"Очередь обновлений переполнена ({self._size}), отброшено обновление полосы {LANE_NAMES[lane]}")
+
+    def _take(self):
+        for lane in self._lanes:
+            if lane:
+                self._size -= 1
+                item = lane.popleft()
+                self._release(item[2])
+                return item
+        return None
+
+    async def _dispatch(self):
+        while True:
+            # Свободный слот — до того, как обновление покинет очередь:
+            # пока слотов нет, оно остаётся в своей полосе и может быть вытеснено
+            await self._slots.acquire()
+            item = self._take()
+            while item is None:
+                self._ready.clear()
+                await self._ready.wait()
+                item = self._take()
+            update, enqueued_at, _ = item
+            self.max_wait = max(self.max_wait, time.monotonic() - enqueued_at)
+            self._busy += 1
+            # Задачи создаются в порядке очереди и сразу встают в очередь своего ключа
+            task = asyncio.create_task(self._run(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, update):
+        try:
+            await self._process(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления: {e}")
+        finally:
+            self._busy -= 1
+            self.processed += 1
+            self._slots.release()
+
+    def start(self, process):
+        """process — корутина обработки одного обновления"""
+        self._process = process
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается разбора очереди (не дольше timeout) и останавливает обработчики"""
+        deadline = time.monotonic() + timeout
+        while (self._size or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._size:
+            logger.warning(f"Остановка с необработанными обновлениями: {self._size}")
+        tasks = [self._dispatcher, *self._tasks] if self._dispatcher is not None else list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._tasks.clear()
+
+    def stats(self) -> dict:
+        stats = {
+            "ingest_queue_depth": self._size,
+            "ingest_in_flight": self._busy,
+            "ingest_processed": self.processed,
+            "ingest_throttled": self.throttled,
+            "ingest_max_wait_ms": round(self.max_wait * 1000, 1),
+        }
+        for lane, name in enumerate(LANE_NAMES):
+            stats[f"ingest_{name}_depth"] = len(self._lanes[lane])
+            stats[f"ingest_{name}_accepted"] = self.accepted[lane]
+            stats[f"ingest_{name}_shed"] = self.shed[lane]
+        return stats
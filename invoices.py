@@ -0,0 +1,108 @@
+import time
+import uuid
+from dataclasses import asdict, dataclass
+
+PAYLOAD_PREFIX = "inv_"
+
+
+@dataclass(frozen=True, slots=True)
+class InvoiceLine:
+    product_id: int
+    name: str
+    price_rub: int
+    qty: int
+
+
+@dataclass(frozen=True, slots=True)
+class Invoice:
+    """Снимок заказа на момент выставления счёта: состав, цены и промокод"""
+    payload: str
+    user_id: int
+    lines: tuple
+    promo: str = None
+    discount_rub: int = 0
+    created_at: float = 0.0
+
+    @property
+    def subtotal_rub(self) -> int:
+        return sum(line.price_rub * line.qty for line in self.lines)
+
+    @property
+    def total_rub(self) -> int:
+        return max(self.subtotal_rub - self.discount_rub, 0)
+
+    @property
+    def total_kopecks(self) -> int:
+        return self.total_rub * 100
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Invoice":
+        lines = tuple(InvoiceLine(**line) for line in data["lines"])
+        return cls(**{**data, "lines": lines})
+
+
+class InvoiceStore:
+    """
+    Снимки выставленных счетов под уникальным payload.
+    Pre-checkout и обработчик оплаты сверяются со снимком, а не с текущей
+    корзиной: изменения корзины после выставления счёта на оплату не влияют.
+    store — пространство имён StateBackend со сроком жизни счёта.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self.created = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def create(self, user_id: int, cart: dict, catalog, promo: str = None, discount_rub: int = 0) -> Invoice:
+        lines = []
+        for pid, qty in cart.items():
+            product = catalog.get(pid)
+            if product:
+                lines.append(InvoiceLine(product.id, product.name, product.price_rub, qty))
+        invoice = Invoice(
+            payload=f"{PAYLOAD_PREFIX}{uuid.uuid4().hex}",
+            user_id=user_id,
+            lines=tuple(lines),
+            promo=promo if discount_rub else None,
+            discount_rub=discount_rub,
+            created_at=time.time(),
+        )
+        self._store.put(invoice.payload, invoice.to_dict())
+        self.created += 1
+        return invoice
+
+    def get(self, payload: str):
+        if not payload or not payload.startswith(PAYLOAD_PREFIX):
+            return None
+        data = self._store.get(payload)
+        return Invoice.from_dict(data) if data else None
+
+    def check(self, payload: str, user_id: int, currency: str, total_amount: int):
+        """(Invoice, None) если оплата совпадает со снимком, иначе (None, причина)"""
+        invoice = self.get(payload)
+        if invoice is None:
+            error = "Счёт устарел. Оформите заказ заново."
+        elif invoice.user_id != user_id:
+            error = "Счёт выставлен другому пользователю."
+        elif currency != "RUB" or total_amount != invoice.total_kopecks:
+            error = "Сумма не совпадает со счётом."
+        else:
+            return invoice, None
+        self.rejected += 1
+        return None, error
+
+    def complete(self, payload: str):
+        self._store.delete(payload)
+        self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            "invoices_created": self.created,
+            "invoices_rejected": self.rejected,
+            "invoices_completed": self.completed,
+        }
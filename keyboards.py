@@ -0,0 +1,154 @@
+import logging
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Telegram принимает не больше 100 кнопок в разметке: длинные категории листаются
+CATEGORY_PAGE_SIZE = 50
+MAX_CATEGORY_PAGES = 100  # Номер страницы в callback_data — две цифры
+
+
+def _build_category_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("👕 Одежда", callback_data="cat_clothing")],
+        [InlineKeyboardButton("👟 Обувь", callback_data="cat_shoes")],
+        [InlineKeyboardButton("👜 Аксессуары", callback_data="cat_accessories")],
+        [InlineKeyboardButton("🛒 Корзина", callback_data="cart")],
+        [InlineKeyboardButton("↓↓ Игры ↓↓", callback_data="ignore")],
+        [InlineKeyboardButton("🎮 Крестики-нолики", callback_data="ttt_menu")]
+    ])
+
+
+def _build_back_kb():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
+    ])
+
+
+def _build_ttt_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("С ботом", callback_data="ttt_vs_bot")],
+        [InlineKeyboardButton("С другом", callback_data="ttt_vs_friend")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")]
+    ])
+
+
+def category_page_data(category: str, page: int) -> str:
+    """callback_data страницы категории: первая — прежний cat_<категория>"""
+    return f"cat_{category}" if page == 0 else f"catpage_{page:02d}{category}"
+
+
+def parse_category_page(value: str) -> tuple:
+    """'<номер страницы из 2 цифр><категория>' -> (категория, страница)"""
+    if len(value) < 3:
+        raise ValueError(f"Неверная страница категории: {value}")
+    return value[2:], int(value[:2])
+
+
+def _build_category_kb(category, items, page, pages):
+    buttons = [[InlineKeyboardButton(p.name, callback_data=f"view_{p.id}")] for p in items]
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=category_page_data(category, page - 1)))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="ignore"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=category_page_data(category, page + 1)))
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_categories")])
+    return InlineKeyboardMarkup(buttons)
+
+
+def _build_board_kb(board, move_prefix):
+    keyboard = []
+    for row in range(3):
+        buttons = []
+        for col in range(3):
+            idx = row * 3 + col
+            text = board[idx] if board[idx] != " " else " "
+            callback = f"{move_prefix}{idx}" if board[idx] == " " else "ignore"
+            buttons.append(InlineKeyboardButton(text, callback_data=callback))
+        keyboard.append(buttons)
+    return InlineKeyboardMarkup(keyboard)
+
+
+class KeyboardCache:
+    """
+    Готовые InlineKeyboardMarkup: статические меню строятся один раз,
+    клавиатуры категорий (постранично) — при каждой загрузке каталога,
+    в том же потоке, что и сам каталог (CatalogStore.on_reload с build),
+    доски игры с ботом — по требованию с вытеснением по LRU.
+    Доски партий вдвоём не кэшируются: в их callback_data id партии,
+    повторно такая разметка не нужна и только вытесняла бы общие доски.
+    Разметка в PTB неизменяемая, поэтому объекты можно отдавать повторно.
+    """
+
+    def __init__(self, max_boards: int = 1024, category_page_size: int = CATEGORY_PAGE_SIZE):
+        self.max_boards = max_boards
+        self.category_page_size = category_page_size
+        self.category_menu = _build_category_menu()
+        self.back_kb = _build_back_kb()
+        self.ttt_menu = _build_ttt_menu()
+        self._categories = {}  # категория -> кортеж страниц
+        self._boards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def build_categories(self, catalog) -> dict:
+        """Строит клавиатуры категорий, не трогая кэш: можно вызывать из другого потока"""
+        size = self.category_page_size
+        categories = {}
+        for cat in catalog.categories:
+            items = catalog.in_category(cat)
+            pages = -(-len(items) // size)
+            if pages > MAX_CATEGORY_PAGES:
+                logger.warning(f"В категории {cat} {len(items)} товаров: в меню попадут первые {MAX_CATEGORY_PAGES * size}")
+                pages = MAX_CATEGORY_PAGES
+            categories[cat] = tuple(
+                _build_category_kb(cat, items[page * size:(page + 1) * size], page, pages) for page in range(pages)
+            )
+        return categories
+
+    def set_categories(self, categories: dict):
+        """Подменяет клавиатуры категорий построенными build_categories"""
+        self._categories = categories
+
+    def category(self, category: str, page: int = 0):
+        """Клавиатура страницы категории или None, если категория пуста"""
+        pages = self._categories.get(category)
+        if pages is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Каталог мог уменьшиться, пока у пользователя открыта дальняя страница
+        return pages[min(page, len(pages) - 1)]
+
+    def board(self, board):
+        key = "".join(board)
+        markup = self._boards.get(key)
+        if markup is not None:
+            self.hits += 1
+            self._boards.move_to_end(key)
+            return markup
+
+        self.misses += 1
+        markup = _build_board_kb(board, "move_")
+        self._boards[key] = markup
+        if len(self._boards) > self.max_boards:
+            self._boards.popitem(last=False)
+        return markup
+
+    @staticmethod
+    def pvp_board(board, game_id: str):
+        """Доска партии вдвоём: id партии — в callback_data свободных клеток"""
+        return _build_board_kb(board, f"pmove_{game_id}")
+
+    def stats(self) -> dict:
+        return {
+            "keyboard_cache_hits": self.hits,
+            "keyboard_cache_misses": self.misses,
+            "keyboard_cache_boards": len(self._boards),
+            "keyboard_cache_categories": len(self._categories),
+        }
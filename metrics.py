@@ -0,0 +1,181 @@
+import bisect
+import functools
+import threading
+import time
+
+# Границы корзин гистограмм задержки, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._started)
+        return False
+
+
+class Histogram:
+    """Одна серия гистограммы: счётчики по корзинам, сумма и число наблюдений"""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()  # Supabase вызывается и из потоков to_thread
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        """with histogram.time(): ... — наблюдение длительности блока"""
+        return _Timer(self)
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class _Family:
+    """Метрика с метками: серия на каждый набор значений меток создаётся при первом обращении"""
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._series = {}
+
+    def _new(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        series = self._series.get(values)
+        if series is None:
+            series = self._series.setdefault(values, self._new())
+        return series
+
+    def render(self, prefix: str) -> list:
+        name = prefix + self.name
+        lines = [f"# HELP {name} {self.help}", f"# TYPE {name} {self.kind}"]
+        for values, series in sorted(self._series.items()):
+            lines.extend(self._render_series(name, values, series))
+        return lines
+
+
+class HistogramFamily(_Family):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+
+    def _new(self):
+        return Histogram(self.buckets)
+
+    def _render_series(self, name, values, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            bucket_label = f'le="{le}"'
+            lines.append(f"{name}_bucket{_label_text(self.labelnames, values, bucket_label)} {cumulative}")
+        labels = _label_text(self.labelnames, values)
+        lines.append(f"{name}_sum{labels} {series.sum}")
+        lines.append(f"{name}_count{labels} {series.count}")
+        return lines
+
+
+class CounterFamily(_Family):
+    kind = "counter"
+
+    def _new(self):
+        return Counter()
+
+    def _render_series(self, name, values, series):
+        return [f"{name}{_label_text(self.labelnames, values)} {series.value}"]
+
+
+class MetricsRegistry:
+    """
+    Гистограммы задержек и счётчики с метками в формате Prometheus.
+    Наблюдение — бинарный поиск корзины и пара сложений, так что реестр
+    можно держать включённым всегда. Плоские счётчики из collect_stats
+    по-прежнему отдаёт server.render_metrics, реестр дописывается после них.
+    """
+
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, cls, name, help_text, labelnames, **kwargs):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = cls(name, help_text, tuple(labelnames), **kwargs)
+        return family
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets: tuple = DEFAULT_BUCKETS) -> HistogramFamily:
+        return self._family(HistogramFamily, name, help_text, labelnames, buckets=buckets)
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> CounterFamily:
+        return self._family(CounterFamily, name, help_text, labelnames)
+
+    def timed(self, handler, name: str = None):
+        """Обёртка асинхронного обработчика: задержка и число исключений по имени обработчика"""
+        latency = self.histogram("handler_latency_seconds", "Время обработки по обработчикам", ("handler",))
+        errors = self.counter("handler_errors_total", "Исключения в обработчиках", ("handler",))
+        name = name or handler.__name__
+        series = latency.labels(name)
+        failures = errors.labels(name)
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                failures.inc()
+                raise
+            finally:
+                series.observe(time.perf_counter() - started)
+        return wrapper
+
+    def render(self, prefix: str = "shop_") -> str:
+        lines = []
+        for family in self._families.values():
+            lines.extend(family.render(prefix))
+        return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,88 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class KeyedLocks:
+    """
+    Замки по ключу (пользователь, партия), создаваемые по требованию.
+    Замок удаляется, как только его никто не держит и не ждёт,
+    так что память пропорциональна числу одновременно активных ключей.
+    """
+
+    def __init__(self):
+        self._locks = {}  # key -> [asyncio.Lock, число держащих и ждущих]
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, keys):
+        # Единый порядок захвата исключает взаимную блокировку при нескольких ключах
+        keys = sorted(set(keys))
+        registered = []
+        held = []
+        try:
+            for key in keys:
+                entry = self._locks.get(key)
+                if entry is None:
+                    entry = self._locks[key] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                registered.append(entry)
+                if entry[0].locked():
+                    self.contended += 1
+                await entry[0].acquire()
+                held.append(entry)
+            yield
+        finally:
+            for entry in reversed(held):
+                entry[0].release()
+            for key, entry in zip(keys, registered):
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка внутри ключа:
+    обновления одного пользователя (и одной партии) идут строго по очереди,
+    разных — одновременно, но не больше max_concurrent_updates сразу.
+    key_func(update) возвращает ключи обновления; пустой набор — без замков.
+    """
+
+    def __init__(self, key_func, max_concurrent_updates: int = 64):
+        super().__init__(max_concurrent_updates)
+        self._key_func = key_func
+        self.locks = KeyedLocks()
+        self.in_flight = 0
+
+    async def process_update(self, update, coroutine):
+        # Сначала очередь своего ключа, потом общий слот: обновления, ждущие
+        # предыдущее обновление того же пользователя, не занимают слоты
+        # max_concurrent_updates и не задерживают остальных пользователей
+        async with self.locks.hold(self._key_func(update)):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        self.in_flight += 1
+        try:
+            await coroutine
+        finally:
+            self.in_flight -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "updates_in_flight": self.in_flight,
+            "ordering_active_keys": len(self.locks),
+            "ordering_contended": self.locks.contended,
+        }
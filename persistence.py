@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+UNIQUE_VIOLATION = "23505"  # код ошибки Postgres: нарушено ограничение уникальности
+
+
+class WriteBehindQueue:
+    """
+    Отложенная запись в Supabase.
+    Обработчики только кладут строку в очередь и сразу продолжают работу;
+    фоновый воркер собирает пачки, вставляет их одним запросом на таблицу
+    в отдельном потоке, повторяет с экспоненциальной задержкой, а если
+    Supabase недоступен — дописывает строки в локальный журнал (JSONL),
+    который переигрывается при следующем успешном сбросе или старте.
+
+    keys — уникальная колонка таблицы (для upsert — ключ конфликта, по
+    умолчанию id). Повторять можно только идемпотентные записи: upsert и
+    вставку в таблицу с ключом, где повтор уже прошедшей вставки даёт
+    конфликт уникальности. Вставка без ключа делается один раз — после
+    таймаута неизвестно, записана ли она, и повтор мог бы её задвоить.
+    """
+
+    def __init__(
+        self,
+        supabase,
+        journal_path: str = "supabase_journal.jsonl",
+        max_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 0.5,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        keys: dict = None,
+        metrics=None,
+    ):
+        self._supabase = supabase
+        self.keys = keys or {}
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._journal_pending = os.path.exists(journal_path)
+
+        self.flushed_rows = 0
+        self.spilled_rows = 0
+        self.dropped_rows = 0
+        self.retries = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._latency = None
+        if metrics is not None:
+            self._latency = metrics.histogram(
+                "supabase_latency_seconds", "Время запроса к Supabase по таблицам", ("table", "op", "status"))
+
+    def submit(self, table: str, op: str, row: dict):
+        """Ставит запись в очередь. op — "insert" или "upsert" """
+        item = (table, op, row)
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning(f"Очередь записи в Supabase переполнена, строка {table} ушла в журнал")
+            self._spill([item])
+
+    async def run(self):
+        """Фоновый воркер: сбрасывает очередь пачками"""
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # Например, журнал не записался: пачка потеряна, но воркер продолжает работу
+                logger.error(f"Не удалось сбросить {len(batch)} записей в Supabase: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def close(self):
+        """Дожидается сброса уже поставленных записей (при остановке бота)"""
+        await self._queue.join()
+
+    async def _flush(self, batch):
+        # Группируем по (таблица, операция), сохраняя порядок первого появления:
+        # customers должен попасть в базу раньше orders
+        groups = {}
+        for table, op, row in batch:
+            groups.setdefault((table, op), []).append(row)
+
+        started = time.monotonic()
+        ok = True
+        for (table, op), rows in groups.items():
+            if op == "upsert":
+                rows = self._collapse(table, rows)
+            retryable = op == "upsert" or table in self.keys
+            if await self._execute_with_retry(table, op, rows, self.max_retries if retryable else 1):
+                self.flushed_rows += len(rows)
+            elif retryable:
+                ok = False
+                self._spill([(table, op, row) for row in rows])
+            else:
+                ok = False
+                self.dropped_rows += len(rows)
+                logger.error(f"Вставка {len(rows)} строк в {table} без ключа идемпотентности не удалась, строки не повторяются")
+
+        self.last_flush_ms = (time.monotonic() - started) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        if ok and self._journal_pending:
+            self.replay_journal()
+
+    def _collapse(self, table, rows) -> list:
+        """Upsert не может изменить одну строку дважды за запрос (Postgres 21000): остаётся последняя версия"""
+        key = self.keys.get(table, "id")
+        latest = {}
+        for row in rows:
+            latest[row.get(key)] = row
+        return list(latest.values())
+
+    async def _execute_with_retry(self, table, op, rows, attempts: int) -> bool:
+        for attempt in range(attempts):
+            try:
+                await asyncio.to_thread(self._execute, table, op, rows)
+                return True
+            except Exception as e:
+                if getattr(e, "code", None) == UNIQUE_VIOLATION:
+                    return await self._skip_existing(table, op, rows, e, attempts)
+                if attempt + 1 >= attempts:
+                    logger.warning(f"Ошибка записи в {table} (попытка {attempt + 1}): {e}")
+                    break
+                self.retries += 1
+                delay = self.base_delay * (2 ** attempt)
+                logger.warning(f"Ошибка записи в {table} (попытка {attempt + 1}): {e}. Повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+        return False
+
+    async def _skip_existing(self, table, op, rows, error, attempts: int) -> bool:
+        """Конфликт уникальности не исчезнет при повторе: строка уже в базе (например, погашение промокода)"""
+        if len(rows) == 1:
+            logger.warning(f"Строка уже есть в {table}, пропущена: {error}")
+            return True
+        # В пачке есть уже записанная строка — остальные пишутся по одной
+        results = [await self._execute_with_retry(table, op, [row], attempts) for row in rows]
+        return all(results)
+
+    def _execute(self, table, op, rows):
+        query = self._supabase.table(table)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            if op == "upsert":
+                query.upsert(rows).execute()
+            else:
+                query.insert(rows).execute()
+            status = "ok"
+        finally:
+            if self._latency is not None:
+                self._latency.labels(table, op, status).observe(time.perf_counter() - started)
+
+    def _spill(self, items):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            for table, op, row in items:
+                f.write(json.dumps({"table": table, "op": op, "row": row}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.spilled_rows += len(items)
+        self._journal_pending = True
+
+    def replay_journal(self) -> int:
+        """Возвращает строки из журнала в очередь. Журнал удаляется после чтения"""
+        if not os.path.exists(self.journal_path):
+            self._journal_pending = False
+            return 0
+        replay_path = f"{self.journal_path}.replay"
+        os.replace(self.journal_path, replay_path)
+        self._journal_pending = False
+
+        items = []
+        with open(replay_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.error(f"Повреждённая строка журнала пропущена: {line[:100]}")
+                    continue
+                items.append((entry["table"], entry["op"], entry["row"]))
+
+        requeued = 0
+        for i, item in enumerate(items):
+            try:
+                self._queue.put_nowait(item)
+                requeued += 1
+            except asyncio.QueueFull:
+                self._spill(items[i:])
+                break
+        os.remove(replay_path)
+        if requeued:
+            logger.info(f"Из журнала возвращено в очередь {requeued} записей")
+        return requeued
+
+    def stats(self) -> dict:
+        return {
+            "supabase_queue_depth": self._queue.qsize(),
+            "supabase_flushed_rows": self.flushed_rows,
+            "supabase_spilled_rows": self.spilled_rows,
+            "supabase_dropped_rows": self.dropped_rows,
+            "supabase_retries": self.retries,
+            "supabase_last_flush_ms": round(self.last_flush_ms, 1),
+            "supabase_max_flush_ms": round(self.max_flush_ms, 1),
+        }
@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+    """
+    Кэш Telegram file_id для фото товаров.
+    После первой успешной отправки фото по URL Telegram возвращает file_id —
+    дальше отправляем его, и Telegram не скачивает картинку заново.
+    Запись привязана к photo_url: при смене URL она перестаёт действовать.
+    """
+
+    def __init__(self, path: str = "photo_cache.json"):
+        self.path = path
+        self._entries = {}  # product_id -> {"url": ..., "file_id": ...}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self._entries = {int(pid): entry for pid, entry in raw.items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша фото {self.path}: {e}")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({str(pid): entry for pid, entry in self._entries.items()}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш фото: {e}")
+
+    def file_id(self, product):
+        entry = self._entries.get(product.id)
+        if entry and entry["url"] == product.photo_url:
+            return entry["file_id"]
+        return None
+
+    def media_for(self, product) -> str:
+        """file_id, если фото уже загружено в Telegram, иначе URL"""
+        return self.file_id(product) or product.photo_url
+
+    def remember(self, product, message):
+        """Сохраняет file_id из ответа Telegram на отправку/редактирование фото"""
+        photo = getattr(message, "photo", None)
+        if not photo:
+            return
+        file_id = photo[-1].file_id
+        if self.file_id(product) == file_id:
+            return
+        self._entries[product.id] = {"url": product.photo_url, "file_id": file_id}
+        self._save()
+
+    def forget(self, product):
+        if self._entries.pop(product.id, None) is not None:
+            self._save()
+
+    def prune(self, catalog):
+        """Удаляет записи для удалённых товаров и товаров со сменившимся фото"""
+        stale = [
+            pid for pid, entry in self._entries.items()
+            if (product := catalog.get(pid)) is None or product.photo_url != entry["url"]
+        ]
+        for pid in stale:
+            del self._entries[pid]
+        if stale:
+            self._save()
+
+    async def warm_up(self, bot, catalog, chat_id: int):
+        """Загружает в Telegram все фото каталога, которых ещё нет в кэше"""
+        uploaded = 0
+        for product in catalog.products:
+            if not product.photo_url or self.file_id(product):
+                continue
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=product.photo_url, disable_notification=True)
+                self.remember(product, message)
+                uploaded += 1
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception as e:
+                logger.warning(f"Не удалось предзагрузить фото товара {product.id}: {e}")
+        logger.info(f"Предзагрузка фото завершена: загружено {uploaded}")
+
+    def stats(self) -> dict:
+        return {"photo_cache_entries": len(self._entries)}
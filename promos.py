@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+
+from persistence import UNIQUE_VIOLATION
+
+logger = logging.getLogger(__name__)
+
+PROMO_PREFIX = "WIN"
+SERIAL_BYTES = 5  # 40 бит — ~10^12 возможных кодов
+TAG_BYTES = 5     # 40 бит подписи — угадать валидный код практически невозможно
+CODE_LENGTH = len(PROMO_PREFIX) + 16  # base32 от 10 байт — ровно 16 символов без '='
+
+
+class PromoStore:
+    """
+    Промокоды вида WIN + base32(серийный номер + HMAC-подпись).
+    Подлинность кода проверяется по подписи без обращения к базе,
+    в памяти хранятся только серийные номера погашенных кодов.
+    store (пространство имён STATE) сохраняет их между перезапусками:
+    номер, которого нет в памяти, ищется там.
+
+    Схема used_promos, на которую рассчитаны redeem и sync:
+      alter table used_promos add column if not exists id bigint generated always as identity;
+      alter table used_promos add constraint used_promos_code_key unique (code);
+    При нескольких процессах погашение решает уникальность code,
+    а id нужен sync, чтобы догружать только новые строки.
+    """
+
+    def __init__(self, secret: bytes, supabase=None, metrics=None, writes=None, store=None):
+        self._secret = secret
+        self._supabase = supabase
+        self._store = store  # серийный номер -> True для погашенных кодов
+        self._writes = writes  # WriteBehindQueue: строка погашения, если Supabase не ответил
+        self._latency = None
+        if metrics is not None:
+            self._latency = metrics.histogram(
+                "supabase_latency_seconds", "Время запроса к Supabase по таблицам", ("table", "op", "status"))
+        self._redeemed = set()  # серийные номера погашенных кодов
+        self._last_synced_id = 0
+        self.rng = secrets.SystemRandom()
+
+    def _tag(self, serial: int) -> bytes:
+        return hmac.new(self._secret, serial.to_bytes(SERIAL_BYTES, "big"), hashlib.sha256).digest()[:TAG_BYTES]
+
+    def _encode(self, serial: int) -> str:
+        raw = serial.to_bytes(SERIAL_BYTES, "big") + self._tag(serial)
+        return PROMO_PREFIX + base64.b32encode(raw).decode("ascii")
+
+    def serial_of(self, code: str):
+        """Серийный номер кода, если подпись верна, иначе None"""
+        if len(code) != CODE_LENGTH or not code.startswith(PROMO_PREFIX):
+            return None
+        try:
+            raw = base64.b32decode(code[len(PROMO_PREFIX):])
+        except (ValueError, TypeError):
+            return None
+        serial_bytes, tag = raw[:SERIAL_BYTES], raw[SERIAL_BYTES:]
+        serial = int.from_bytes(serial_bytes, "big")
+        if not hmac.compare_digest(tag, self._tag(serial)):
+            return None
+        return serial
+
+    def _is_redeemed(self, serial: int) -> bool:
+        if serial in self._redeemed:
+            return True
+        if self._store is not None and serial in self._store:
+            self._redeemed.add(serial)
+            return True
+        return False
+
+    def _mark_redeemed(self, serial: int):
+        self._redeemed.add(serial)
+        if self._store is not None:
+            self._store.put(serial, True)
+
+    def issue(self) -> str:
+        while True:
+            serial = self.rng.getrandbits(SERIAL_BYTES * 8)
+            if serial not in self._redeemed:
+                return self._encode(serial)
+
+    def is_valid(self, code) -> bool:
+        if not code:
+            return False
+        serial = self.serial_of(code)
+        return serial is not None and not self._is_redeemed(serial)
+
+    async def redeem(self, code: str, used_by: int = None) -> bool:
+        """
+        Погашает код. False — код поддельный или уже использован.
+        С Supabase решает вставка в used_promos: код, погашенный другим
+        процессом, даёт конфликт уникальности, даже если sync его ещё не подтянул.
+        """
+        serial = self.serial_of(code)
+        if serial is None or self._is_redeemed(serial):
+            return False
+        self._mark_redeemed(serial)  # до await: второй платёж этого процесса с тем же кодом сюда не пройдёт
+        if not self._supabase:
+            return True
+        row = {"code": code, "used_by": used_by}
+        try:
+            await asyncio.to_thread(self._insert, row)
+        except Exception as e:
+            if getattr(e, "code", None) == UNIQUE_VIOLATION:
+                return False
+            # Платёж уже прошёл: код считается погашенным, строка уйдёт в Supabase через очередь записи
+            logger.error(f"Не удалось записать погашение промокода: {e}")
+            if self._writes is not None:
+                self._writes.submit("used_promos", "insert", row)
+        return True
+
+    def _insert(self, row: dict):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            self._supabase.table("used_promos").insert(row).execute()
+            status = "ok"
+        finally:
+            if self._latency is not None:
+                self._latency.labels("used_promos", "insert", status).observe(time.perf_counter() - started)
+
+    def sync(self, page_size: int = 1000) -> int:
+        """
+        Догружает из used_promos только строки, появившиеся после прошлой
+        синхронизации (по возрастанию id — колонку нужно добавить, см. описание класса).
+        Возвращает число новых погашений
+        """
+        if not self._supabase:
+            return 0
+        added = 0
+        while True:
+            started = time.perf_counter()
+            status = "error"
+            try:
+                response = (
+                    self._supabase.table("used_promos")
+                    .select("id, code")
+                    .gt("id", self._last_synced_id)
+                    .order("id")
+                    .limit(page_size)
+                    .execute()
+                )
+                status = "ok"
+            finally:
+                if self._latency is not None:
+                    self._latency.labels("used_promos", "select", status).observe(time.perf_counter() - started)
+            rows = response.data
+            for row in rows:
+                self._last_synced_id = max(self._last_synced_id, row["id"])
+                serial = self.serial_of(row["code"])
+                if serial is not None and not self._is_redeemed(serial):
+                    self._mark_redeemed(serial)
+                    added += 1
+            if len(rows) < page_size:
+                return added
+
+    async def sync_forever(self, interval: float = 60.0):
+        """Фоновая задача: периодически подтягивает погашения с других инстансов"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации промокодов: {e}")
+
+    def stats(self) -> dict:
+        return {"promos_redeemed": len(self._redeemed)}
@@ -0,0 +1,58 @@
+import time
+from collections import deque
+
+from ttl import TTLCache
+
+
+class SlidingWindowQuota:
+    """
+    Лимит «не больше limit событий за последние window секунд» на пользователя.
+
+    На пользователя хранится deque не длиннее limit: для решения «можно /
+    нельзя» старшие события не нужны — всё, что вытеснено из deque, старше
+    оставшихся и истекает раньше них. Проверка и запись — O(1) амортизированно.
+    Пользователи лежат в TTLCache: запись исчезает через window секунд
+    после последнего события, общее число ограничено max_users.
+    Если передан store (пространство имён StateBackend), события
+    дублируются туда и подгружаются при промахе — лимиты переживают перезапуск.
+    """
+
+    def __init__(self, limit: int, window: float = 86400, max_users: int = 100000, store=None, clock=time.time):
+        self.limit = limit
+        self.window = window
+        self._store = store
+        self._clock = clock
+        self._users = TTLCache(ttl=window, max_entries=max_users)
+
+    def _events(self, key):
+        events = self._users.get(key)
+        if events is None and self._store is not None:
+            stored = self._store.get(key)
+            if stored:
+                events = deque(stored, maxlen=self.limit)
+                self._users[key] = events
+        return events
+
+    def count(self, key) -> int:
+        events = self._events(key)
+        if not events:
+            return 0
+        cutoff = self._clock() - self.window
+        while events and events[0] <= cutoff:
+            events.popleft()
+        return len(events)
+
+    def allowed(self, key) -> bool:
+        return self.count(key) < self.limit
+
+    def record(self, key):
+        events = self._events(key)
+        if events is None:
+            events = deque(maxlen=self.limit)
+        events.append(self._clock())
+        self._users[key] = events  # продлевает срок жизни записи
+        if self._store is not None:
+            self._store.put(key, list(events))
+
+    def stats(self) -> dict:
+        return self._users.stats()
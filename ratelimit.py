@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """
+    Ограничитель «маркерная корзина» на ключ (user_id).
+    Корзина вмещает burst маркеров и пополняется со скоростью rate в секунду,
+    так что короткие серии нажатий проходят, а долгий спам — нет.
+
+    Корзины хранятся в OrderedDict по времени последнего обращения.
+    Корзина, к которой не обращались burst / rate секунд, снова полна —
+    то есть неотличима от новой, и её можно удалить. Такие корзины всегда
+    в начале словаря, поэтому очистка — O(1) амортизированно.
+    """
+
+    __slots__ = ("rate", "burst", "max_keys", "_idle_ttl", "_clock", "_buckets", "allowed", "rejected")
+
+    def __init__(self, rate: float = 2.0, burst: int = 5, max_keys: int = 100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._idle_ttl = burst / rate
+        self._clock = clock
+        self._buckets = OrderedDict()  # key -> [tokens, last_refill]
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, key) -> bool:
+        now = self._clock()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            self._expire(now)
+            buckets[key] = [self.burst - 1.0, now]
+            self.allowed += 1
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        buckets.move_to_end(key)
+        if tokens < 1.0:
+            bucket[0] = tokens
+            self.rejected += 1
+            return False
+        bucket[0] = tokens - 1.0
+        self.allowed += 1
+        return True
+
+    def reserve(self, key, max_wait: float = None):
+        """
+        Занимает маркер, даже если его пока нет, и возвращает, сколько секунд
+        нужно подождать до его появления (0 — можно сразу). Долг хранится как
+        момент в будущем, когда корзина опустеет до нуля, поэтому очередь
+        ожидающих выстраивается без отдельных структур.
+        Если ждать пришлось бы дольше max_wait, маркер не занимается и возвращается None.
+        """
+        now = self._clock()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            self._expire(now)
+            buckets[key] = [self.burst - 1.0, now]
+            return 0.0
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate) - 1.0
+        buckets.move_to_end(key)
+        if tokens >= 0:
+            bucket[0], bucket[1] = tokens, now
+            return 0.0
+        wait = -tokens / self.rate
+        if max_wait is not None and wait > max_wait:
+            return None
+        bucket[0], bucket[1] = 0.0, now + wait
+        return wait
+
+    def _expire(self, now: float):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket[1] < self._idle_ttl and len(buckets) < self.max_keys:
+                break
+            buckets.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "ratelimit_allowed": self.allowed,
+            "ratelimit_rejected": self.rejected,
+            "ratelimit_tracked_users": len(self._buckets),
+        }
@@ -0,0 +1,120 @@
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Поля пользователя, которые остаются в журнале; имя заменяется псевдонимом, остальное выбрасывается
+USER_FIELDS = ("id", "is_bot", "language_code", "is_premium")
+# Личные данные, которые в журнал не попадают вовсе
+DROPPED_FIELDS = ("contact", "location", "order_info", "shipping_address", "photo", "document", "voice")
+
+
+class UpdateRecorder:
+    """
+    Журнал входящих обновлений для повторного прогона (benchmarks.replay).
+    Строка — {"t": время прихода, "update": обновление}; id пользователей
+    и личных чатов заменены псевдонимами HMAC(salt, id), одинаковыми для
+    одного пользователя в пределах журнала, имена и контакты убраны.
+
+    record() только кладёт строку в буфер; flush() дописывает буфер
+    в gzip-файл отдельным блоком (gzip.open читает такие блоки подряд).
+    """
+
+    def __init__(self, path: str, salt: bytes, max_buffer: int = 10000):
+        self.path = path
+        self._salt = salt
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._pseudonyms = {}
+        self.recorded = 0
+        self.dropped = 0
+
+    def pseudonym(self, value: int) -> int:
+        """Стабильный псевдоним id: знак сохраняется (группы в Telegram — отрицательные id)"""
+        alias = self._pseudonyms.get(value)
+        if alias is None:
+            if len(self._pseudonyms) >= 100000:
+                self._pseudonyms.clear()  # Только кэш: псевдоним всегда можно вычислить заново
+            digest = hmac.new(self._salt, str(abs(value)).encode(), hashlib.sha256).digest()
+            alias = int.from_bytes(digest[:6], "big") + 1
+            alias = self._pseudonyms[value] = -alias if value < 0 else alias
+        return alias
+
+    def _scrub(self, value):
+        if isinstance(value, list):
+            return [self._scrub(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        result = {}
+        for key, item in value.items():
+            if key in DROPPED_FIELDS:
+                continue
+            if key in ("from", "user") and isinstance(item, dict):
+                item = self._user(item)
+            elif key == "chat" and isinstance(item, dict):
+                item = {"id": self.pseudonym(item["id"]), "type": item.get("type", "private")}
+            elif key == "chat_id" and isinstance(item, int):
+                item = self.pseudonym(item)
+            else:
+                item = self._scrub(item)
+            result[key] = item
+        return result
+
+    def _user(self, user: dict) -> dict:
+        user = {key: user[key] for key in USER_FIELDS if key in user}
+        if "id" in user:
+            user["id"] = self.pseudonym(user["id"])
+            user["first_name"] = f"user{user['id']}"
+        return user
+
+    def record(self, data: dict):
+        if len(self._buffer) >= self.max_buffer:
+            # Диск не успевает — теряем запись журнала, но не задерживаем обработку
+            self.dropped += 1
+            return
+        self._buffer.append({"t": time.time(), "update": self._scrub(data)})
+        self.recorded += 1
+
+    def flush(self):
+        self._write(self._take())
+
+    def _take(self) -> list:
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch)
+        try:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            logger.error(f"Не удалось дописать журнал обновлений {self.path}: {e}")
+
+    async def flush_periodically(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            # Буфер забирается в цикле событий, сжатие и запись — в потоке
+            await asyncio.to_thread(self._write, self._take())
+
+    def stats(self) -> dict:
+        return {"journal_recorded": self.recorded, "journal_dropped": self.dropped}
+
+
+def read_journal(*paths: str) -> list:
+    """Записи одного или нескольких журналов (например, по одному на процесс) по времени прихода"""
+    entries = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
@@ -0,0 +1,78 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает callback_data 64 байтами
+MAX_CALLBACK_LENGTH = 64
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов для callback_data вместо цепочки elif.
+
+    exact("cart", handler)           — точное совпадение
+    prefix("view_", handler, int)    — префикс; остаток строки разбирается
+                                       parse один раз и передаётся аргументом
+
+    Поиск — один словарь для точных маршрутов и по одной проверке словаря
+    на каждый '_' в строке для префиксов, так что стоимость не растёт
+    с числом маршрутов. Отдельная проверка регулярным выражением не нужна:
+    точные маршруты заданы нами, а аргумент префикса допускается только
+    из ASCII-букв и цифр.
+    """
+
+    def __init__(self, instrument=None):
+        self._exact = {}     # data -> (handler, answer)
+        self._prefixes = {}  # prefix -> (handler, parse, answer)
+        self._instrument = instrument  # handler -> обёрнутый handler (например, MetricsRegistry.timed)
+
+    def _wrap(self, handler):
+        return self._instrument(handler) if self._instrument else handler
+
+    def exact(self, data: str, handler, answer: bool = True):
+        """answer=False — обработчик сам отвечает на callback_query"""
+        self._exact[data] = (self._wrap(handler), answer)
+
+    def prefix(self, prefix: str, handler, parse=str, answer: bool = True):
+        if not prefix.endswith("_"):
+            raise ValueError(f"Префикс маршрута должен заканчиваться на '_': {prefix}")
+        self._prefixes[prefix] = (self._wrap(handler), parse, answer)
+
+    def route(self, data: str):
+        """(handler, args, answer) или None, если маршрут не найден или аргумент не разобран"""
+        entry = self._exact.get(data)
+        if entry is not None:
+            return entry[0], (), entry[1]
+        if len(data) > MAX_CALLBACK_LENGTH:
+            return None
+
+        prefixes = self._prefixes
+        i = data.find("_")
+        while i != -1:
+            entry = prefixes.get(data[:i + 1])
+            if entry is not None:
+                handler, parse, answer = entry
+                arg = data[i + 1:]
+                if not (arg.isascii() and arg.isalnum()):
+                    return None
+                try:
+                    return handler, (parse(arg),), answer
+                except ValueError:
+                    return None
+            i = data.find("_", i + 1)
+        return None
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        data = query.data or ""
+        route = self.route(data)
+        if route is None:
+            await query.answer("Недопустимый запрос")
+            logger.warning(f"Подозрительный callback_data: {data[:MAX_CALLBACK_LENGTH]} от пользователя {update.effective_user.id}")
+            return
+
+        handler, args, answer = route
+        if answer:
+            await query.answer()
+        logger.info(f"Получен callback: {data} от пользователя {update.effective_user.id}")
+        await handler(update, context, *args)
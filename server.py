@@ -0,0 +1,223 @@
+"""
+HTTP-сервер бота: вебхук Telegram, проверки здоровья и метрики
+в одном ASGI-приложении на том же цикле событий, что и сам бот.
+
+  POST /<url_path>  — обновления от Telegram
+  GET  /healthz     — процесс жив (ничего не проверяет)
+  GET  /readyz      — готов принимать трафик: все проверки готовности прошли
+  GET  /metrics     — счётчики и гистограммы задержек в текстовом формате Prometheus
+  POST /internal/quota — списание лимита пользователя по запросу другого процесса (шардирование)
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+QUOTA_PATH = "/internal/quota"
+
+
+def webhook_secret(bot_token: str) -> str:
+    """Секрет вебхука по умолчанию — выводится из токена, одинаково во всех процессах"""
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+class ReadinessChecks:
+    """
+    Набор асинхронных проверок готовности. Результат кэшируется на ttl
+    секунд, чтобы частые опросы балансировщика не превращались
+    в запросы к внешним сервисам.
+    """
+
+    def __init__(self, checks: dict, ttl: float = 5.0, timeout: float = 3.0):
+        self._checks = checks  # имя -> async () -> bool
+        self.ttl = ttl
+        self.timeout = timeout
+        self._result = None
+        self._checked_at = 0.0
+
+    async def _run(self, check) -> bool:
+        try:
+            return bool(await asyncio.wait_for(check(), timeout=self.timeout))
+        except Exception as e:
+            logger.warning(f"Проверка готовности не прошла: {e}")
+            return False
+
+    async def results(self) -> dict:
+        now = time.monotonic()
+        if self._result is None or now - self._checked_at >= self.ttl:
+            names = list(self._checks)
+            values = await asyncio.gather(*(self._run(self._checks[name]) for name in names))
+            self._result = dict(zip(names, values))
+            self._checked_at = now
+        return self._result
+
+
+def render_metrics(stats: dict, prefix: str = "shop_") -> str:
+    """Плоский словарь счётчиков -> текстовый формат Prometheus (нечисловые значения пропускаются)"""
+    lines = []
+    for name, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines.append(f"{prefix}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def create_app(application, url_path: str, secret_token: str = None, readiness: ReadinessChecks = None,
+               metrics=None, ingest=None, forward=None, registry=None, recorder=None, quota=None) -> Starlette:
+    """
+    application — инициализированный telegram.ext.Application;
+    metrics — функция без аргументов, возвращающая плоский словарь счётчиков;
+    registry — MetricsRegistry: гистограммы и счётчики с метками дописываются в /metrics;
+    recorder — UpdateRecorder: каждое принятое обновление пишется в журнал;
+    ingest — IngestQueue: обновление ставится в неё, и Telegram сразу получает 200;
+    forward — вместо обработки на месте: async forward(data, body) -> bool передаёт
+    сырое обновление дальше и ждёт, пока его примут (фронтальный процесс
+    при шардировании, application=None);
+    quota — charge(name, user_id) -> bool: лимиты пользователей этого процесса
+    для других процессов бота ({"quota": ..., "user_id": ...} -> {"granted": ...}).
+    """
+    expected_secret = secret_token.encode() if secret_token else None
+
+    def authorized(request: Request) -> bool:
+        if expected_secret is None:
+            return True
+        received = request.headers.get(SECRET_HEADER, "").encode()
+        return hmac.compare_digest(received, expected_secret)
+
+    async def webhook(request: Request):
+        # Секрет проверяется до чтения тела: чужие запросы не стоят разбора JSON
+        if not authorized(request):
+            return Response(status_code=403)
+        if forward is not None:
+            body = await request.body()
+            try:
+                data = json.loads(body)
+            except ValueError as e:
+                logger.warning(f"Некорректное обновление от Telegram: {e}")
+                return Response(status_code=400)
+            # Обновление не принято процессом бота — 503: Telegram повторит доставку, дубли отсечёт дедупликация
+            return Response(status_code=200 if await forward(data, body) else 503)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление от Telegram: {e}")
+            return Response(status_code=400)
+        if recorder is not None:
+            recorder.record(data)
+        if ingest is not None:
+            # Отброшенное при перегрузке обновление тоже подтверждаем: повтор от Telegram только усилит нагрузку
+            ingest.submit(update)
+        else:
+            await application.update_queue.put(update)
+        return Response()
+
+    async def healthz(request: Request):
+        return PlainTextResponse("ok")
+
+    async def readyz(request: Request):
+        results = await readiness.results() if readiness else {}
+        ready = all(results.values())
+        return JSONResponse({"ready": ready, "checks": results}, status_code=200 if ready else 503)
+
+    async def metrics_endpoint(request: Request):
+        stats = metrics() if metrics else {}
+        text = render_metrics(stats) + (registry.render() if registry else "")
+        return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+    async def quota_endpoint(request: Request):
+        if not authorized(request):
+            return Response(status_code=403)
+        try:
+            data = await request.json()
+            granted = quota(data["quota"], int(data["user_id"]))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Некорректный запрос лимита: {e}")
+            return Response(status_code=400)
+        return JSONResponse({"granted": granted})
+
+    routes = [
+        Route(f"/{url_path.strip('/')}", webhook, methods=["POST"]),
+        Route("/healthz", healthz, methods=["GET"]),
+        Route("/readyz", readyz, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+    ]
+    if quota is not None:
+        routes.append(Route(QUOTA_PATH, quota_endpoint, methods=["POST"]))
+    return Starlette(routes=routes)
+
+
+@asynccontextmanager
+async def running(application, ingest=None):
+    """
+    Жизненный цикл Application без встроенного Updater:
+    post_init / post_stop / post_shutdown вызываются так же, как в run_webhook.
+    """
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if ingest is not None:
+            # Через update_processor — с теми же ограничениями параллельности и порядка, что и при polling
+            async def process(update):
+                await application.update_processor.process_update(update, application.process_update(update))
+            ingest.start(process)
+        try:
+            yield
+        finally:
+            if ingest is not None:
+                await ingest.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def webhook_server(app: Starlette, host: str, port: int) -> uvicorn.Server:
+    return uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off"))
+
+
+async def serve(application, host: str, port: int, webhook_url: str, url_path: str,
+                secret_token: str = None, readiness: ReadinessChecks = None, metrics=None, ingest=None,
+                registry=None, recorder=None):
+    """Запускает бота и HTTP-сервер на текущем цикле событий"""
+    web = webhook_server(
+        create_app(application, url_path, secret_token, readiness, metrics, ingest,
+                   registry=registry, recorder=recorder),
+        host, port,
+    )
+    async with running(application, ingest):
+        await application.bot.set_webhook(
+            url=f"{webhook_url.rstrip('/')}/{url_path.strip('/')}",
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await web.serve()
+
+
+async def serve_worker(application, host: str, port: int, url_path: str, secret_token: str = None,
+                       readiness: ReadinessChecks = None, metrics=None, ingest=None, registry=None,
+                       recorder=None, quota=None):
+    """Процесс бота за фронтом sharding: вебхук регистрирует фронт, сюда обновления приходят от него"""
+    web = webhook_server(
+        create_app(application, url_path, secret_token, readiness, metrics, ingest,
+                   registry=registry, recorder=recorder, quota=quota),
+        host, port,
+    )
+    async with running(application, ingest):
+        await web.serve()
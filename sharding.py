@@ -0,0 +1,299 @@
+"""
+Горизонтальное масштабирование: фронтальный процесс и N процессов бота.
+
+Фронт принимает вебхук Telegram, не разбирая обновление целиком, и по
+согласованному хэшу отправляет его одному из процессов bot.py:
+по id партии для ходов и входа в партию вдвоём, иначе по user_id.
+Корзины, счета, партии и лимиты пользователя живут только в его процессе.
+Партия вдвоём создаётся с id, который попадает в процесс создателя
+(bot.new_game_id), поэтому приглашение и все ходы оказываются в одном месте.
+Лимиты соперника из другого процесса списываются запросом к его процессу
+(POST /internal/quota), а повторное погашение промокода в другом процессе
+отсекает ограничение уникальности used_promos.code в Supabase.
+
+Каждый процесс получает свои STATE_DB_PATH, PHOTO_CACHE_PATH,
+SUPABASE_JOURNAL_PATH, UPDATE_JOURNAL_PATH (если задан) и долю BOT_API_RATE.
+
+Запуск (вместо python bot.py):
+  python -m sharding --workers 4
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+from server import SECRET_HEADER, ReadinessChecks, create_app, webhook_secret, webhook_server
+
+logger = logging.getLogger(__name__)
+
+BOT_SCRIPT = str(Path(__file__).with_name("bot.py"))
+# Файлы, которые процессы бота не должны делить между собой
+PER_SHARD_PATHS = {
+    "STATE_DB_PATH": "state.db",
+    "PHOTO_CACHE_PATH": "photo_cache.json",
+    "SUPABASE_JOURNAL_PATH": "supabase_journal.jsonl",
+    "UPDATE_JOURNAL_PATH": "",  # пусто — журнал обновлений выключен
+}
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def game_key(game_id: str) -> str:
+    return f"game:{game_id}"
+
+
+class HashRing:
+    """
+    Согласованное хэширование с виртуальными узлами: при изменении числа
+    процессов на другой процесс переезжает лишь ~1/N ключей.
+    """
+
+    def __init__(self, shards: int, replicas: int = 128):
+        if shards < 1:
+            raise ValueError("Нужен хотя бы один процесс")
+        self.shards = shards
+        points = sorted((_hash(f"shard:{shard}:{i}"), shard) for shard in range(shards) for i in range(replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> int:
+        i = bisect.bisect(self._points, _hash(key))
+        return self._owners[i % len(self._points)]
+
+
+def route_key(data: dict) -> str:
+    """
+    Ключ маршрутизации сырого обновления (dict из JSON) — те же правила,
+    что у bot.update_keys, но без сборки объекта Update
+    """
+    query = data.get("callback_query")
+    if query and str(query.get("data", "")).startswith("pmove_"):
+        return game_key(query["data"][6:14])
+    message = data.get("message")
+    if message and str(message.get("text", "")).startswith("/start ttt_"):
+        return game_key(message["text"][11:19])
+    # Все типы обновлений с пользователем: message, callback_query, pre_checkout_query...
+    for field, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user")
+        if isinstance(sender, dict) and "id" in sender:
+            return user_key(sender["id"])
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return user_key(chat["id"])
+    return f"update:{data.get('update_id')}"
+
+
+def shard_path(path: str, index: int) -> str:
+    """state.db -> state.2.db, updates.jsonl.gz -> updates.2.jsonl.gz"""
+    p = Path(path)
+    stem, dot, suffixes = p.name.partition(".")
+    return str(p.with_name(f"{stem}.{index}{dot}{suffixes}"))
+
+
+class ShardRouter:
+    """
+    Пересылает сырые обновления процессам бота по HTTP.
+    На каждый процесс — lanes отправителей; ключ всегда попадает в одну
+    и ту же полосу, так что порядок обновлений пользователя сохраняется
+    и по дороге до процесса.
+
+    Telegram получает ответ только после того, как процесс бота принял
+    обновление: если он не ответил 200 и после повторов, фронт отвечает
+    503 и Telegram доставит обновление заново — платежи не теряются.
+    """
+
+    def __init__(self, worker_urls: list, secret_token: str, lanes: int = 4, max_pending: int = 1000,
+                 attempts: int = 3, retry_delay: float = 0.2):
+        self.ring = HashRing(len(worker_urls))
+        self.worker_urls = worker_urls
+        self.secret_token = secret_token
+        self.lanes = lanes
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self._queues = [[asyncio.Queue(max_pending) for _ in range(lanes)] for _ in worker_urls]
+        self._tasks = []
+        self._client = None
+        self.forwarded = [0] * len(worker_urls)
+        self.rejected = 0
+        self.failed = 0
+
+    async def forward(self, data: dict, body: bytes) -> bool:
+        """Для create_app(forward=...): False — очередь процесса переполнена или процесс не принял обновление"""
+        key = route_key(data)
+        shard = self.ring.shard_for(key)
+        queue = self._queues[shard][_hash(key) % self.lanes]
+        accepted = asyncio.get_running_loop().create_future()
+        try:
+            queue.put_nowait((body, accepted))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        return await accepted
+
+    async def _sender(self, shard: int, queue: asyncio.Queue):
+        while True:
+            body, accepted = await queue.get()
+            ok = await self._post(shard, body)
+            if not accepted.done():  # Telegram мог не дождаться ответа
+                accepted.set_result(ok)
+
+    async def _post(self, shard: int, body: bytes) -> bool:
+        url = self.worker_urls[shard]
+        headers = {"Content-Type": "application/json", SECRET_HEADER: self.secret_token}
+        for attempt in range(self.attempts):
+            try:
+                response = await self._client.post(url, content=body, headers=headers)
+                if response.status_code != 200:
+                    raise RuntimeError(f"ответ {response.status_code}")
+                self.forwarded[shard] += 1
+                return True
+            except Exception as e:
+                logger.warning(f"Не удалось передать обновление процессу {shard} (попытка {attempt + 1}): {e}")
+                if attempt + 1 < self.attempts:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        self.failed += 1
+        return False
+
+    def start(self):
+        self._client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=len(self.worker_urls) * self.lanes))
+        for shard, queues in enumerate(self._queues):
+            for queue in queues:
+                self._tasks.append(asyncio.create_task(self._sender(shard, queue)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._client is not None:
+            await self._client.aclose()
+
+    def stats(self) -> dict:
+        stats = {
+            "shard_count": len(self.worker_urls),
+            "shard_pending": sum(q.qsize() for queues in self._queues for q in queues),
+            "shard_rejected": self.rejected,
+            "shard_failed": self.failed,
+        }
+        for shard, count in enumerate(self.forwarded):
+            stats[f"shard_{shard}_forwarded"] = count
+        return stats
+
+
+def worker_env(index: int, count: int, port: int) -> dict:
+    env = dict(os.environ)
+    env["SHARD_INDEX"] = str(index)
+    env["SHARD_COUNT"] = str(count)
+    env["SHARD_PORT"] = str(port)
+    env["SHARD_BASE_PORT"] = str(port - index)  # по нему процессы находят друг друга (лимиты игроков)
+    for name, default in PER_SHARD_PATHS.items():
+        path = os.getenv(name, default)
+        if path:
+            env[name] = shard_path(path, index)
+    # Общий лимит Bot API делится поровну, лимит на чат остаётся прежним
+    env["BOT_API_RATE"] = str(float(os.getenv("BOT_API_RATE", "30")) / count)
+    if index > 0:
+        env["PHOTO_WARMUP_CHAT_ID"] = "0"  # Фото прогревает один процесс
+    return env
+
+
+async def start_worker(index: int, count: int, worker_port: int):
+    return await asyncio.create_subprocess_exec(
+        sys.executable, BOT_SCRIPT, env=worker_env(index, count, worker_port + index),
+    )
+
+
+async def supervise(processes: list, index: int, worker_port: int, max_delay: float = 30.0):
+    """
+    Перезапускает упавший процесс бота. Пока он поднимается, фронт
+    отвечает на его обновления 503, и Telegram доставляет их повторно
+    """
+    delay = 1.0
+    while True:
+        started = time.monotonic()
+        code = await processes[index].wait()
+        if time.monotonic() - started > 60:
+            delay = 1.0  # Процесс успел поработать — не падает сразу после старта
+        logger.error(f"Процесс {index} завершился с кодом {code}, перезапуск через {delay:.0f} с")
+        await asyncio.sleep(delay)
+        processes[index] = await start_worker(index, len(processes), worker_port)
+        delay = min(delay * 2, max_delay)
+
+
+async def run_front(workers: int, host: str, port: int, worker_port: int, webhook_url: str = "",
+                    register_webhook: bool = True):
+    bot_token = os.getenv("BOT_TOKEN")
+    url_path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+    secret = os.getenv("WEBHOOK_SECRET") or webhook_secret(bot_token)
+
+    processes = [await start_worker(index, workers, worker_port) for index in range(workers)]
+    supervisors = [asyncio.create_task(supervise(processes, index, worker_port)) for index in range(workers)]
+    worker_base = [f"http://127.0.0.1:{worker_port + i}" for i in range(workers)]
+    router = ShardRouter([f"{base}/{url_path}" for base in worker_base], secret)
+
+    async def workers_ready() -> bool:
+        async with httpx.AsyncClient(timeout=2) as client:
+            responses = await asyncio.gather(*(client.get(f"{base}/readyz") for base in worker_base))
+        return all(r.status_code == 200 for r in responses)
+
+    web = webhook_server(
+        create_app(None, url_path, secret, ReadinessChecks({"workers": workers_ready}),
+                   metrics=router.stats, forward=router.forward),
+        host, port,
+    )
+    router.start()
+    try:
+        if register_webhook and webhook_url:
+            from telegram import Bot, Update
+            base_url = os.getenv("BOT_API_BASE_URL", "").strip() or "https://api.telegram.org/bot"
+            async with Bot(bot_token, base_url=base_url) as bot:
+                await bot.set_webhook(
+                    url=f"{webhook_url.rstrip('/')}/{url_path}",
+                    secret_token=secret,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+        await web.serve()
+    finally:
+        for task in supervisors:
+            task.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        await router.stop()
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SHARD_COUNT", str(os.cpu_count() or 1))))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "10000")))
+    parser.add_argument("--worker-port", type=int, default=int(os.getenv("SHARD_BASE_PORT", "10100")),
+                        help="процесс i слушает 127.0.0.1:worker-port+i")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    webhook_url = os.getenv("WEBHOOK_URL", "").strip()
+    if not webhook_url:
+        logger.warning("WEBHOOK_URL не задан: вебхук не регистрируется, обновления нужно присылать самим")
+    asyncio.run(run_front(args.workers, args.host, args.port, args.worker_port, webhook_url))
+
+
+if __name__ == "__main__":
+    main()
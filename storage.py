@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from ttl import TTLCache
+
+logger = logging.getLogger(__name__)
+
+_DELETED = object()
+
+
+class Namespace:
+    """Словарь-подобный доступ к одному пространству имён хранилища"""
+
+    __slots__ = ("_backend", "name")
+
+    def __init__(self, backend, name: str):
+        self._backend = backend
+        self.name = name
+
+    def get(self, key, default=None):
+        return self._backend.get(self.name, key, default)
+
+    def put(self, key, value):
+        self._backend.put(self.name, key, value)
+
+    def delete(self, key):
+        self._backend.delete(self.name, key)
+
+    def pop(self, key, default=None):
+        value = self._backend.get(self.name, key, _DELETED)
+        if value is _DELETED:
+            return default
+        self._backend.delete(self.name, key)
+        return value
+
+    def items(self):
+        return self._backend.items(self.name)
+
+    def __contains__(self, key) -> bool:
+        return self._backend.get(self.name, key, _DELETED) is not _DELETED
+
+    def __len__(self) -> int:
+        return self._backend.count(self.name)
+
+
+class StateBackend:
+    """
+    Интерфейс хранилища состояния бота (корзины, игры, статистика).
+    Значения — JSON-совместимые объекты. После изменения значения
+    его нужно снова записать через put: SQLite хранит копию.
+    Для пространства имён можно задать ttl (секунды с последней записи)
+    и max_entries — при переполнении вытесняются давно не изменявшиеся записи.
+    """
+
+    def configure(self, ns: str, ttl: float = None, max_entries: int = None):
+        raise NotImplementedError
+
+    def get(self, ns: str, key, default=None):
+        raise NotImplementedError
+
+    def put(self, ns: str, key, value):
+        raise NotImplementedError
+
+    def delete(self, ns: str, key):
+        raise NotImplementedError
+
+    def items(self, ns: str):
+        raise NotImplementedError
+
+    def count(self, ns: str) -> int:
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """Удаляет истёкшие и лишние записи, возвращает их число"""
+        return 0
+
+    def stats(self) -> dict:
+        """{пространство имён: {"live": ..., "expired": ..., "evicted": ...}}"""
+        return {}
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def namespace(self, name: str, ttl: float = None, max_entries: int = None) -> Namespace:
+        self.configure(name, ttl=ttl, max_entries=max_entries)
+        return Namespace(self, name)
+
+
+class MemoryBackend(StateBackend):
+    """Всё в словарях процесса — быстро, но теряется при перезапуске"""
+
+    def __init__(self):
+        self._data = {}
+
+    def configure(self, ns, ttl=None, max_entries=None):
+        current = self._data.get(ns)
+        cache = TTLCache(ttl=ttl, max_entries=max_entries)
+        if current is not None:
+            for key, value in current.items():
+                cache[key] = value
+        self._data[ns] = cache
+
+    def _ns(self, ns):
+        cache = self._data.get(ns)
+        if cache is None:
+            cache = self._data[ns] = TTLCache()
+        return cache
+
+    def get(self, ns, key, default=None):
+        return self._ns(ns).get(key, default)
+
+    def put(self, ns, key, value):
+        self._ns(ns)[key] = value
+
+    def delete(self, ns, key):
+        self._ns(ns).pop(key, None)
+
+    def items(self, ns):
+        return self._ns(ns).items()
+
+    def count(self, ns):
+        return len(self._ns(ns))
+
+    def sweep(self):
+        return sum(cache.sweep() for cache in self._data.values())
+
+    def stats(self):
+        return {ns: cache.stats() for ns, cache in self._data.items()}
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Локальная SQLite-база в режиме WAL.
+    Записи копятся в буфере и сбрасываются одной транзакцией —
+    при достижении flush_threshold или по таймеру (flush() из фоновой задачи).
+    Чтение сначала смотрит в буфер, поэтому несброшенные данные видны сразу.
+    SQL-строки постоянные, так что sqlite3 берёт подготовленные
+    выражения из своего кэша, а не компилирует их заново.
+    Срок жизни хранится в колонке expires_at (unix-время), поэтому
+    переживает перезапуск; истёкшие строки невидимы и удаляются sweep().
+    stats() не обращается к базе: число живых записей пересчитывается
+    при configure() и каждом sweep(), который идёт в отдельном потоке.
+    """
+
+    _GET = "SELECT value, expires_at FROM state WHERE ns = ? AND key = ?"
+    _PUT = (
+        "INSERT INTO state (ns, key, value, expires_at) VALUES (?, ?, ?, ?)"
+        " ON CONFLICT(ns, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+    )
+    _DELETE = "DELETE FROM state WHERE ns = ? AND key = ?"
+    _ITEMS = "SELECT key, value FROM state WHERE ns = ? AND (expires_at IS NULL OR expires_at > ?)"
+    _COUNT = "SELECT COUNT(*) FROM state WHERE ns = ? AND (expires_at IS NULL OR expires_at > ?)"
+    _EXPIRE = "DELETE FROM state WHERE ns = ? AND expires_at <= ?"
+    _EVICT = (
+        "DELETE FROM state WHERE ns = ? AND key IN"
+        " (SELECT key FROM state WHERE ns = ? ORDER BY expires_at LIMIT ?)"
+    )
+
+    def __init__(self, path: str = "state.db", flush_threshold: int = 256):
+        self.path = path
+        self.flush_threshold = flush_threshold
+        self._dirty = {}  # (ns, key_json) -> (value_json, expires_at) | _DELETED
+        self._policies = {}  # ns -> (ttl, max_entries)
+        self._counters = {}  # ns -> {"expired": ..., "evicted": ...}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=64)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL, PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(state)")}
+        if "expires_at" not in columns:
+            self._conn.execute("ALTER TABLE state ADD COLUMN expires_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS state_expiry ON state (ns, expires_at)")
+
+    def configure(self, ns, ttl=None, max_entries=None):
+        self._policies[ns] = (ttl, max_entries)
+        if ns not in self._counters:
+            with self._lock:
+                live = self._conn.execute(self._COUNT, (ns, time.time())).fetchone()[0]
+            self._counters[ns] = {"live": live, "expired": 0, "evicted": 0}
+
+    @staticmethod
+    def _key(key) -> str:
+        return json.dumps(key)
+
+    def get(self, ns, key, default=None):
+        k = (ns, self._key(key))
+        with self._lock:
+            entry = self._dirty.get(k)
+            if entry is None:
+                entry = self._conn.execute(self._GET, k).fetchone() or _DELETED
+        if entry is _DELETED:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            return default
+        return json.loads(value)
+
+    def put(self, ns, key, value):
+        ttl = self._policies.get(ns, (None, None))[0]
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._write((ns, self._key(key)), (json.dumps(value, ensure_ascii=False), expires_at))
+
+    def delete(self, ns, key):
+        self._write((ns, self._key(key)), _DELETED)
+
+    def _write(self, k, value):
+        with self._lock:
+            self._dirty[k] = value
+            if len(self._dirty) >= self.flush_threshold:
+                self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._dirty:
+            return
+        puts = [(ns, key, *entry) for (ns, key), entry in self._dirty.items() if entry is not _DELETED]
+        deletes = [k for k, value in self._dirty.items() if value is _DELETED]
+        self._dirty.clear()
+        try:
+            self._conn.execute("BEGIN")
+            if puts:
+                self._conn.executemany(self._PUT, puts)
+            if deletes:
+                self._conn.executemany(self._DELETE, deletes)
+            self._conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            self._conn.execute("ROLLBACK")
+            logger.error(f"Ошибка записи состояния в SQLite: {e}")
+
+    def items(self, ns):
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(self._ITEMS, (ns, time.time())).fetchall()
+        return [(json.loads(key), json.loads(value)) for key, value in rows]
+
+    def count(self, ns):
+        self.flush()
+        with self._lock:
+            return self._conn.execute(self._COUNT, (ns, time.time())).fetchone()[0]
+
+    def sweep(self):
+        self.flush()
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for ns, (ttl, max_entries) in self._policies.items():
+                counters = self._counters[ns]
+                if ttl is not None:
+                    expired = self._conn.execute(self._EXPIRE, (ns, now)).rowcount
+                    counters["expired"] += expired
+                    removed += expired
+                live = self._conn.execute(self._COUNT, (ns, now)).fetchone()[0]
+                if max_entries is not None and live > max_entries:
+                    excess = live - max_entries
+                    # Самый ранний expires_at — запись, которую дольше всех не меняли
+                    counters["evicted"] += self._conn.execute(self._EVICT, (ns, ns, excess)).rowcount
+                    removed += excess
+                    live = max_entries
+                counters["live"] = live
+        return removed
+
+    def stats(self):
+        # Вызывается из /metrics и /stats на цикле событий — только счётчики в памяти, live на момент sweep()
+        return {ns: dict(counters) for ns, counters in self._counters.items()}
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+
+def create_backend(kind: str = "sqlite", path: str = "state.db") -> StateBackend:
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    raise ValueError(f"Неизвестный тип хранилища: {kind}")
+
+
+async def flush_periodically(backend: StateBackend, interval: float = 0.5):
+    """Фоновая задача: сбрасывает накопленные записи на диск"""
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(backend.flush)
+
+
+async def sweep_periodically(backend: StateBackend, interval: float = 60.0):
+    """Фоновая задача: удаляет истёкшие и вытесняет лишние записи"""
+    while True:
+        await asyncio.sleep(interval)
+        removed = await asyncio.to_thread(backend.sweep)
+        if removed:
+            logger.info(f"Очистка состояния: удалено {removed} записей")
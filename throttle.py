@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from ratelimit import TokenBucketLimiter
+
+logger = logging.getLogger(__name__)
+
+# Чем меньше число, тем раньше запрос получит маркер из общего лимита
+PRIORITY_PAYMENT = 0
+PRIORITY_REPLY = 1
+PRIORITY_MENU = 2
+
+ENDPOINT_PRIORITY = {
+    "answerPreCheckoutQuery": PRIORITY_PAYMENT,
+    "sendInvoice": PRIORITY_PAYMENT,
+    "answerCallbackQuery": PRIORITY_REPLY,
+    "sendMessage": PRIORITY_REPLY,
+}
+LANE_NAMES = {PRIORITY_PAYMENT: "payment", PRIORITY_REPLY: "reply", PRIORITY_MENU: "menu"}
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Планировщик исходящих запросов к Bot API.
+
+    Каждый запрос сначала ждёт маркер своего чата (Telegram не любит больше
+    ~1 сообщения в секунду в один чат), затем маркер общего лимита бота
+    (~30 в секунду). Общие маркеры раздаются по приоритету: платежи и
+    счета раньше ответов, ответы раньше правки меню. На RetryAfter
+    все запросы ставятся на паузу на указанное время и запрос повторяется.
+    Приоритет можно задать явно: rate_limit_args={"priority": ...}.
+    Запрос с rate_limit_args={"skippable": True} (перерисовка меню или доски,
+    которую следующее нажатие всё равно повторит), которому пришлось бы ждать
+    маркер чата дольше max_chat_wait, не отправляется (вызов возвращает True,
+    как правка inline-сообщения), чтобы очередь чата не росла без предела.
+    Остальные запросы, в том числе правки с итогом, ждут сколько нужно.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = 30.0,
+        overall_burst: int = 30,
+        chat_rate: float = 1.0,
+        chat_burst: int = 5,
+        max_retries: int = 3,
+        max_chat_wait: float = 5.0,
+        metrics=None,
+    ):
+        self.overall_rate = overall_rate
+        self.overall_burst = overall_burst
+        self.max_retries = max_retries
+        self.max_chat_wait = max_chat_wait
+        self._chats = TokenBucketLimiter(rate=chat_rate, burst=chat_burst)
+        self._tokens = float(overall_burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+        self.retry_after_count = 0
+        self.skipped_edits = 0
+        self._delay_count = {lane: 0 for lane in LANE_NAMES}
+        self._delay_sum = {lane: 0.0 for lane in LANE_NAMES}
+        self._delay_max = {lane: 0.0 for lane in LANE_NAMES}
+        # Задержка самого вызова (без ожидания маркеров) и ошибки по методам Bot API
+        self._latency = self._errors = None
+        if metrics is not None:
+            self._latency = metrics.histogram("bot_api_latency_seconds", "Время вызова Bot API по методам", ("method",))
+            self._errors = metrics.counter("bot_api_errors_total", "Ошибки вызовов Bot API по методам", ("method",))
+
+    async def initialize(self) -> None:
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is None:
+            return
+        self._dispatcher.cancel()
+        await asyncio.gather(self._dispatcher, return_exceptions=True)
+        self._dispatcher = None
+        # Маркер уже никто не раздаст — ожидающие запросы отменяются
+        for _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    async def _acquire(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        """Единственный раздатчик общих маркеров — порядок строго по приоритету"""
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            self._tokens = min(self.overall_burst, self._tokens + (now - self._last_refill) * self.overall_rate)
+            self._last_refill = now
+            if self._tokens < 1.0:
+                await asyncio.sleep((1.0 - self._tokens) / self.overall_rate)
+                continue
+
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # запрос отменён, пока ждал
+                continue
+            self._tokens -= 1.0
+            future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = ENDPOINT_PRIORITY.get(endpoint, PRIORITY_MENU)
+        skippable = False
+        if isinstance(rate_limit_args, dict):
+            priority = rate_limit_args.get("priority", priority)
+            skippable = rate_limit_args.get("skippable", False)
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if chat_id is not None:
+                wait = self._chats.reserve(chat_id, self.max_chat_wait if skippable else None)
+                if wait is None:
+                    self.skipped_edits += 1
+                    return True
+                if wait:
+                    await asyncio.sleep(wait)
+            await self._acquire(priority)
+            self._record_delay(priority, time.monotonic() - started)
+
+            called = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._observe(endpoint, called, failed=True)
+                self.retry_after_count += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning(f"Flood control на {endpoint}: пауза {retry_after} с (попытка {attempt + 1})")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                await asyncio.sleep(retry_after)
+            except Exception:
+                self._observe(endpoint, called, failed=True)
+                raise
+            else:
+                self._observe(endpoint, called)
+                return result
+
+    def _observe(self, endpoint: str, called: float, failed: bool = False):
+        if self._latency is None:
+            return
+        self._latency.labels(endpoint).observe(time.perf_counter() - called)
+        if failed:
+            self._errors.labels(endpoint).inc()
+
+    def _record_delay(self, priority: int, delay: float):
+        lane = priority if priority in LANE_NAMES else PRIORITY_MENU
+        self._delay_count[lane] += 1
+        self._delay_sum[lane] += delay
+        if delay > self._delay_max[lane]:
+            self._delay_max[lane] = delay
+
+    def stats(self) -> dict:
+        stats = {
+            "throttle_waiting": len(self._waiters),
+            "throttle_retry_after": self.retry_after_count,
+            "throttle_skipped_edits": self.skipped_edits,
+        }
+        for lane, name in LANE_NAMES.items():
+            count = self._delay_count[lane]
+            stats[f"throttle_{name}_requests"] = count
+            stats[f"throttle_{name}_avg_delay_ms"] = round(self._delay_sum[lane] / count * 1000, 2) if count else 0.0
+            stats[f"throttle_{name}_max_delay_ms"] = round(self._delay_max[lane] * 1000, 2)
+        return stats
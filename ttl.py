@@ -0,0 +1,88 @@
+import heapq
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Словарь с временем жизни записей и ограничением размера.
+    Порядок OrderedDict — порядок использования (LRU): при переполнении
+    вытесняется давно не использованная запись. Истёкшие записи не видны
+    сразу, а физически удаляются sweep() по куче сроков истечения —
+    за O(k log n), где k — число истёкших, без обхода всего словаря.
+    """
+
+    def __init__(self, ttl: float = None, max_entries: int = None, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._heap = []             # (expires_at, seq, key); устаревшие элементы пропускаются
+        self._seq = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._data[key]
+            self.expired += 1
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self._clock() + self.ttl
+            self._seq += 1
+            heapq.heappush(self._heap, (expires_at, self._seq, key))
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if self.max_entries is not None:
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evicted += 1
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._compact_heap()
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def items(self):
+        now = self._clock()
+        return [(k, v) for k, (v, exp) in self._data.items() if exp is None or exp > now]
+
+    def sweep(self) -> int:
+        """Удаляет истёкшие записи, возвращает их число"""
+        now = self._clock()
+        removed = 0
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires_at, _, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            # Запись могла быть перезаписана с новым сроком или уже удалена
+            if entry is not None and entry[1] == expires_at:
+                del self._data[key]
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def _compact_heap(self):
+        self._heap = [item for item in self._heap if self._data.get(item[2], (None, None))[1] == item[0]]
+        heapq.heapify(self._heap)
+
+    def stats(self) -> dict:
+        return {"live": len(self._data), "expired": self.expired, "evicted": self.evicted}
@@ -0,0 +1,112 @@
+"""
+Крестики-нолики на битовых масках.
+
+Позиция — две 9-битные маски (x, o): бит i установлен, если в клетке i
+стоит соответствующий знак. Игрок всегда X и ходит первым, бот — O.
+Для всех достижимых позиций, где ход за ботом, при импорте заранее
+считаются два набора ходов:
+  BEST_MOVES   — оптимальная игра (бот никогда не проигрывает);
+  LOSING_MOVES — поддавки (ведут к победе X как можно быстрее).
+Ход бота — выбор из готовой маски, без перебора во время игры.
+"""
+import random
+
+FULL = 0x1FF
+WIN_MASKS = (
+    0b000000111, 0b000111000, 0b111000000,  # строки
+    0b001001001, 0b010010010, 0b100100100,  # столбцы
+    0b100010001, 0b001010100,               # диагонали
+)
+
+# WINS[mask] — есть ли в маске хотя бы одна полная линия
+WINS = bytes(any(mask & w == w for w in WIN_MASKS) for mask in range(FULL + 1))
+
+X_WIN, DRAW, O_WIN = 1, 0, -1
+
+
+def winner(x: int, o: int):
+    """'X', 'O' или None"""
+    if WINS[x]:
+        return "X"
+    if WINS[o]:
+        return "O"
+    return None
+
+
+def is_full(x: int, o: int) -> bool:
+    return (x | o) == FULL
+
+
+def free_cells(x: int, o: int):
+    taken = x | o
+    return [i for i in range(9) if not taken >> i & 1]
+
+
+def render(x: int, o: int) -> str:
+    """Строка из 9 символов 'X', 'O', ' ' — ключ для кэша клавиатур"""
+    return "".join("X" if x >> i & 1 else "O" if o >> i & 1 else " " for i in range(9))
+
+
+def _solve():
+    """
+    Обход всех достижимых позиций с запоминанием.
+    Значение позиции — с точки зрения X, с поправкой на глубину,
+    чтобы из равных вариантов выбирать более быструю развязку.
+    """
+    honest = {}   # (x, o) -> оценка при честной игре O
+    giveaway = {}  # (x, o) -> оценка, когда O помогает X
+    best_moves = {}
+    losing_moves = {}
+
+    def value(x, o, memo, o_helps, depth):
+        key = (x, o)
+        if key in memo:
+            return memo[key]
+        if WINS[x]:
+            result = 10 - depth
+        elif WINS[o]:
+            result = depth - 10
+        elif (x | o) == FULL:
+            result = 0
+        else:
+            taken = x | o
+            x_to_move = bin(x).count("1") == bin(o).count("1")
+            scores = {}
+            for i in range(9):
+                bit = 1 << i
+                if taken & bit:
+                    continue
+                if x_to_move:
+                    scores[i] = value(x | bit, o, memo, o_helps, depth + 1)
+                else:
+                    scores[i] = value(x, o | bit, memo, o_helps, depth + 1)
+            if x_to_move or o_helps:
+                result = max(scores.values())
+            else:
+                result = min(scores.values())
+            if not x_to_move:
+                moves_mask = 0
+                for i, score in scores.items():
+                    if score == result:
+                        moves_mask |= 1 << i
+                (losing_moves if o_helps else best_moves)[key] = moves_mask
+        memo[key] = result
+        return result
+
+    value(0, 0, honest, False, 0)
+    value(0, 0, giveaway, True, 0)
+    return best_moves, losing_moves
+
+
+BEST_MOVES, LOSING_MOVES = _solve()
+
+
+def bot_move(x: int, o: int, play_to_win: bool = True, rng=random) -> int:
+    """Клетка для хода O в позиции (x, o); ход должен быть за O"""
+    table = BEST_MOVES if play_to_win else LOSING_MOVES
+    moves_mask = table.get((x, o))
+    if not moves_mask:
+        # Позиция недостижима из нормальной партии — любой свободный ход
+        return rng.choice(free_cells(x, o))
+    moves = [i for i in range(9) if moves_mask >> i & 1]
+    return moves[0] if len(moves) == 1 else rng.choice(moves)
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+SKIPPABLE = {"skippable": True}
+
+
+def _limit_args(skippable: bool):
+    return SKIPPABLE if skippable else None
+
+
+class RenderMemo:
+    """
+    LRU-кэш готовых (text, markup). Ключ должен включать всё, от чего
+    зависит результат (версию корзины, промокод, версию каталога), —
+    тогда устаревшие записи просто перестают запрашиваться и вытесняются.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        value = self._entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+        self.misses += 1
+        value = self._entries[key] = build()
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        return {"render_memo_hits": self.hits, "render_memo_misses": self.misses, "render_memo_size": len(self._entries)}
+
+
+class MessageTracker:
+    """
+    Хэш содержимого, которое последним показали в сообщении (chat_id, message_id).
+    Правка с тем же содержимым не отправляется: Telegram всё равно ответил бы
+    «Message is not modified», потратив запрос к Bot API.
+    Все правки сообщений по callback_query должны идти через edit_* —
+    иначе запомненный хэш перестанет соответствовать сообщению.
+    skippable=True — перерисовка меню, которую ограничитель может пропустить
+    при долгой очереди чата (PriorityRateLimiter); правки с итогом его не ставят.
+    """
+
+    def __init__(self, max_messages: int = 100000):
+        self.max_messages = max_messages
+        self._shown = OrderedDict()  # (chat_id, message_id) -> hash содержимого
+        self.edits_sent = 0
+        self.edits_avoided = 0
+
+    @staticmethod
+    def _key(query):
+        message = query.message
+        # У сообщений из inline-режима нет chat_id/message_id — их не отслеживаем
+        return (message.chat_id, message.message_id) if message else None
+
+    async def _edit(self, query, content, send):
+        key = self._key(query)
+        digest = hash(content)
+        if key is not None and self._shown.get(key) == digest:
+            self.edits_avoided += 1
+            return None
+        self._shown.pop(key, None)  # если правка упадёт, содержимое сообщения неизвестно
+        result = await send()
+        self.edits_sent += 1
+        # True вместо Message — правку пропустил ограничитель (throttle): в сообщении прежнее содержимое
+        if key is not None and result is not True:
+            self._shown[key] = digest
+            if len(self._shown) > self.max_messages:
+                self._shown.popitem(last=False)
+        return result
+
+    async def edit_text(self, query, text, reply_markup=None, parse_mode=None, skippable=False):
+        return await self._edit(
+            query,
+            ("text", text, parse_mode, reply_markup),
+            lambda: query.edit_message_text(
+                text, parse_mode=parse_mode, reply_markup=reply_markup, rate_limit_args=_limit_args(skippable)
+            ),
+        )
+
+    async def edit_caption(self, query, caption, reply_markup=None, parse_mode=None, skippable=False):
+        return await self._edit(
+            query,
+            ("caption", caption, parse_mode, reply_markup),
+            lambda: query.edit_message_caption(
+                caption=caption, parse_mode=parse_mode, reply_markup=reply_markup, rate_limit_args=_limit_args(skippable)
+            ),
+        )
+
+    async def edit_media(self, query, media, reply_markup, content, skippable=False):
+        """content — хэшируемое описание медиа (например, id товара, URL фото и подпись): сам InputMedia не сравнивается"""
+        return await self._edit(
+            query,
+            ("media", content, reply_markup),
+            lambda: query.edit_message_media(media=media, reply_markup=reply_markup, rate_limit_args=_limit_args(skippable)),
+        )
+
+    def stats(self) -> dict:
+        return {"edits_sent": self.edits_sent, "edits_avoided": self.edits_avoided, "edits_tracked_messages": len(self._shown)}